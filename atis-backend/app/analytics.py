@@ -1,51 +1,250 @@
 """
 Analytics and Tracking Module for ATIS
-Tracks system usage, performance metrics, and generates insights
+Tracks system usage, performance metrics, and generates insights.
+Every tracked event is appended to an event log (see eventlog.py) and
+applied to the in-memory state; on startup the state is rebuilt by
+replaying the log. analytics_data.json from earlier versions is converted
+into the log once and renamed to analytics_data.json.migrated.
+
+The state holds aggregates, not the events themselves: running sums and
+counts, per-mode and per-route counters, the usage heatmap, per-user
+totals in leaderboards that keep their top entries ready, and a 7-day
+window of active users. Each event updates them in O(1), so dashboard
+reads cost the same at any history size. rebuild() recomputes them from
+the log.
 """
 
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+import heapq
+import threading
 import time
 import json
 import os
-from collections import defaultdict, Counter
-from datetime import datetime, timedelta
+from collections import Counter
+from datetime import datetime
+
+from .eventlog import EventLog
+
+LOG_DIR = os.getenv("ATIS_ANALYTICS_LOG_DIR", os.path.join(os.path.dirname(__file__), "analytics_log"))
+
+# Entries each leaderboard keeps ready; longer lists are sorted on demand
+LEADERBOARD_SIZE = int(os.getenv("ATIS_ANALYTICS_TOP", "100"))
+ACTIVE_WINDOW_S = 7 * 24 * 60 * 60
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+class Leaderboard:
+    """Running totals per key that serve the top entries without sorting all keys
+
+    The best `size` keys are kept in `_top`, with a min-heap (pruned lazily)
+    to find the one to displace. While totals only grow, no key outside
+    `_top` can overtake the heap's minimum without passing through add(),
+    so the set stays exact. A leader whose total drops marks the board for
+    one full rebuild on the next read.
+    """
+
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.totals: Dict[Any, float] = {}
+        self._top: Dict[Any, float] = {}
+        self._heap: List[Tuple[float, Any]] = []
+        self._dirty = False
+
+    def add(self, key: Any, amount: float = 1):
+        total = self.totals.get(key, 0) + amount
+        self.totals[key] = total
+        if self._dirty:
+            return
+        top = self._top
+        if key in top:
+            if amount < 0:
+                self._dirty = True
+                return
+            top[key] = total
+        elif len(top) < self.size:
+            top[key] = total
+        else:
+            # Stale heap entries are older, smaller totals, so this rejects most keys cheaply
+            if total <= self._heap[0][0]:
+                return
+            floor_total, floor_key = self._floor()
+            if total <= floor_total:
+                return
+            del top[floor_key]
+            heapq.heappop(self._heap)
+            top[key] = total
+        heapq.heappush(self._heap, (total, key))
+        if len(self._heap) > 4 * self.size:
+            self._heap = [(t, k) for k, t in self._top.items()]
+            heapq.heapify(self._heap)
+
+    def _floor(self) -> Tuple[float, Any]:
+        # Entries left behind by later updates of the same key are stale
+        while self._top.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def _rebuild(self):
+        self._top = dict(heapq.nlargest(self.size, self.totals.items(), key=lambda kv: kv[1]))
+        self._heap = [(t, k) for k, t in self._top.items()]
+        heapq.heapify(self._heap)
+        self._dirty = False
+
+    def top(self, limit: int) -> List[Tuple[Any, float]]:
+        """The `limit` largest totals, largest first"""
+        if limit > self.size:
+            return heapq.nlargest(limit, self.totals.items(), key=lambda kv: kv[1])
+        if self._dirty:
+            self._rebuild()
+        return sorted(self._top.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+    def __len__(self):
+        return len(self.totals)
+
+
+class ActiveWindow:
+    """Number of users whose last activity is after a cutoff, without a pass over all users
+
+    Users sit in one bucket per second of last activity. Buckets leave,
+    oldest first, once the cutoff passes them; the cutoff only moves forward.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[int, set] = {}
+        self._order: List[int] = []    # min-heap of bucket seconds
+        self._last: Dict[str, int] = {}
+        self._count = 0
+
+    def touch(self, user: str, timestamp: int):
+        bucket = self._buckets.get(self._last.get(user))
+        if bucket is not None and user in bucket:
+            bucket.discard(user)
+            self._count -= 1
+        self._last[user] = timestamp
+        bucket = self._buckets.get(timestamp)
+        if bucket is None:
+            bucket = self._buckets[timestamp] = set()
+            heapq.heappush(self._order, timestamp)
+        bucket.add(user)
+        self._count += 1
+
+    def count_after(self, cutoff: int) -> int:
+        while self._order and self._order[0] <= cutoff:
+            self._count -= len(self._buckets.pop(heapq.heappop(self._order)))
+        return self._count
 
 
 class AnalyticsTracker:
     """Tracks and analyzes system usage"""
     
-    def __init__(self, data_file: str = "analytics_data.json"):
+    def __init__(self, data_file: str = "analytics_data.json", log_dir: str = LOG_DIR):
         self.data_file = os.path.join(os.path.dirname(__file__), data_file)
-        self.data = self._load_data()
+        self._lock = threading.Lock()
+        self.data = self._init_data()
+        self.log = EventLog(log_dir)
+        fresh = not any(True for _ in self.log.replay())
+        if fresh and os.path.exists(self.data_file):
+            self._migrate_legacy()
+        elif fresh:
+            self._record('started', {'timestamp': self.data['started_at']})
+        self.rebuild()
+    
+    def rebuild(self):
+        """Recompute every aggregate from the event log"""
+        self.log.wait_durable()
+        with self._lock:
+            self.data = self._init_data()
+            for event in self.log.replay():
+                self._apply(event.pop('k'), event)
+    
+    def _migrate_legacy(self):
+        """Write the events of an old analytics_data.json into the log, oldest first"""
+        try:
+            with open(self.data_file, 'r') as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not migrate {self.data_file}: {e}")
+            return
+        self.log.append({'k': 'started', 'timestamp': legacy.get('started_at', int(time.time()))})
+        events = [('trip', r) for r in legacy.get('trips', [])]
+        events += [('search', r) for r in legacy.get('searches', [])]
+        events += [('system', r) for r in legacy.get('system_events', [])]
+        events.sort(key=lambda e: e[1].get('timestamp', 0))
+        for kind, record in events:
+            self.log.append({'k': kind, **record})
+        if not self.log.wait_durable():
+            # Keep the source; the log now holds a partial copy, so don't import it twice
+            print(f"Could not write {self.data_file} to the event log; kept it. "
+                  f"Remove {self.log.directory} to import it again")
+            return
+        os.replace(self.data_file, self.data_file + '.migrated')
+    
+    def _record(self, kind: str, record: Dict[str, Any]):
+        """Apply an event and queue it for the log (committed within ATIS_EVENTLOG_FLUSH_MS)"""
+        with self._lock:
+            self._apply(kind, record)
+        self.log.append({'k': kind, **record})
+    
+    def _apply(self, kind: str, record: Dict[str, Any]):
+        if kind == 'trip':
+            self._apply_trip(record)
+            self._update_user_stats(record.get('user', 'unknown'), 'trip', record.get('timestamp'))
+        elif kind == 'search':
+            self.data['totals']['searches'] += 1
+            self._update_user_stats(record.get('user', 'unknown'), 'search', record.get('timestamp'))
+        elif kind == 'system':
+            self.data['totals']['system_events'] += 1
+        elif kind == 'started':
+            self.data['started_at'] = record['timestamp']
     
-    def _load_data(self) -> Dict[str, Any]:
-        """Load analytics data from file"""
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r') as f:
-                    return json.load(f)
-            except:
-                return self._init_data()
-        return self._init_data()
+    def _apply_trip(self, trip: Dict[str, Any]):
+        data = self.data
+        totals = data['totals']
+        env = trip.get('environmental', {})
+        co2 = env.get('co2_saved_kg', 0)
+        mcda = trip.get('mcda_score', 0)
+        totals['trips'] += 1
+        totals['co2_saved_kg'] += co2
+        totals['distance_km'] += env.get('total_distance_km', 0)
+        totals['duration_min'] += trip.get('duration_min', 0)
+        totals['transfers'] += trip.get('transfers', 0)
+        totals['mcda_score'] += mcda
+        if mcda >= 50:
+            totals['successful'] += 1
+        modes = data['modes']
+        for mode in trip.get('modes', []):
+            modes[mode] += 1
+        
+        route_key = (tuple(trip.get('origin', [])), tuple(trip.get('destination', [])))
+        route = data['routes'].get(route_key)
+        if route is None:
+            # Duration sum, and the modes of the first trip seen on the route
+            route = data['routes'][route_key] = [0, trip.get('modes', [])]
+        route[0] += trip.get('duration_min', 0)
+        data['route_counts'].add(route_key)
+        
+        dt = datetime.fromtimestamp(trip.get('timestamp', 0))
+        data['heatmap'][dt.weekday()][dt.hour] += 1
+        data['user_co2'].add(trip.get('user', 'unknown'), co2)
     
     def _init_data(self) -> Dict[str, Any]:
-        """Initialize empty analytics data structure"""
+        """Initialize empty analytics aggregates"""
         return {
-            'trips': [],
-            'searches': [],
+            'totals': {'trips': 0, 'searches': 0, 'system_events': 0, 'co2_saved_kg': 0.0,
+                       'distance_km': 0.0, 'duration_min': 0, 'transfers': 0, 'mcda_score': 0,
+                       'successful': 0},
+            'modes': Counter(),
+            'routes': {},                   # (origin, destination) -> [duration sum, modes]
+            'route_counts': Leaderboard(),
+            'heatmap': [[0] * 24 for _ in range(7)],
             'users': {},
-            'system_events': [],
+            'user_trips': Leaderboard(),
+            'user_co2': Leaderboard(),
+            'active': ActiveWindow(),
             'started_at': int(time.time())
         }
     
-    def _save_data(self):
-        """Save analytics data to file"""
-        try:
-            with open(self.data_file, 'w') as f:
-                json.dump(self.data, f, indent=2)
-        except Exception as e:
-            print(f"Failed to save analytics: {e}")
-    
     def track_trip_planned(self, user: str, origin: List[float], destination: List[float], 
                           itinerary: Dict[str, Any]):
         """Track when a trip is planned"""
@@ -62,9 +261,7 @@ class AnalyticsTracker:
             'mcda_score': itinerary.get('mcda_score', 0)
         }
         
-        self.data['trips'].append(trip_record)
-        self._update_user_stats(user, 'trip')
-        self._save_data()
+        self._record('trip', trip_record)
     
     def track_search(self, user: str, query: str, results_count: int):
         """Track location searches"""
@@ -75,9 +272,7 @@ class AnalyticsTracker:
             'results_count': results_count
         }
         
-        self.data['searches'].append(search_record)
-        self._update_user_stats(user, 'search')
-        self._save_data()
+        self._record('search', search_record)
     
     def track_system_event(self, event_type: str, details: Dict[str, Any]):
         """Track system events (errors, warnings, etc.)"""
@@ -87,139 +282,84 @@ class AnalyticsTracker:
             'details': details
         }
         
-        self.data['system_events'].append(event_record)
-        self._save_data()
+        self._record('system', event_record)
     
-    def _update_user_stats(self, user: str, action_type: str):
+    def _update_user_stats(self, user: str, action_type: str, timestamp: Optional[int] = None):
         """Update user-specific statistics"""
+        now = timestamp or int(time.time())
         if user not in self.data['users']:
             self.data['users'][user] = {
-                'first_seen': int(time.time()),
+                'first_seen': now,
                 'trip_count': 0,
                 'search_count': 0,
-                'last_active': int(time.time())
+                'last_active': now
             }
+            self.data['user_trips'].add(user, 0)
         
         if action_type == 'trip':
             self.data['users'][user]['trip_count'] += 1
+            self.data['user_trips'].add(user)
         elif action_type == 'search':
             self.data['users'][user]['search_count'] += 1
         
-        self.data['users'][user]['last_active'] = int(time.time())
+        self.data['users'][user]['last_active'] = now
+        self.data['active'].touch(user, now)
     
     def get_summary_stats(self) -> Dict[str, Any]:
         """Get overall summary statistics"""
-        trips = self.data.get('trips', [])
-        users = self.data.get('users', {})
-        
-        # Calculate totals
-        total_trips = len(trips)
-        total_users = len(users)
-        total_searches = len(self.data.get('searches', []))
-        
-        # Calculate environmental impact
-        total_co2_saved = sum(
-            trip.get('environmental', {}).get('co2_saved_kg', 0) 
-            for trip in trips
-        )
-        
-        total_distance = sum(
-            trip.get('environmental', {}).get('total_distance_km', 0)
-            for trip in trips
-        )
-        
-        # Active users (last 7 days)
-        week_ago = int(time.time()) - (7 * 24 * 60 * 60)
-        active_users = sum(
-            1 for user_data in users.values() 
-            if user_data.get('last_active', 0) > week_ago
-        )
+        with self._lock:
+            totals = dict(self.data['totals'])
+            total_users = len(self.data['users'])
+            # Active users (last 7 days)
+            active_users = self.data['active'].count_after(int(time.time()) - ACTIVE_WINDOW_S)
         
-        # Average trip metrics
-        avg_duration = sum(trip.get('duration_min', 0) for trip in trips) / max(total_trips, 1)
-        avg_transfers = sum(trip.get('transfers', 0) for trip in trips) / max(total_trips, 1)
-        avg_mcda_score = sum(trip.get('mcda_score', 0) for trip in trips) / max(total_trips, 1)
+        total_trips = totals['trips']
         
         return {
             'total_trips': total_trips,
             'total_users': total_users,
-            'total_searches': total_searches,
+            'total_searches': totals['searches'],
             'active_users_7d': active_users,
-            'total_co2_saved_kg': round(total_co2_saved, 2),
-            'total_distance_km': round(total_distance, 2),
-            'avg_duration_min': round(avg_duration, 1),
-            'avg_transfers': round(avg_transfers, 2),
-            'avg_mcda_score': round(avg_mcda_score, 1),
+            'total_co2_saved_kg': round(totals['co2_saved_kg'], 2),
+            'total_distance_km': round(totals['distance_km'], 2),
+            'avg_duration_min': round(totals['duration_min'] / max(total_trips, 1), 1),
+            'avg_transfers': round(totals['transfers'] / max(total_trips, 1), 2),
+            'avg_mcda_score': round(totals['mcda_score'] / max(total_trips, 1), 1),
             'car_trips_avoided': total_trips,
             'system_uptime_days': (int(time.time()) - self.data.get('started_at', int(time.time()))) / 86400
         }
     
     def get_popular_routes(self, limit: int = 10) -> List[Dict[str, Any]]:
         """Get most popular routes"""
-        trips = self.data.get('trips', [])
-        
-        # Create route signatures
-        route_counter = Counter()
-        route_details = {}
-        
-        for trip in trips:
-            origin = tuple(trip.get('origin', []))
-            destination = tuple(trip.get('destination', []))
-            route_key = (origin, destination)
-            
-            route_counter[route_key] += 1
-            
-            if route_key not in route_details:
-                route_details[route_key] = {
+        with self._lock:
+            top = self.data['route_counts'].top(limit)
+            popular = []
+            for (origin, dest), count in top:
+                duration_sum, modes = self.data['routes'][(origin, dest)]
+                popular.append({
                     'origin': list(origin),
-                    'destination': list(destination),
-                    'avg_duration': trip.get('duration_min', 0),
-                    'common_modes': trip.get('modes', []),
-                    'count': 0
-                }
-            else:
-                # Update averages
-                current = route_details[route_key]
-                current['count'] += 1
-                current['avg_duration'] = (
-                    (current['avg_duration'] * current['count'] + trip.get('duration_min', 0)) 
-                    / (current['count'] + 1)
-                )
-        
-        # Get top routes
-        popular = []
-        for (origin, dest), count in route_counter.most_common(limit):
-            route_key = (origin, dest)
-            details = route_details[route_key]
-            popular.append({
-                'origin': list(origin),
-                'destination': list(dest),
-                'trip_count': count,
-                'avg_duration_min': round(details['avg_duration'], 1),
-                'common_modes': details['common_modes']
-            })
+                    'destination': list(dest),
+                    'trip_count': count,
+                    'avg_duration_min': round(duration_sum / count, 1),
+                    'common_modes': modes
+                })
         
         return popular
     
+    def get_hourly_usage_matrix(self) -> Dict[str, Any]:
+        """Trip counts as a days x hours grid (0=Monday)"""
+        with self._lock:
+            heatmap = [list(row) for row in self.data['heatmap']]
+        
+        return {'days': DAYS, 'counts': heatmap}
+    
     def get_hourly_usage_heatmap(self) -> List[Dict[str, Any]]:
         """Get trip counts by hour of day and day of week"""
-        trips = self.data.get('trips', [])
-        
-        # Initialize 7x24 grid (days x hours)
-        heatmap = [[0 for _ in range(24)] for _ in range(7)]
-        
-        for trip in trips:
-            timestamp = trip.get('timestamp', 0)
-            dt = datetime.fromtimestamp(timestamp)
-            day_of_week = dt.weekday()  # 0=Monday, 6=Sunday
-            hour = dt.hour
-            heatmap[day_of_week][hour] += 1
+        heatmap = self.get_hourly_usage_matrix()['counts']
         
         # Convert to list format
         result = []
-        days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        
-        for day_idx, day_name in enumerate(days):
+        for day_idx, day_name in enumerate(DAYS):
             for hour in range(24):
                 result.append({
                     'day': day_name,
@@ -231,17 +371,13 @@ class AnalyticsTracker:
     
     def get_mode_popularity(self) -> Dict[str, Any]:
         """Get statistics on transport mode usage"""
-        trips = self.data.get('trips', [])
-        
-        mode_counter = Counter()
-        for trip in trips:
-            for mode in trip.get('modes', []):
-                mode_counter[mode] += 1
+        with self._lock:
+            mode_counter = dict(self.data['modes'])
         
         total = sum(mode_counter.values())
         
         return {
-            'counts': dict(mode_counter),
+            'counts': mode_counter,
             'percentages': {
                 mode: round((count / total * 100), 1) 
                 for mode, count in mode_counter.items()
@@ -250,88 +386,61 @@ class AnalyticsTracker:
     
     def get_environmental_impact(self) -> Dict[str, Any]:
         """Get cumulative environmental impact statistics"""
-        trips = self.data.get('trips', [])
-        
-        total_co2_saved = sum(
-            trip.get('environmental', {}).get('co2_saved_kg', 0)
-            for trip in trips
-        )
+        with self._lock:
+            totals = dict(self.data['totals'])
         
-        total_distance = sum(
-            trip.get('environmental', {}).get('total_distance_km', 0)
-            for trip in trips
-        )
+        total_co2_saved = totals['co2_saved_kg']
         
         # Calculate tree equivalent (45.9 trees per ton CO2 per year)
         trees_equivalent = (total_co2_saved / 1000) * 45.9
         
         return {
             'total_co2_saved_kg': round(total_co2_saved, 2),
-            'total_distance_km': round(total_distance, 2),
+            'total_distance_km': round(totals['distance_km'], 2),
             'trees_equivalent': round(trees_equivalent, 1),
-            'car_trips_avoided': len(trips),
-            'avg_co2_per_trip': round(total_co2_saved / max(len(trips), 1), 2)
+            'car_trips_avoided': totals['trips'],
+            'avg_co2_per_trip': round(total_co2_saved / max(totals['trips'], 1), 2)
         }
     
     def get_user_leaderboard(self, metric: str = 'trips', limit: int = 10) -> List[Dict[str, Any]]:
         """Get top users by various metrics"""
-        users = self.data.get('users', {})
-        trips = self.data.get('trips', [])
-        
-        if metric == 'trips':
-            sorted_users = sorted(
-                users.items(),
-                key=lambda x: x[1].get('trip_count', 0),
-                reverse=True
-            )[:limit]
-            
-            return [
-                {
-                    'username': user,
-                    'trip_count': data.get('trip_count', 0),
-                    'search_count': data.get('search_count', 0)
-                }
-                for user, data in sorted_users
-            ]
-        
-        elif metric == 'environmental':
-            # Calculate per-user CO2 savings
-            user_co2 = defaultdict(float)
-            for trip in trips:
-                user = trip.get('user', 'unknown')
-                co2_saved = trip.get('environmental', {}).get('co2_saved_kg', 0)
-                user_co2[user] += co2_saved
-            
-            sorted_users = sorted(
-                user_co2.items(),
-                key=lambda x: x[1],
-                reverse=True
-            )[:limit]
+        with self._lock:
+            if metric == 'trips':
+                users = self.data['users']
+                return [
+                    {
+                        'username': user,
+                        'trip_count': users[user]['trip_count'],
+                        'search_count': users[user]['search_count']
+                    }
+                    for user, _ in self.data['user_trips'].top(limit)
+                ]
             
-            return [
-                {
-                    'username': user,
-                    'co2_saved_kg': round(co2, 2),
-                    'trees_equivalent': round((co2 / 1000) * 45.9, 1)
-                }
-                for user, co2 in sorted_users
-            ]
+            elif metric == 'environmental':
+                return [
+                    {
+                        'username': user,
+                        'co2_saved_kg': round(co2, 2),
+                        'trees_equivalent': round((co2 / 1000) * 45.9, 1)
+                    }
+                    for user, co2 in self.data['user_co2'].top(limit)
+                ]
         
         return []
     
     def get_performance_metrics(self) -> Dict[str, Any]:
         """Get system performance metrics"""
-        trips = self.data.get('trips', [])
+        with self._lock:
+            totals = dict(self.data['totals'])
         
-        if not trips:
+        if not totals['trips']:
             return {'avg_mcda_score': 0, 'success_rate': 100}
         
         # Calculate average MCDA scores
-        avg_mcda = sum(trip.get('mcda_score', 0) for trip in trips) / len(trips)
+        avg_mcda = totals['mcda_score'] / totals['trips']
         
         # Success rate (trips with reasonable scores)
-        successful = sum(1 for trip in trips if trip.get('mcda_score', 0) >= 50)
-        success_rate = (successful / len(trips)) * 100
+        success_rate = (totals['successful'] / totals['trips']) * 100
         
         # Average satisfaction (mock data based on MCDA scores)
         avg_satisfaction = min(5.0, (avg_mcda / 20))  # Scale 0-100 to 0-5
@@ -340,7 +449,7 @@ class AnalyticsTracker:
             'avg_mcda_score': round(avg_mcda, 1),
             'success_rate': round(success_rate, 1),
             'avg_satisfaction': round(avg_satisfaction, 1),
-            'total_evaluations': len(trips)
+            'total_evaluations': totals['trips']
         }
 
 
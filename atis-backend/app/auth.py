@@ -1,4 +1,4 @@
-import os, json, time, hashlib, hmac
+import os, time
 from typing import Optional, Tuple
 import jwt
 import pyotp
@@ -6,87 +6,87 @@ import qrcode
 import io
 import base64
 
-USERS_PATH = os.path.join(os.path.dirname(__file__), "users.json")
+from .users import get_users
+from .passwords import hash_password, check_password, check_nobody, is_legacy
+from .tokens import Revocations, TokenCache, token_digest
+
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 JWT_ISSUER = "atis-demo"
 JWT_EXP_SECONDS = 60*60*8
 
-def _load_users():
-    if os.path.exists(USERS_PATH):
-        return json.loads(open(USERS_PATH).read())
-    return {}
-
-def _save_users(data):
-    with open(USERS_PATH, "w", encoding="utf-8") as f:
-        f.write(json.dumps(data, indent=2))
-
-def _hash_password(password: str, salt: str) -> str:
-    return hashlib.sha256((salt + ":" + password).encode()).hexdigest()
-
+# register_user and verify_user run bcrypt: call them through passwords.hash_pool
 def register_user(username: str, password: str) -> bool:
-    users = _load_users()
-    if username in users:
-        return False
-    salt = hashlib.sha256(os.urandom(16)).hexdigest()[:16]
     mfa_secret = pyotp.random_base32()  # Generate MFA secret
-    users[username] = {
-        "salt": salt, 
-        "pw": _hash_password(password, salt), 
+    # False if the name is taken, including by a concurrent registration
+    return get_users().create(username, {
+        "salt": "",  # bcrypt keeps its salt in the hash
+        "pw": hash_password(password), 
         "created": int(time.time()),
         "mfa_secret": mfa_secret,
         "mfa_enabled": False  # User must enable it after setup
-    }
-    _save_users(users)
-    return True
+    })
 
 def verify_user(username: str, password: str) -> bool:
-    users = _load_users()
-    u = users.get(username)
-    if not u: return False
-    return hmac.compare_digest(_hash_password(password, u["salt"]), u["pw"])
+    u = get_users().get(username)
+    if not u: return check_nobody(password)
+    if not check_password(password, u["pw"], u["salt"]):
+        return False
+    if is_legacy(u["pw"]):
+        # Old SHA-256 hash: replace it now that we know the password
+        get_users().update(username, pw=hash_password(password), salt="")
+    return True
 
 def issue_token(username: str) -> str:
     now = int(time.time())
-    payload = {"sub": username, "iss": JWT_ISSUER, "iat": now, "exp": now + JWT_EXP_SECONDS}
+    # jti keeps tokens issued in the same second distinct, so each can be revoked alone
+    payload = {"sub": username, "iss": JWT_ISSUER, "iat": now, "exp": now + JWT_EXP_SECONDS,
+               "jti": base64.urlsafe_b64encode(os.urandom(9)).decode()}
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
-def decode_token(token: str) -> Optional[dict]:
+def _verify_token(token: str) -> Optional[dict]:
     try:
         return jwt.decode(token, JWT_SECRET, algorithms=["HS256"], issuer=JWT_ISSUER)
     except Exception:
         return None
 
+# Verified claims cached by token digest until exp; revocations checked on every use
+revocations = Revocations(get_users, lifetime_s=JWT_EXP_SECONDS)
+token_cache = TokenCache(_verify_token, revocations)
+
+def decode_token(token: str) -> Optional[dict]:
+    return token_cache.claims(token)
+
+def revoke_token(token: str) -> bool:
+    """Log a token out; False if it was not valid anyway"""
+    claims = decode_token(token)
+    if not claims:
+        return False
+    revocations.revoke_token(token_digest(token), claims["exp"])
+    return True
+
+def revoke_user_tokens(username: str):
+    """Void every token issued to the user before now"""
+    revocations.revoke_user(username)
+
 # ========== MFA Functions ==========
 
 def get_mfa_secret(username: str) -> Optional[str]:
     """Get user's MFA secret"""
-    users = _load_users()
-    u = users.get(username)
+    u = get_users().get(username)
     return u.get("mfa_secret") if u else None
 
 def is_mfa_enabled(username: str) -> bool:
     """Check if MFA is enabled for user"""
-    users = _load_users()
-    u = users.get(username)
+    u = get_users().get(username)
     return u.get("mfa_enabled", False) if u else False
 
 def enable_mfa(username: str) -> bool:
     """Enable MFA for user"""
-    users = _load_users()
-    if username not in users:
-        return False
-    users[username]["mfa_enabled"] = True
-    _save_users(users)
-    return True
+    return get_users().update(username, mfa_enabled=True)
 
 def disable_mfa(username: str) -> bool:
     """Disable MFA for user"""
-    users = _load_users()
-    if username not in users:
-        return False
-    users[username]["mfa_enabled"] = False
-    _save_users(users)
-    return True
+    return get_users().update(username, mfa_enabled=False)
 
 def verify_mfa_code(username: str, code: str) -> bool:
     """Verify MFA code"""
@@ -0,0 +1,325 @@
+"""
+In-process Result Caches for ATIS
+LRU + TTL caches with single-flight loading: concurrent misses on the same
+key wait for the one request already computing it instead of repeating the
+work. A cache can subscribe to data topics ("feed", "incidents",
+"realtime", "reviews", ...); publishing a change on a topic clears every cache that
+depends on it. StaleCache adds stale-while-revalidate for upstream data
+such as departure boards.
+"""
+
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import random
+import threading
+import time
+
+from .db import add_swap_listener
+
+
+class _Flight:
+    """One in-progress computation that concurrent callers wait on"""
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire `ttl_s` seconds after they were
+    computed. With `align_s`, entries also expire at the next multiple of
+    `align_s` on the wall clock (plus up to `jitter_s`, so keys don't all
+    turn over at once), for data the upstream republishes on a schedule.
+    Results computed while the cache was being invalidated are handed to
+    their waiters but not stored.
+    """
+
+    def __init__(self, name: str, max_entries: int = 1024, ttl_s: float = 60.0,
+                 topics: Iterable[str] = (), align_s: Optional[float] = None, jitter_s: float = 0.0):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.align_s = align_s
+        self.jitter_s = jitter_s
+        self.topics = tuple(topics)
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0,
+                      "expired": 0, "invalidations": 0, "errors": 0}
+        _register(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Cached value or `default`; does not count towards hit/miss stats"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._store(key, value)
+
+    def offer(self, key: Hashable, value: Any) -> bool:
+        """
+        Store a value fetched outside the cache unless a fresh entry or a
+        computation of `key` is already there. Never waits, so it is safe
+        to call from an event loop or a future's callback.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if key in self._flights or (entry is not None and entry[0] > time.monotonic()):
+                return False
+            self._store(key, value)
+            return True
+
+    def _expiry(self) -> float:
+        now = time.monotonic()
+        if not self.align_s:
+            return now + self.ttl_s
+        wall = time.time()
+        boundary = math.floor(wall / self.align_s + 1) * self.align_s + random.uniform(0, self.jitter_s)
+        return now + min(self.ttl_s, boundary - wall)
+
+    def _store(self, key, value):
+        self._data[key] = (self._expiry(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Cached value for `key`, computing it on a miss. Only one caller per
+        key runs `compute`; the others block until it finishes and share its
+        result (or its exception).
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[1]
+                del self._data[key]
+                self.stats["expired"] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+            raise
+        with self._lock:
+            # A flight that was discarded or invalidated meanwhile may hold old data
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+                if generation == self._generation:
+                    self._store(key, flight.value)
+        flight.done.set()
+        return flight.value
+
+    def discard(self, key: Hashable):
+        """Drop one entry; a computation of it already in flight finishes but is not stored"""
+        with self._lock:
+            self._data.pop(key, None)
+            self._flights.pop(key, None)
+
+    def invalidate(self):
+        """Drop every entry; in-flight computations finish but are not stored"""
+        with self._lock:
+            self._data.clear()
+            self._flights.clear()
+            self._generation += 1
+            self.stats["invalidations"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self.stats)
+            s["size"] = len(self._data)
+        lookups = s["hits"] + s["misses"] + s["coalesced"]
+        s["hit_ratio"] = round((s["hits"] + s["coalesced"]) / lookups, 3) if lookups else 0.0
+        s["max_entries"] = self.max_entries
+        s["ttl_s"] = self.ttl_s
+        if self.align_s:
+            s["align_s"] = self.align_s
+        return s
+
+
+class StaleCache(TTLCache):
+    """
+    TTLCache with stale-while-revalidate: an entry is fresh for `ttl_s`,
+    then served as-is for up to `stale_s` more while one background refresh
+    per key fetches the new value. Only entries past both windows make the
+    caller wait, with concurrent callers sharing one fetch. A failed
+    refresh keeps serving the stale entry until it runs out.
+    """
+
+    def __init__(self, name: str, max_entries: int = 1024, ttl_s: float = 15.0,
+                 stale_s: float = 30.0, topics: Iterable[str] = (), refresh_workers: int = 4,
+                 align_s: Optional[float] = None, jitter_s: float = 0.0):
+        super().__init__(name, max_entries, ttl_s, topics, align_s, jitter_s)
+        self.stale_s = stale_s
+        self._refreshing: Dict[Hashable, object] = {}
+        self._recent_calls: "deque[float]" = deque()   # upstream call times, last minute
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers,
+                                            thread_name_prefix=f"{name}-refresh")
+        self.stats.update({"stale": 0, "refreshes": 0, "refresh_errors": 0, "upstream_calls": 0})
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] + self.stale_s <= time.monotonic():
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry[1]
+                if entry[0] + self.stale_s > now:
+                    self._data.move_to_end(key)
+                    self.stats["stale"] += 1
+                    if key not in self._refreshing and key not in self._flights:
+                        token = self._refreshing[key] = object()
+                        self._executor.submit(self._refresh, key, compute, token, self._generation)
+                    return entry[1]
+        return super().get_or_compute(key, self._counted(compute))
+
+    def _counted(self, compute: Callable[[], Any]) -> Callable[[], Any]:
+        def call():
+            with self._lock:
+                self._count_call()
+            return compute()
+        return call
+
+    def _count_call(self):
+        self.stats["upstream_calls"] += 1
+        self._recent_calls.append(time.monotonic())
+        self._trim_calls()
+
+    def offer(self, key: Hashable, value: Any) -> bool:
+        # The value came from an upstream call made outside the cache
+        with self._lock:
+            self._count_call()
+        return super().offer(key, value)
+
+    def _refresh(self, key: Hashable, compute: Callable[[], Any], token: object, generation: int):
+        try:
+            value = self._counted(compute)()
+        except Exception:
+            value = token
+        with self._lock:
+            current = self._refreshing.get(key) is token
+            if current:
+                del self._refreshing[key]
+            if value is token:
+                self.stats["refresh_errors"] += 1
+            elif current and generation == self._generation:
+                self._store(key, value)
+                self.stats["refreshes"] += 1
+
+    def _trim_calls(self):
+        cutoff = time.monotonic() - 60
+        while self._recent_calls and self._recent_calls[0] < cutoff:
+            self._recent_calls.popleft()
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._refreshing.pop(key, None)
+        super().discard(key)
+
+    def invalidate(self):
+        with self._lock:
+            self._refreshing.clear()
+        super().invalidate()
+
+    def snapshot(self) -> Dict[str, Any]:
+        s = super().snapshot()
+        lookups = s["hits"] + s["misses"] + s["coalesced"] + s["stale"]
+        s["hit_ratio"] = round((lookups - s["misses"]) / lookups, 3) if lookups else 0.0
+        # Without the cache every lookup would have been an upstream call
+        s["upstream_calls_saved"] = lookups - s["upstream_calls"]
+        with self._lock:
+            self._trim_calls()
+            s["upstream_calls_last_min"] = len(self._recent_calls)
+        s["stale_s"] = self.stale_s
+        return s
+
+
+# ---------- Registry & change notifications ----------
+
+_caches: Dict[str, TTLCache] = {}
+_change_listeners: List[Callable[[str], None]] = []
+
+
+def _register(cache: TTLCache):
+    _caches[cache.name] = cache
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: c.snapshot() for name, c in list(_caches.items())}
+
+
+def add_change_listener(fn: Callable[[str], None]):
+    """Call `fn(topic)` after each data_changed, once dependent caches are cleared"""
+    _change_listeners.append(fn)
+
+
+def data_changed(topic: str):
+    """Publish a change on `topic`: clears every cache subscribed to it"""
+    for cache in list(_caches.values()):
+        if topic in cache.topics:
+            cache.invalidate()
+    for fn in list(_change_listeners):
+        fn(topic)
+
+
+add_swap_listener(lambda: data_changed("feed"))
+
+
+# ---------- Key helpers ----------
+
+def snap(lat: float, lng: float, grid_deg: float) -> Tuple[int, int]:
+    """Grid cell of a coordinate, for keys that tolerate nearby points"""
+    return round(lat / grid_deg), round(lng / grid_deg)
+
+
+def time_bucket(when, bucket_s: int) -> int:
+    """Index of the `bucket_s`-second window containing datetime `when`"""
+    return int(when.timestamp()) // bucket_s
@@ -1,28 +1,279 @@
-import sqlite3, os
+import sqlite3, os, threading, time
+from contextlib import contextmanager
+from math import radians, sin, cos, atan2, sqrt
 DB_PATH = os.path.join(os.path.dirname(__file__), "atis.db")
 
-def connect():
-    return sqlite3.connect(DB_PATH)
+# Connection pool tuning (see /metrics for checkout and wait stats)
+POOL_SIZE = int(os.getenv("ATIS_DB_POOL_SIZE", "8"))
+POOL_TIMEOUT_S = float(os.getenv("ATIS_DB_POOL_TIMEOUT", "10"))
+# How often a pool checks whether its file was replaced by another process
+# (python -m app.init_db swaps in a new atis.db under the running API)
+FILE_CHECK_S = float(os.getenv("ATIS_DB_FILE_CHECK_S", "1"))
+STATEMENT_CACHE = 256
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-65536",    # 64 MB (negative = KiB)
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+def _file_id(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+class ConnectionPool:
+    """
+    Bounded pool of persistent SQLite connections for one database file.
+    Connections keep their statement cache and page cache between requests,
+    and may be handed to any threadpool worker.
+
+    At most every FILE_CHECK_S a checkout looks at the file's inode. When
+    another process has renamed a new file into place, connections to the
+    old one are retired (idle ones now, busy ones when returned) and the
+    swap listeners run, as after an in-process swap_database().
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = []  # LIFO, so the warmest connection is reused first
+        self._cond = threading.Condition()
+        self._open_count = 0
+        self._paused = False
+        self._file = None          # inode the connections should be on
+        self._con_file = {}        # connection -> inode it was opened on
+        self._next_check = 0.0
+        self.stats = {"checkouts": 0, "waits": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+                      "timeouts": 0, "opened": 0, "closed": 0, "file_changes": 0}
+
+    def _open(self):
+        con = sqlite3.connect(self.path, check_same_thread=False,
+                              cached_statements=STATEMENT_CACHE)
+        for pragma in PRAGMAS:
+            con.execute(pragma)
+        with self._cond:
+            if self._file is None:
+                self._file = _file_id(self.path)
+            self._con_file[con] = self._file
+        return con
+
+    def _close(self, con):
+        with self._cond:
+            self._con_file.pop(con, None)
+        con.close()
+
+    def note_file(self):
+        """The file at `path` was just replaced in this process; no need to detect it"""
+        with self._cond:
+            self._file = _file_id(self.path)
+            self._next_check = time.monotonic() + FILE_CHECK_S
+
+    def _check_file(self):
+        """True if the file was replaced since the last check (once per replacement)"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        current = _file_id(self.path)
+        with self._cond:
+            if now < self._next_check:
+                return False
+            self._next_check = now + FILE_CHECK_S
+            if current is None or current == self._file or self._file is None:
+                return False
+            self._file = current
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self.stats["closed"] += len(idle)
+            self.stats["file_changes"] += 1
+            self._cond.notify_all()
+        for con in idle:
+            self._close(con)
+        return True
+
+    def acquire(self, timeout=POOL_TIMEOUT_S):
+        if self._check_file():
+            # Not inline: the caller may hold a lock a listener takes (e.g. a timetable load)
+            threading.Thread(target=_run_swap_listeners, name="db-file-changed", daemon=True).start()
+        deadline = time.monotonic() + timeout
+        wait_start = None
+        con = None
+        with self._cond:
+            while True:
+                if not self._paused:
+                    if self._idle:
+                        con = self._idle.pop()
+                        break
+                    if self._open_count < self.size:
+                        self._open_count += 1
+                        self.stats["opened"] += 1
+                        break
+                if wait_start is None:
+                    wait_start = time.perf_counter()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise TimeoutError(f"No SQLite connection free for {self.path} after {timeout}s")
+                self._cond.wait(remaining)
+            self.stats["checkouts"] += 1
+            if wait_start is not None:
+                waited = (time.perf_counter() - wait_start) * 1000
+                self.stats["waits"] += 1
+                self.stats["wait_ms_total"] += waited
+                self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], waited)
+        if con is None:
+            try:
+                con = self._open()
+            except Exception:
+                with self._cond:
+                    self._open_count -= 1
+                    self._cond.notify()
+                raise
+        return con
+
+    def release(self, con):
+        if con.in_transaction:
+            con.rollback()
+        with self._cond:
+            if not self._paused and self._con_file.get(con) == self._file:
+                self._idle.append(con)
+                self._cond.notify()
+                return
+            # Draining for paused(), or open on a file since replaced: retire instead of reusing
+            self._open_count -= 1
+            self.stats["closed"] += 1
+            self._cond.notify_all()
+        self._close(con)
+
+    @contextmanager
+    def paused(self, timeout=POOL_TIMEOUT_S):
+        """
+        Hold off checkouts and close every connection for the duration,
+        e.g. while the database file is replaced underneath the pool.
+        Connections in use are closed as they are returned.
+        """
+        with self._cond:
+            self._paused = True
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self.stats["closed"] += len(idle)
+        for con in idle:
+            self._close(con)
+        try:
+            with self._cond:
+                if not self._cond.wait_for(lambda: self._open_count == 0, timeout):
+                    raise TimeoutError(f"Connections to {self.path} still in use after {timeout}s")
+            yield
+        finally:
+            with self._cond:
+                self._paused = False
+                self._cond.notify_all()
+
+    def reset(self):
+        """Close every connection; the next checkout reopens the file"""
+        with self.paused():
+            pass
+
+    def snapshot(self):
+        with self._cond:
+            s = dict(self.stats)
+            s["size"] = self.size
+            s["open"] = self._open_count
+            s["idle"] = len(self._idle)
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / s["waits"], 3) if s["waits"] else 0.0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 3)
+        s["wait_ms_max"] = round(s["wait_ms_max"], 3)
+        return s
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=None):
+    path = path or DB_PATH
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+@contextmanager
+def connection(path=None):
+    """Check out a pooled connection; commits on success, rolls back on error"""
+    pool = get_pool(path)
+    con = pool.acquire()
+    try:
+        yield con
+        if con.in_transaction:
+            con.commit()
+    finally:
+        pool.release(con)
+
+def reset_pool(path=None):
+    pool = _pools.get(path or DB_PATH)
+    if pool is not None:
+        pool.reset()
+
+# Called after swap_database() installs a new file, or a pool notices another
+# process did (e.g. to drop caches)
+_swap_listeners = []
+
+def add_swap_listener(fn):
+    _swap_listeners.append(fn)
+
+def swap_database(new_path, path=None):
+    """
+    Atomically replace the database at `path` with the fully built file at
+    `new_path`. Checkouts pause while the old file's WAL is checkpointed
+    and the new file is renamed into place, so no connection ever sees a
+    mix of the two.
+    """
+    path = path or DB_PATH
+    pool = get_pool(path)
+    with pool.paused():
+        if os.path.exists(path):
+            con = sqlite3.connect(path)
+            try:
+                con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                con.close()
+        os.replace(new_path, path)
+        # The WAL and its index are found by name, not inode: left in place, the
+        # old file's frames would be replayed into the new one. Processes still on
+        # the old file keep their open (now unlinked) copies until their pools
+        # notice the new inode and retire those connections
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        pool.note_file()
+    _run_swap_listeners()
+
+def _run_swap_listeners():
+    for fn in _swap_listeners:
+        fn()
+
+def pool_stats():
+    return {path: pool.snapshot() for path, pool in list(_pools.items())}
 
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371000
-    from math import radians, sin, cos, atan2, sqrt
     phi1, phi2 = radians(lat1), radians(lat2)
     dphi = radians(lat2 - lat1)
     dl = radians(lon2 - lon1)
     a = sin(dphi/2)**2 + cos(phi1)*cos(phi2)*sin(dl/2)**2
-    return 2*R*atan2(sqrt(1-a), sqrt(a))
-
-def query_nearby_stops(lat, lng, radius=900):
-    con = connect()
-    cur = con.cursor()
-    cur.execute("SELECT stop_id, name, lat, lon FROM stops")
-    rows = cur.fetchall()
-    results = []
-    for sid, name, slat, slon in rows:
-        d = haversine(lat, lng, slat, slon)
-        if d <= radius:
-            results.append({"stop_id": sid, "stop_name": name, "name": name, "lat": slat, "lng": slon, "distance_m": round(d, 1)})
-    results.sort(key=lambda x: x["distance_m"])
-    con.close()
-    return results
+    return 2*R*atan2(sqrt(a), sqrt(1-a))
+
+def query_nearby_stops(lat, lng, radius=900, k=None):
+    # Candidates come from the in-memory grid index, not a scan of `stops`
+    from .spatial import get_stop_index
+    index = get_stop_index()
+    if k:
+        return index.nearest(lat, lng, k, max_radius=radius)
+    return index.within(lat, lng, radius)
+
+def query_nearby_stops_batch(points, radius=900, k=None):
+    from .spatial import get_stop_index
+    return get_stop_index().nearby_batch(points, radius=radius, k=k)
@@ -0,0 +1,131 @@
+"""
+Response Encoding for ATIS
+JSON is encoded with orjson. Clients that list application/msgpack in
+Accept get MessagePack instead, and bodies above a size threshold are
+compressed with brotli or gzip, whichever the client accepts (brotli
+preferred). msgpack and brotli are optional: without them clients get
+JSON and gzip. Streaming responses (NDJSON, SSE) pass through untouched.
+"""
+
+from typing import Any, Optional, Tuple
+import gzip
+import os
+
+import orjson
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_BYTES = int(os.getenv("ATIS_COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("ATIS_GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("ATIS_BROTLI_QUALITY", "4"))
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def dumps(payload: Any) -> bytes:
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def json_response(payload: Any, **kwargs) -> Response:
+    """Response encoded straight from plain dicts/lists, skipping FastAPI's jsonable_encoder pass"""
+    return Response(dumps(payload), media_type=JSON, **kwargs)
+
+
+def _accepts(header: Optional[str], token: str) -> bool:
+    """token listed in an Accept / Accept-Encoding header without q=0"""
+    for part in (header or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip() == token:
+            q = params.replace(" ", "")
+            try:
+                return not q.startswith("q=") or float(q[2:]) > 0
+            except ValueError:
+                return True
+    return False
+
+
+def negotiate(headers: Headers) -> Tuple[str, Optional[str]]:
+    """(media type, content coding or None) to send for these request headers"""
+    media = MSGPACK if msgpack is not None and _accepts(headers.get("accept"), MSGPACK) else JSON
+    accept_encoding = headers.get("accept-encoding")
+    if brotli is not None and _accepts(accept_encoding, "br"):
+        return media, "br"
+    if _accepts(accept_encoding, "gzip"):
+        return media, "gzip"
+    return media, None
+
+
+def to_msgpack(json_body: bytes) -> bytes:
+    return msgpack.packb(orjson.loads(json_body), use_bin_type=True)
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def encode(json_body: bytes, media: str, coding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """JSON body -> (body in `media`, content coding actually applied)"""
+    body = to_msgpack(json_body) if media == MSGPACK else json_body
+    if coding is None or len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    return compress(body, coding), coding
+
+
+class EncodingMiddleware:
+    """
+    Re-encodes complete JSON responses for the client: MessagePack when
+    asked for, compression above MIN_COMPRESS_BYTES. Responses that already
+    carry a Content-Encoding or an ETag (negotiated by
+    http_cache.conditional) or arrive in several chunks are left alone.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        media, coding = negotiate(Headers(scope=scope))
+        if media == JSON and coding is None:
+            return await self.app(scope, receive, send)
+        start = None
+
+        async def send_encoded(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                return await send(message)
+            headers = MutableHeaders(raw=start["headers"])
+            body = message.get("body", b"")
+            if (message.get("more_body") or "content-encoding" in headers or "etag" in headers
+                    or not headers.get("content-type", "").startswith(JSON) or not body):
+                await send(start)
+                start = None
+                return await send(message)
+            encoded, applied = encode(body, media, coding)
+            if media == MSGPACK:
+                headers["content-type"] = MSGPACK
+                headers.add_vary_header("Accept")
+            if applied:
+                headers["content-encoding"] = applied
+            headers.add_vary_header("Accept-Encoding")
+            headers["content-length"] = str(len(encoded))
+            await send(start)
+            start = None
+            await send({"type": "http.response.body", "body": encoded})
+
+        await self.app(scope, receive, send_encoded)
@@ -56,7 +56,8 @@ def calculate_leg_emissions(leg: Dict[str, Any]) -> Dict[str, float]:
 
 def calculate_itinerary_emissions(itinerary: Dict[str, Any]) -> Dict[str, Any]:
     """Calculate total emissions for an entire itinerary"""
-    legs = itinerary.get('legs', [])
+    # Routed itineraries carry per-leg distances in leg_details
+    legs = itinerary.get('leg_details') or itinerary.get('legs', [])
     
     # If legs is just strings, convert to dict format
     if legs and isinstance(legs[0], str):
@@ -0,0 +1,256 @@
+"""
+Append-only Event Log for ATIS
+Events are appended as NDJSON lines to numbered segment files
+(events-00000001.ndjson, ...) in one directory. append() only queues the
+event; a background writer commits the queue as one write + fsync every
+`flush_ms` milliseconds or as soon as `flush_events` are waiting (group
+commit), so the cost per event is independent of how much history there
+is. A segment is sealed (fsynced and closed) once it passes
+`segment_bytes`, and the next one is started.
+
+Each line is "<crc32 hex> <json>". On open, the newest segment is scanned
+and cut back to its last intact line, so a crash in the middle of a commit
+loses at most that commit and never leaves a torn line behind. A corrupt
+line with intact ones after it is left in place and skipped on replay.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional
+import atexit
+import os
+import re
+import threading
+import time
+import zlib
+
+import orjson
+
+from .encoding import dumps
+
+FLUSH_MS = float(os.getenv("ATIS_EVENTLOG_FLUSH_MS", "50"))
+FLUSH_EVENTS = int(os.getenv("ATIS_EVENTLOG_FLUSH_EVENTS", "1000"))
+SEGMENT_BYTES = int(float(os.getenv("ATIS_EVENTLOG_SEGMENT_MB", "64")) * 1024 * 1024)
+FSYNC = os.getenv("ATIS_EVENTLOG_FSYNC", "1") == "1"
+# Producers wait for the writer beyond this many queued events
+MAX_PENDING = 100_000
+
+_SEGMENT = re.compile(r"^events-(\d{8})\.ndjson$")
+
+
+def encode_line(event: Dict[str, Any]) -> bytes:
+    body = dumps(event)
+    return b"%08x %s\n" % (zlib.crc32(body), body)
+
+
+def decode_line(line: bytes) -> Optional[Dict[str, Any]]:
+    """The event on an intact line, else None"""
+    if len(line) < 10 or not line.endswith(b"\n") or line[8:9] != b" ":
+        return None
+    body = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(body):
+            return None
+        return orjson.loads(body)
+    except ValueError:
+        return None
+
+
+class EventLog:
+    """Segmented NDJSON log with a group-committing background writer"""
+
+    def __init__(self, directory: str, flush_ms: float = FLUSH_MS, flush_events: int = FLUSH_EVENTS,
+                 segment_bytes: int = SEGMENT_BYTES, fsync: bool = FSYNC):
+        self.directory = directory
+        self.flush_s = flush_ms / 1000
+        self.flush_events = flush_events
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self._pending: List[bytes] = []
+        self._appended = 0     # sequence number of the last queued event
+        self._committed = 0    # ... and of the last one a commit has finished with
+        self._first_lost: Optional[int] = None   # first event of a failed commit
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = {"appended": 0, "commits": 0, "bytes": 0, "rotations": 0, "commit_ms_max": 0.0,
+                      "commit_ms_total": 0.0, "producer_waits": 0, "recovered_bytes_cut": 0, "corrupt_lines": 0,
+                      "errors": 0, "lost_events": 0}
+        self._recover()
+        self._writer = threading.Thread(target=self._run, name="eventlog-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # ---------- Segments ----------
+
+    def segments(self) -> List[str]:
+        names = sorted(n for n in os.listdir(self.directory) if _SEGMENT.match(n))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"events-{seq:08d}.ndjson")
+
+    def _recover(self):
+        """Open the newest segment for appending, cutting off a torn tail (bad lines with nothing intact after)"""
+        existing = self.segments()
+        if not existing:
+            self._seq = 1
+            self._file = open(self._segment_path(1), "ab", buffering=0)
+            self._size = 0
+            return
+        path = existing[-1]
+        self._seq = int(_SEGMENT.match(os.path.basename(path)).group(1))
+        good = 0    # end of the last intact line
+        offset = bad = bad_before_good = 0
+        with open(path, "rb") as f:
+            for line in f:
+                offset += len(line)
+                if decode_line(line) is None:
+                    bad += 1
+                else:
+                    good, bad_before_good = offset, bad
+            size = offset
+        self.stats["corrupt_lines"] = bad_before_good
+        if good < size:
+            # The tail was never acknowledged as durable: the commit that wrote it died
+            with open(path, "r+b") as f:
+                f.truncate(good)
+                f.flush()
+                os.fsync(f.fileno())
+            self.stats["recovered_bytes_cut"] = size - good
+        # Unbuffered: a failed write leaves nothing behind to be flushed later
+        self._file = open(path, "ab", buffering=0)
+        self._size = good
+
+    def _rotate(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._seq += 1
+        self._file = open(self._segment_path(self._seq), "ab", buffering=0)
+        self._size = 0
+        if self.fsync:
+            # Make the new file's directory entry durable too
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.stats["rotations"] += 1
+
+    # ---------- Writing ----------
+
+    def append(self, event: Dict[str, Any]) -> int:
+        """Queue an event; returns its sequence number (see wait_durable)"""
+        line = encode_line(event)
+        with self._cond:
+            while len(self._pending) >= MAX_PENDING and not self._closed:
+                self.stats["producer_waits"] += 1
+                self._cond.wait()
+            self._pending.append(line)
+            self._appended += 1
+            self.stats["appended"] += 1
+            if len(self._pending) >= self.flush_events:
+                self._cond.notify_all()
+            return self._appended
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_s
+                while len(self._pending) < self.flush_events and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                upto = self._appended
+                closing = self._closed
+                self._cond.notify_all()   # producers waiting on MAX_PENDING
+            if batch and not self._commit(batch):
+                with self._cond:
+                    first = upto - len(batch) + 1
+                    self._first_lost = first if self._first_lost is None else min(self._first_lost, first)
+                    self.stats["lost_events"] += len(batch)
+            with self._cond:
+                self._committed = max(self._committed, upto)
+                self._cond.notify_all()
+            if closing and not batch:
+                return
+
+    def _commit(self, batch: List[bytes]) -> bool:
+        t = time.perf_counter()
+        data = b"".join(batch)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self._file.write(view):]
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            # Keep running; the events in this batch are lost, not the writer. Cut off
+            # whatever part of the batch did reach the file, so the next commit
+            # starts on a line boundary
+            self.stats["errors"] += 1
+            print(f"Event log commit failed: {e}")
+            try:
+                os.ftruncate(self._file.fileno(), self._size)
+            except OSError as e:
+                print(f"Event log could not cut a failed commit: {e}")
+            return False
+        self._size += len(data)
+        ms = (time.perf_counter() - t) * 1000
+        self.stats["commits"] += 1
+        self.stats["bytes"] += len(data)
+        self.stats["commit_ms_total"] += ms
+        self.stats["commit_ms_max"] = max(self.stats["commit_ms_max"], ms)
+        if self._size >= self.segment_bytes:
+            self._rotate()
+        return True
+
+    def wait_durable(self, seq: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        Block until the commit of event `seq` (default: everything appended
+        so far) is done. True only if it and every event before it reached
+        the disk; False on timeout or after a failed commit.
+        """
+        with self._cond:
+            seq = self._appended if seq is None else seq
+            self._cond.notify_all()
+            if not self._cond.wait_for(lambda: self._committed >= seq, timeout):
+                return False
+            return self._first_lost is None or self._first_lost > seq
+
+    def close(self):
+        """Commit what is queued and stop the writer"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    # ---------- Reading ----------
+
+    def replay(self) -> Iterator[Dict[str, Any]]:
+        """Every committed event, oldest first (intact lines only)"""
+        for path in self.segments():
+            with open(path, "rb") as f:
+                for line in f:
+                    event = decode_line(line)
+                    if event is not None:
+                        yield event
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            s = dict(self.stats)
+            s["pending"] = len(self._pending)
+        s["segments"] = len(self.segments())
+        s["segment_bytes"] = self.segment_bytes
+        s["events_per_commit"] = round(s["appended"] / s["commits"], 1) if s["commits"] else 0.0
+        s["commit_ms_avg"] = round(s["commit_ms_total"] / s["commits"], 3) if s["commits"] else 0.0
+        s["commit_ms_total"] = round(s["commit_ms_total"], 1)
+        s["commit_ms_max"] = round(s["commit_ms_max"], 3)
+        return s
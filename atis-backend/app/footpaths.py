@@ -0,0 +1,279 @@
+"""
+Walking Transfer (Footpath) Graph for ATIS
+Precomputes, for every stop, the neighbouring stops within a walk radius
+and the time to walk there. The graph is a CSR adjacency (row offsets plus
+flat target/seconds/metres arrays, nearest first) stored in one binary file
+next to the database and memory-mapped on load, so workers share the pages
+instead of each building their own copy.
+
+When the stop table changes (a new feed is imported) only the rows of stops
+near an added, moved or removed stop are recomputed; everything else is
+copied over from the previous file.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from bisect import bisect_right
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from . import db
+from .spatial import StopIndex, load_stops
+
+FOOTPATH_RADIUS_M = float(os.getenv("ATIS_FOOTPATH_RADIUS_M", "400"))
+WALK_SPEED_MPS = 1.3           # ~4.7 km/h
+WALK_DETOUR = 1.25             # street network vs straight line
+
+# Above this share of changed stops an incremental update is not worth it
+INCREMENTAL_MAX_CHANGED = 0.3
+
+FILE_MAGIC = b"ATISFP01"
+FILE_VERSION = 1
+
+
+def walk_seconds(meters: float) -> int:
+    return int(meters * WALK_DETOUR / WALK_SPEED_MPS)
+
+
+def footpath_file(db_path: Optional[str] = None) -> str:
+    """Graph file kept beside the database it was built from"""
+    return os.path.splitext(db_path or db.DB_PATH)[0] + ".footpaths"
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class FootpathGraph:
+    """
+    CSR walking graph over a fixed stop order.
+    The neighbours of stop s are targets[offsets[s]:offsets[s+1]], with
+    walk times in secs[] and straight-line distances in meters[], sorted
+    nearest first so a tighter walk limit is just a shorter slice.
+    """
+
+    def __init__(self, stop_ids: List[str], lats: np.ndarray, lons: np.ndarray,
+                 offsets: np.ndarray, targets: np.ndarray, secs: np.ndarray,
+                 meters: np.ndarray, radius_m: float):
+        self.stop_ids = stop_ids
+        self.lats, self.lons = lats, lons
+        self.radius_m = radius_m
+        self._arrays = (offsets, targets, secs, meters)
+        # memoryviews index to plain Python numbers, which is what the
+        # routing inner loop wants (numpy scalars are far slower there)
+        self.offsets = memoryview(offsets)
+        self.targets = memoryview(targets)
+        self.secs = memoryview(secs)
+        self.meters = memoryview(meters)
+        self.path: Optional[str] = None
+        self.build_info: Dict[str, object] = {}
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.targets)
+
+    def neighbours(self, s: int, max_m: Optional[float] = None) -> List[Tuple[int, int, float]]:
+        """[(stop, walk seconds, metres)] from stop s, optionally capped at max_m"""
+        lo, hi = self.offsets[s], self.offsets[s + 1]
+        if max_m is not None and max_m < self.radius_m:
+            hi = bisect_right(self.meters, max_m, lo, hi)
+        return [(self.targets[e], self.secs[e], self.meters[e]) for e in range(lo, hi)]
+
+    def stats(self) -> Dict[str, object]:
+        return {"stops": len(self), "edges": self.n_edges, "radius_m": self.radius_m,
+                "file": self.path, **self.build_info}
+
+    # ---------- Building ----------
+
+    @classmethod
+    def from_rows(cls, stop_ids, lats, lons, rows: Sequence[Tuple[np.ndarray, np.ndarray]],
+                  radius_m: float) -> "FootpathGraph":
+        """Assemble the CSR arrays from per-stop (targets, metres) rows"""
+        counts = np.fromiter((len(t) for t, _ in rows), dtype=np.int64, count=len(rows))
+        offsets = np.zeros(len(rows) + 1, dtype=np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        if rows:
+            targets = np.concatenate([t for t, _ in rows]).astype(np.int32)
+            meters = np.concatenate([m for _, m in rows]).astype(np.float32)
+        else:
+            targets, meters = np.empty(0, np.int32), np.empty(0, np.float32)
+        secs = (meters * (WALK_DETOUR / WALK_SPEED_MPS)).astype(np.int32)
+        return cls(list(stop_ids), np.asarray(lats, np.float64), np.asarray(lons, np.float64),
+                   offsets, targets, secs, meters, radius_m)
+
+    @classmethod
+    def build(cls, index: StopIndex, radius_m: float = FOOTPATH_RADIUS_M) -> "FootpathGraph":
+        """Full build over every stop in `index`"""
+        pts = list(zip(index.lats, index.lons))
+        rows = [_drop_self(s, t, m) for s, (t, m) in enumerate(index.within_batch(pts, radius_m))]
+        return cls.from_rows(index.stop_ids, index.lats, index.lons, rows, radius_m)
+
+    @classmethod
+    def update(cls, old: "FootpathGraph", index: StopIndex,
+               radius_m: float = FOOTPATH_RADIUS_M) -> "FootpathGraph":
+        """
+        Build the graph for `index` reusing the rows of `old`.
+        A stop's row only changes if a stop within the radius of it was
+        added, removed or moved, so those are the only rows recomputed.
+        Returns `old` itself when nothing changed.
+        """
+        n = len(index.stop_ids)
+        old_pos = {sid: j for j, sid in enumerate(old.stop_ids)}
+        # j_of: new position -> old (-1 if added); remap: old -> new (-1 if removed)
+        j_of = np.fromiter((old_pos.get(sid, -1) for sid in index.stop_ids), dtype=np.int64, count=n)
+        known = np.flatnonzero(j_of >= 0)
+        lats, lons = np.asarray(index.lats), np.asarray(index.lons)
+        moved = known[(old.lats[j_of[known]] != lats[known]) | (old.lons[j_of[known]] != lons[known])]
+        remap = np.full(len(old.stop_ids), -1, dtype=np.int64)
+        remap[j_of[known]] = known
+        changed = np.union1d(np.flatnonzero(j_of < 0), moved)  # added or moved
+        gone = np.concatenate([j_of[moved], np.flatnonzero(remap < 0)])  # moved or removed
+
+        same_order = n == len(old.stop_ids) and bool((remap == np.arange(n)).all())
+        if not len(changed) and not len(gone) and same_order:
+            return old
+
+        # Every stop in range of a change, at its new or old position
+        dirty = set(changed.tolist())
+        probes = list(zip(lats[changed], lons[changed])) + list(zip(old.lats[gone], old.lons[gone]))
+        for hits, _ in index.within_batch(probes, radius_m):
+            dirty.update(hits.tolist())
+        if len(dirty) > INCREMENTAL_MAX_CHANGED * n:
+            graph = cls.build(index, radius_m)
+            graph.build_info = {"mode": "full", "rows_rebuilt": n}
+            return graph
+
+        dirty_list = sorted(dirty)
+        fresh = [_drop_self(i, t, m) for i, (t, m) in zip(dirty_list, index.within_batch(
+            [(index.lats[i], index.lons[i]) for i in dirty_list], radius_m))]
+
+        # Clean rows are gathered from the old arrays in one vectorized
+        # pass; only the dirty rows are written one by one
+        old_off, old_to, _, old_m = old._arrays
+        is_dirty = np.zeros(n, dtype=bool)
+        is_dirty[dirty_list] = True
+        counts = np.zeros(n, dtype=np.int64)
+        clean = np.flatnonzero(~is_dirty)
+        counts[clean] = old_off[j_of[clean] + 1] - old_off[j_of[clean]]
+        counts[dirty_list] = [len(t) for t, _ in fresh]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        targets = np.empty(offsets[-1], dtype=np.int32)
+        meters = np.empty(offsets[-1], dtype=np.float32)
+        row_of = np.repeat(np.arange(n), counts)
+        pos = np.flatnonzero(~is_dirty[row_of])
+        src = pos - offsets[row_of[pos]] + old_off[j_of[row_of[pos]]]
+        targets[pos] = remap[old_to[src]]
+        meters[pos] = old_m[src]
+        for i, (t, m) in zip(dirty_list, fresh):
+            targets[offsets[i]:offsets[i + 1]] = t
+            meters[offsets[i]:offsets[i + 1]] = m
+
+        secs = (meters * (WALK_DETOUR / WALK_SPEED_MPS)).astype(np.int32)
+        graph = cls(list(index.stop_ids), np.asarray(index.lats, np.float64),
+                    np.asarray(index.lons, np.float64), offsets.astype(np.int32),
+                    targets, secs, meters, radius_m)
+        graph.build_info = {"mode": "incremental", "rows_rebuilt": len(dirty_list)}
+        return graph
+
+    # ---------- Storage ----------
+
+    def save(self, path: str):
+        """Write the graph to `path` (atomically, via a temp file and rename)"""
+        offsets, targets, secs, meters = self._arrays
+        header = json.dumps({
+            "version": FILE_VERSION, "radius_m": self.radius_m,
+            "walk_speed_mps": WALK_SPEED_MPS, "walk_detour": WALK_DETOUR,
+            "stops": len(self.stop_ids), "edges": len(targets), "stop_ids": self.stop_ids,
+        }).encode()
+        arrays = (np.asarray(self.lats, "<f8"), np.asarray(self.lons, "<f8"),
+                  np.asarray(offsets, "<i4"), np.asarray(targets, "<i4"),
+                  np.asarray(secs, "<i4"), np.asarray(meters, "<f4"))
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(FILE_MAGIC + struct.pack("<Q", len(header)) + header)
+            for a in arrays:
+                fh.write(b"\0" * (_align(fh.tell()) - fh.tell()))
+                fh.write(a.tobytes())
+        os.replace(tmp, path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path: str) -> Optional["FootpathGraph"]:
+        """Memory-map a saved graph; None if missing, unreadable or built with other settings"""
+        try:
+            with open(path, "rb") as fh:
+                if fh.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                    return None
+                (header_len,) = struct.unpack("<Q", fh.read(8))
+                header = json.loads(fh.read(header_len))
+        except (OSError, ValueError, struct.error):
+            return None
+        if header.get("version") != FILE_VERSION or header.get("walk_speed_mps") != WALK_SPEED_MPS \
+                or header.get("walk_detour") != WALK_DETOUR:
+            return None
+
+        n, m = header["stops"], header["edges"]
+        pos = len(FILE_MAGIC) + 8 + header_len
+        arrays = []
+        for dtype, count in (("<f8", n), ("<f8", n), ("<i4", n + 1),
+                             ("<i4", m), ("<i4", m), ("<f4", m)):
+            pos = _align(pos)
+            if count:
+                arrays.append(np.memmap(path, dtype=dtype, mode="r", offset=pos, shape=(count,)))
+            else:
+                arrays.append(np.empty(0, dtype=dtype))
+            pos += np.dtype(dtype).itemsize * count
+        graph = cls(header["stop_ids"], *arrays, radius_m=header["radius_m"])
+        graph.path = path
+        return graph
+
+
+def _drop_self(s: int, targets: np.ndarray, meters: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    keep = targets != s
+    return targets[keep], meters[keep]
+
+
+def load_footpaths(index: StopIndex, db_path: Optional[str] = None,
+                   radius_m: float = FOOTPATH_RADIUS_M) -> FootpathGraph:
+    """
+    Footpath graph for the stops in `index`: the saved file if it still
+    matches, otherwise an incremental (or, with no usable file, full)
+    rebuild that is saved back for the next start.
+    """
+    path = footpath_file(db_path)
+    t0 = time.perf_counter()
+    old = FootpathGraph.load(path)
+    if old is not None and old.radius_m == radius_m:
+        graph = FootpathGraph.update(old, index, radius_m)
+        if graph is old:
+            graph.build_info = {"mode": "mapped", "rows_rebuilt": 0}
+    else:
+        graph = FootpathGraph.build(index, radius_m)
+        graph.build_info = {"mode": "full", "rows_rebuilt": len(index.stop_ids)}
+    graph.build_info["seconds"] = round(time.perf_counter() - t0, 3)
+
+    if graph is not old:
+        try:
+            graph.save(path)
+            # Re-open from disk so the arrays are shared page cache, not heap
+            mapped = FootpathGraph.load(path)
+            if mapped is not None:
+                mapped.build_info = graph.build_info
+                graph = mapped
+        except OSError as e:
+            print(f"Footpath graph not saved ({path}): {e}")
+    return graph
+
+
+def update_footpaths(db_path: Optional[str] = None,
+                     radius_m: float = FOOTPATH_RADIUS_M) -> FootpathGraph:
+    """Build step: bring the graph file up to date with the stops table"""
+    return load_footpaths(StopIndex(load_stops(db_path)), db_path, radius_m)
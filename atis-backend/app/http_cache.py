@@ -0,0 +1,108 @@
+"""
+HTTP Conditional Responses for ATIS
+Pre-serialized JSON bodies with a content-hash ETag and Last-Modified,
+built once per data version (kept in the result caches next to the data
+they render) instead of on every request. Polling clients that send the
+validators back get 304 Not Modified with no body. MessagePack and
+compressed variants are encoded on first use and kept with the JSON,
+each with its own ETag.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+import threading
+import time
+
+from fastapi import Request, Response
+
+from .encoding import JSON, dumps, encode, negotiate
+
+# Cache-Control for data that only changes on deploy, and for data that
+# clients may keep but must revalidate (If-None-Match) before reuse
+STATIC = "public, max-age=86400"
+REVALIDATE = "no-cache"
+
+
+class Representation:
+    """One serialized response body and its validators"""
+    __slots__ = ("body", "etag", "last_modified", "modified_s", "cache_control", "_variants")
+
+    def __init__(self, body: bytes, cache_control: str, modified_s: Optional[float] = None):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self.modified_s = int(modified_s if modified_s is not None else time.time())
+        self.last_modified = formatdate(self.modified_s, usegmt=True)
+        self.cache_control = cache_control
+        self._variants: Dict[Tuple[str, Optional[str]], Tuple[bytes, Optional[str], str]] = {}
+
+    def variant(self, media: str, coding: Optional[str]) -> Tuple[bytes, Optional[str], str]:
+        """(body, content coding applied, ETag) for a negotiated media type and coding"""
+        if media == JSON and coding is None:
+            return self.body, None, self.etag
+        v = self._variants.get((media, coding))
+        if v is None:
+            body, applied = encode(self.body, media, coding)
+            # Each encoding is a representation of its own, so it gets its own strong ETag
+            tags = [t for t in ("msgpack" if media != JSON else None, applied) if t]
+            etag = self.etag[:-1] + "".join("-" + t for t in tags) + '"'
+            v = self._variants[(media, coding)] = (body, applied, etag)
+        return v
+
+    @classmethod
+    def of(cls, payload: Any, cache_control: str = REVALIDATE) -> "Representation":
+        return cls(dumps(payload), cache_control)
+
+
+_lock = threading.Lock()
+_stats = {"full": 0, "not_modified": 0, "bytes_out": 0, "bytes_saved": 0}
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match requires
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _not_modified_since(header: str, modified_s: int) -> bool:
+    try:
+        return modified_s <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def conditional(request: Request, rep: Representation) -> Response:
+    """200 with the stored body in the negotiated encoding, or 304 if the client's validators still match"""
+    media, coding = negotiate(request.headers)
+    body, applied, etag = rep.variant(media, coding)
+    headers = {"ETag": etag, "Last-Modified": rep.last_modified, "Cache-Control": rep.cache_control,
+               "Vary": "Accept, Accept-Encoding"}
+    if applied:
+        headers["Content-Encoding"] = applied
+    inm = request.headers.get("if-none-match")
+    ims = request.headers.get("if-modified-since")
+    if inm is not None:
+        fresh = _etag_matches(inm, etag)
+    else:
+        # If-Modified-Since only counts without If-None-Match (RFC 9110 13.2.2)
+        fresh = ims is not None and _not_modified_since(ims, rep.modified_s)
+    with _lock:
+        if fresh:
+            _stats["not_modified"] += 1
+            _stats["bytes_saved"] += len(body)
+        else:
+            _stats["full"] += 1
+            _stats["bytes_out"] += len(body)
+    if fresh:
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media, headers=headers)
+
+
+def conditional_stats() -> Dict[str, Any]:
+    with _lock:
+        s = dict(_stats)
+    total = s["full"] + s["not_modified"]
+    s["not_modified_ratio"] = round(s["not_modified"] / total, 3) if total else 0.0
+    return s
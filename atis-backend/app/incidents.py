@@ -0,0 +1,470 @@
+"""
+Incident Store for ATIS
+Traffic incidents and service alerts held in memory with two indexes: a
+uniform lat/lng grid, where each incident is listed in every cell its
+extent covers, for bbox queries, and a centered interval tree over
+start/end times for "active during [a, b]" queries. Both answer in time
+proportional to the cells or tree depth touched plus the hits, not the
+size of the store.
+
+Incidents leave the store at their end time. IncidentFeed polls each
+source (NZTA incidents, service alerts) in a daemon thread and replaces
+that source's records with its latest snapshot; any change, expiry
+included, is published on the "incidents" data topic.
+"""
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from datetime import datetime, timezone
+from math import floor
+import heapq
+import os
+import threading
+import time
+
+from .cache import data_changed
+
+INCIDENT_CELL_DEG = float(os.getenv("ATIS_INCIDENT_CELL_DEG", "0.02"))
+INCIDENTS_INTERVAL_S = float(os.getenv("ATIS_INCIDENTS_INTERVAL", "30"))
+
+# Incidents covering more grid cells than this (region-wide alerts) are
+# kept in one list that every bbox query checks, instead of in each cell
+MAX_CELLS_PER_INCIDENT = 1024
+
+FOREVER = float("inf")
+
+BBox = Tuple[float, float, float, float]   # min_lng, min_lat, max_lng, max_lat
+
+
+def parse_bbox(bbox: str) -> BBox:
+    """'minLng,minLat,maxLng,maxLat' -> floats; ValueError if malformed"""
+    parts = [float(x) for x in bbox.split(",")]
+    if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+        raise ValueError("bbox must be minLng,minLat,maxLng,maxLat")
+    return parts[0], parts[1], parts[2], parts[3]
+
+
+def parse_time(value: Any) -> Optional[float]:
+    """ISO 8601 string or epoch seconds -> epoch seconds; naive times are UTC like the feeds"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def _points(coords) -> Iterable[Tuple[float, float]]:
+    if coords and isinstance(coords[0], (int, float)):
+        yield float(coords[0]), float(coords[1])
+        return
+    for c in coords or ():
+        yield from _points(c)
+
+
+def extent(record: Dict[str, Any]) -> Optional[BBox]:
+    """
+    Bounding box of an incident from a GeoJSON `geometry`, a `bbox`
+    [minLng, minLat, maxLng, maxLat] or `lat`/`lng`; None if it has no
+    location (treated as region-wide).
+    """
+    geom = record.get("geometry")
+    if geom:
+        pts = list(_points(geom.get("coordinates")))
+        if pts:
+            lngs, lats = [p[0] for p in pts], [p[1] for p in pts]
+            return min(lngs), min(lats), max(lngs), max(lats)
+    if record.get("bbox"):
+        b = record["bbox"]
+        return float(b[0]), float(b[1]), float(b[2]), float(b[3])
+    if record.get("lat") is not None and record.get("lng") is not None:
+        lat, lng = float(record["lat"]), float(record["lng"])
+        return lng, lat, lng, lat
+    return None
+
+
+def grid_cells(box: BBox, cell_deg: float = INCIDENT_CELL_DEG) -> Optional[List[Tuple[int, int]]]:
+    """(lng, lat) grid cells a box covers; None if more than MAX_CELLS_PER_INCIDENT"""
+    x0, y0 = floor(box[0] / cell_deg), floor(box[1] / cell_deg)
+    x1, y1 = floor(box[2] / cell_deg), floor(box[3] / cell_deg)
+    if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_CELLS_PER_INCIDENT:
+        return None
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def route_key(name: Any) -> str:
+    """Route names compare case-insensitively ("NX1", "Southern Line")"""
+    return str(name).strip().casefold()
+
+
+def _intersects(a: Optional[BBox], b: BBox) -> bool:
+    return a is None or (a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3])
+
+
+# ---------- Interval tree ----------
+
+class IntervalTree:
+    """
+    Static centered interval tree over closed intervals (start, end, item).
+    Each node keeps the intervals containing its center sorted by start and
+    by end, so an overlap query walks one root-to-leaf path per side and
+    stops scanning a node's lists at the first miss: O(log n + hits).
+    Rebuilt from scratch when the set changes.
+    """
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, intervals: Iterable[Tuple[float, float, Any]]):
+        items = list(intervals)
+        self._size = len(items)
+        self._root = self._build(items)
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def _build(cls, items):
+        if not items:
+            return None
+        points = sorted(p for s, e, _ in items for p in (s, e) if p != FOREVER)
+        center = points[len(points) // 2] if points else items[0][0]
+        left, right, here = [], [], []
+        for it in items:
+            if it[1] < center:
+                left.append(it)
+            elif it[0] > center:
+                right.append(it)
+            else:
+                here.append(it)
+        by_start = sorted(here, key=lambda it: it[0])
+        by_end = sorted(here, key=lambda it: it[1], reverse=True)
+        return center, by_start, by_end, cls._build(left), cls._build(right)
+
+    def overlapping(self, start: float, end: float) -> List[Any]:
+        """Items whose interval overlaps [start, end]"""
+        out = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            center, by_start, by_end, left, right = node
+            if end < center:
+                # Every interval here ends at or after center > end: only the start can miss
+                for s, _, item in by_start:
+                    if s > end:
+                        break
+                    out.append(item)
+                stack.append(left)
+            elif start > center:
+                for _, e, item in by_end:
+                    if e < start:
+                        break
+                    out.append(item)
+                stack.append(right)
+            else:
+                out.extend(item for _, _, item in by_start)
+                stack.append(left)
+                stack.append(right)
+        return out
+
+
+# ---------- Store ----------
+
+class _Entry:
+    __slots__ = ("key", "record", "extent", "start", "end", "order", "cells", "routes", "version")
+
+    def __init__(self, key, record, box, start, end, order, version):
+        self.key = key
+        self.record = record
+        self.extent = box
+        self.start = start
+        self.end = end
+        self.order = order
+        self.cells: Optional[List[Tuple[int, int]]] = None
+        self.routes = {route_key(r) for r in record.get("affected_routes") or ()}
+        self.version = version
+
+
+class IncidentStore:
+    """
+    Current and upcoming incidents keyed by (source, id). Writers replace a
+    source's whole snapshot; readers query by bbox and time window, or by
+    the routes and cells an itinerary uses (the grid doubles as an index of
+    road segments, and affected_routes gets an inverted index of its own).
+    Changes are published on `topic` once the lock is released.
+    """
+
+    def __init__(self, cell_deg: float = INCIDENT_CELL_DEG, topic: Optional[str] = "incidents",
+                 clock: Callable[[], float] = time.time):
+        self.cell_deg = cell_deg
+        self.topic = topic
+        self.clock = clock
+        self._entries: Dict[Tuple[str, str], _Entry] = {}
+        self._cells: Dict[Tuple[int, int], Set[Tuple[str, str]]] = {}
+        self._everywhere: Set[Tuple[str, str]] = set()
+        self._by_route: Dict[str, Set[Tuple[str, str]]] = {}
+        self._listeners: List[Callable[[List[Tuple[str, Dict[str, Any]]]], None]] = []
+        self._tree: Optional[IntervalTree] = None
+        self._ends: List[Tuple[float, int, Tuple[str, str]]] = []   # expiry heap, stale rows skipped
+        self._version = 0
+        self._lock = threading.Lock()
+        self.stats = {"loads": 0, "added": 0, "updated": 0, "removed": 0, "expired": 0,
+                      "queries": 0, "tree_builds": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _cell_range(self, box: BBox):
+        c = self.cell_deg
+        return floor(box[0] / c), floor(box[1] / c), floor(box[2] / c), floor(box[3] / c)
+
+    # Index maintenance; callers hold the lock
+
+    def _add(self, entry: _Entry):
+        self._entries[entry.key] = entry
+        box = entry.extent
+        if box is None:
+            self._everywhere.add(entry.key)
+        else:
+            entry.cells = grid_cells(box, self.cell_deg)
+            if entry.cells is None:
+                self._everywhere.add(entry.key)
+            else:
+                for cell in entry.cells:
+                    self._cells.setdefault(cell, set()).add(entry.key)
+        for route in entry.routes:
+            self._by_route.setdefault(route, set()).add(entry.key)
+        if entry.end != FOREVER:
+            heapq.heappush(self._ends, (entry.end, entry.version, entry.key))
+        self._tree = None
+
+    def _remove(self, key: Tuple[str, str]) -> _Entry:
+        entry = self._entries.pop(key)
+        if entry.cells is None:
+            self._everywhere.discard(key)
+        else:
+            for cell in entry.cells:
+                members = self._cells[cell]
+                members.discard(key)
+                if not members:
+                    del self._cells[cell]
+        for route in entry.routes:
+            members = self._by_route[route]
+            members.discard(key)
+            if not members:
+                del self._by_route[route]
+        self._tree = None
+        return entry
+
+    def _expire(self, now: float) -> int:
+        n = 0
+        while self._ends and self._ends[0][0] < now:
+            _, version, key = heapq.heappop(self._ends)
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._remove(key)
+                n += 1
+        self.stats["expired"] += n
+        return n
+
+    def _publish(self):
+        if self.topic:
+            data_changed(self.topic)
+
+    def add_listener(self, fn: Callable[[List[Tuple[str, Dict[str, Any]]]], None]):
+        """Call `fn([(source, record), ...])` with the incidents each replace() added or changed"""
+        self._listeners.append(fn)
+
+    # Writers
+
+    def replace(self, source: str, records: List[Dict[str, Any]]) -> int:
+        """
+        Make `records` (each with an "id") the full set for `source`.
+        Records already over are dropped. Returns the number of incidents
+        added, changed or removed.
+        """
+        now = self.clock()
+        changed = 0
+        fresh: List[Tuple[str, Dict[str, Any]]] = []
+        with self._lock:
+            self.stats["loads"] += 1
+            seen = set()
+            for order, rec in enumerate(records):
+                key = (source, str(rec["id"]))
+                start = parse_time(rec.get("start_time"))
+                end = parse_time(rec.get("end_time"))
+                start = start if start is not None else -FOREVER
+                end = end if end is not None else FOREVER
+                if end < now or key in seen:
+                    continue
+                seen.add(key)
+                old = self._entries.get(key)
+                if old is not None:
+                    if old.record == rec:
+                        old.order = order
+                        continue
+                    self._remove(key)
+                self._version += 1
+                self._add(_Entry(key, rec, extent(rec), start, end, order, self._version))
+                fresh.append((source, rec))
+                self.stats["updated" if old is not None else "added"] += 1
+                changed += 1
+            gone = [k for k in self._entries if k[0] == source and k not in seen]
+            for key in gone:
+                self._remove(key)
+            self.stats["removed"] += len(gone)
+            changed += len(gone) + self._expire(now)
+        if changed:
+            self._publish()
+        if fresh:
+            for fn in list(self._listeners):
+                fn(fresh)
+        return changed
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Drop incidents whose end time has passed; cheap when nothing is due"""
+        now = self.clock() if now is None else now
+        if not self._ends or self._ends[0][0] >= now:
+            return 0
+        with self._lock:
+            n = self._expire(now)
+        if n:
+            self._publish()
+        return n
+
+    # Readers
+
+    def query(self, bbox: Optional[BBox] = None, start: Optional[float] = None, end: Optional[float] = None,
+              sources: Optional[Iterable[str]] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        (source, record) for incidents intersecting `bbox` and overlapping
+        [start, end] (default: from now on), by source then feed order.
+        """
+        now = self.clock()
+        self.expire(now)
+        start = now if start is None else start
+        end = FOREVER if end is None else end
+        wanted = set(sources) if sources is not None else None
+        with self._lock:
+            self.stats["queries"] += 1
+            if bbox is not None:
+                x0, y0, x1, y1 = self._cell_range(bbox)
+                if (x1 - x0 + 1) * (y1 - y0 + 1) > max(len(self._cells), 1):
+                    # Box bigger than the occupied area: walk the occupied cells instead
+                    keys = set().union(*(m for (x, y), m in self._cells.items()
+                                         if x0 <= x <= x1 and y0 <= y <= y1))
+                else:
+                    keys = set()
+                    for x in range(x0, x1 + 1):
+                        for y in range(y0, y1 + 1):
+                            members = self._cells.get((x, y))
+                            if members:
+                                keys |= members
+                keys |= self._everywhere
+                entries = [e for e in map(self._entries.__getitem__, keys)
+                           if e.start <= end and e.end >= start and _intersects(e.extent, bbox)]
+            else:
+                if self._tree is None:
+                    self._tree = IntervalTree((e.start, e.end, e) for e in self._entries.values())
+                    self.stats["tree_builds"] += 1
+                entries = self._tree.overlapping(start, end)
+        if wanted is not None:
+            entries = [e for e in entries if e.key[0] in wanted]
+        entries.sort(key=lambda e: (e.key[0], e.order))
+        return [(e.key[0], e.record) for e in entries]
+
+    def matching(self, routes: Iterable[str], cells: Iterable[Tuple[int, int]]) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        (source, record) for current incidents that list one of `routes`
+        (route_key form) or cover one of the grid `cells`. Region-wide
+        incidents only match by route.
+        """
+        self.expire()
+        with self._lock:
+            keys: Set[Tuple[str, str]] = set()
+            for route in routes:
+                members = self._by_route.get(route)
+                if members:
+                    keys |= members
+            for cell in cells:
+                members = self._cells.get(cell)
+                if members:
+                    keys |= members
+            entries = sorted(map(self._entries.__getitem__, keys), key=lambda e: (e.key[0], e.order))
+        return [(e.key[0], e.record) for e in entries]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            by_source: Dict[str, int] = {}
+            for source, _ in self._entries:
+                by_source[source] = by_source.get(source, 0) + 1
+            return {"incidents": len(self._entries), "by_source": by_source, "cells": len(self._cells),
+                    "routes": len(self._by_route), "region_wide": len(self._everywhere), **self.stats}
+
+
+incident_store = IncidentStore()
+
+
+# ---------- Feed ----------
+
+class IncidentFeed:
+    """
+    Polls each source (name -> callable returning its current records) into
+    the store. A source that fails keeps its previous records.
+    """
+
+    def __init__(self, sources: Dict[str, Callable[[], List[Dict[str, Any]]]],
+                 store: IncidentStore = incident_store, interval_s: float = INCIDENTS_INTERVAL_S):
+        self.sources = sources
+        self.store = store
+        self.interval_s = interval_s
+        self.loaded = False
+        self.last: Dict[str, Any] = {}
+        self.stats = {"polls": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _poll(self) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        changed = 0
+        for name, fetch in self.sources.items():
+            try:
+                changed += self.store.replace(name, fetch())
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Incident source {name} failed: {e}")
+        self.loaded = True
+        self.stats["polls"] += 1
+        self.last = {"changed": changed, "incidents": len(self.store),
+                     "ms": round((time.perf_counter() - t0) * 1000, 2), "at": int(time.time())}
+        return self.last
+
+    def poll(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._poll()
+
+    def ensure_current(self):
+        """Load synchronously if nothing has been polled yet, then expire what has ended"""
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self._poll()
+        self.store.expire()
+
+    def start(self):
+        """Poll every interval_s in a daemon thread (the first request loads if this hasn't yet)"""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                self.poll()
+                time.sleep(self.interval_s)
+
+        self._thread = threading.Thread(target=loop, name="incidents", daemon=True)
+        self._thread.start()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "last_poll": self.last}
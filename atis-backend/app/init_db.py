@@ -1,23 +1,26 @@
-import sqlite3, os
-DB_PATH = os.path.join(os.path.dirname(__file__), "atis.db")
+import os, sys
+if __package__ in (None, ""):
+    # Allow `python app/init_db.py` as well as `python -m app.init_db`
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = "app"
+from .db import DB_PATH
+from .gtfs import import_feed
+from .footpaths import update_footpaths
 
-STOPS = [
-    ("1001", "Britomart Station", -36.8443, 174.7676),
-    ("1002", "Wellesley St East (Uni)", -36.8524, 174.7692),
-    ("1003", "SkyCity (Victoria St)", -36.8484, 174.7618),
-    ("1004", "Aotea Square", -36.8520, 174.7633),
-    ("1005", "Albany Station", -36.7223, 174.7079),
-]
+# Small Auckland feed shipped with the repo; pass a GTFS zip to load a real one
+SAMPLE_FEED = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "sample_gtfs")
 
-def main():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("DROP TABLE IF EXISTS stops")
-    cur.execute("CREATE TABLE stops (stop_id TEXT PRIMARY KEY, name TEXT, lat REAL, lon REAL)")
-    cur.executemany("INSERT INTO stops (stop_id, name, lat, lon) VALUES (?, ?, ?, ?)", STOPS)
-    con.commit()
-    con.close()
-    print(f"Initialized DB at {DB_PATH} with {len(STOPS)} stops.")
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    feed = argv[0] if argv else os.getenv("GTFS_FEED", SAMPLE_FEED)
+    db_path = argv[1] if len(argv) > 1 else DB_PATH
+    print(f"Loading GTFS feed {feed}")
+    report = import_feed(feed, db_path)
+    print(f"Initialized DB at {db_path} with {report['tables']['stops']['rows']} stops.")
+    graph = update_footpaths(db_path)
+    info = graph.stats()
+    print(f"Footpath graph: {info['edges']:,} walking transfers within {info['radius_m']:.0f} m "
+          f"({info['mode']}, {info['rows_rebuilt']:,} stops recomputed in {info['seconds']:.2f} s) -> {info['file']}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,238 @@
+"""
+Isochrones for ATIS
+"How far can I get in N minutes from here": one one-to-all RAPTOR search
+from the origin over the /plan timetable and footpath graph, then a walk
+from every reached stop (and from the origin itself) rasterised onto a
+metric grid. Each time band's reachable cells are traced into a GeoJSON
+MultiPolygon.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from collections import defaultdict
+from math import cos, radians
+import os
+
+import numpy as np
+
+from .cache import TTLCache, snap, time_bucket
+from .footpaths import WALK_DETOUR, WALK_SPEED_MPS
+from .realtime import overlay
+from .routing import INF, get_timetable, local_now, parse_when
+from .spatial import METERS_PER_DEG_LAT
+
+ISOCHRONE_BANDS = (10, 20, 30, 45)
+MAX_BAND_MIN = 90
+MAX_WALK_KM = 3.0
+ISOCHRONE_CELL_M = float(os.getenv("ATIS_ISOCHRONE_CELL_M", "100"))
+
+isochrone_cache = TTLCache("isochrone", max_entries=int(os.getenv("ATIS_ISOCHRONE_CACHE_SIZE", "512")),
+                           ttl_s=float(os.getenv("ATIS_ISOCHRONE_CACHE_TTL", "120")),
+                           topics=("feed", "realtime"))
+ISOCHRONE_CACHE_GRID_DEG = 0.001   # ~100 m origin cells
+ISOCHRONE_CACHE_BUCKET_S = 60
+STAMP_CELLS = 1 << 20              # grid cells stamped per batch of seeds
+
+
+def isochrone(origin: Sequence[float], depart_at: Optional[str] = "now",
+              bands: Sequence[int] = ISOCHRONE_BANDS, modes: Optional[List[str]] = None,
+              max_walk_km: float = 1.2) -> Dict[str, Any]:
+    """Cached per origin cell, departure minute and options"""
+    when = parse_when(depart_at) or local_now()
+    bands = tuple(sorted(set(int(b) for b in bands)))
+    key = (snap(origin[0], origin[1], ISOCHRONE_CACHE_GRID_DEG),
+           time_bucket(when, ISOCHRONE_CACHE_BUCKET_S), bands,
+           tuple(sorted(modes or ())), max_walk_km)
+    return isochrone_cache.get_or_compute(
+        key, lambda: compute_isochrone(origin, when, bands, modes, max_walk_km))
+
+
+def compute_isochrone(origin: Sequence[float], when, bands: Sequence[int],
+                      modes: Optional[List[str]] = None, max_walk_km: float = 1.2) -> Dict[str, Any]:
+    tt = get_timetable()
+    lat0, lng0 = float(origin[0]), float(origin[1])
+    max_s = max(bands) * 60
+    max_walk_m = (1.2 if max_walk_km is None else max_walk_km) * 1000 / WALK_DETOUR
+    day_start = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    depart = int((when - day_start).total_seconds())
+
+    # Transit: earliest arrival at every stop
+    stops: List[Dict[str, Any]] = []
+    seeds: List[Tuple[float, float, float]] = [(lat0, lng0, 0.0)]   # (lat, lng, elapsed s)
+    access = tt.nearby(lat0, lng0, max_walk_m) if tt.pat_stops else []
+    if access:
+        transit_modes = [m for m in (modes or []) if m not in ("walk", "bike")] or None
+        label = tt.reach_times(access, depart, overlay.running(tt.active_trips(when.date())), max_s,
+                               modes=transit_modes, max_walk_m=max_walk_m)
+        for s, t in enumerate(label):
+            if t == INF or t - depart > max_s:
+                continue
+            elapsed = t - depart
+            seeds.append((tt.stop_lats[s], tt.stop_lons[s], elapsed))
+            stops.append({"stop_id": tt.stop_ids[s], "name": tt.stop_names[s],
+                          "lat": tt.stop_lats[s], "lng": tt.stop_lons[s],
+                          "minutes": round(elapsed / 60, 1)})
+        stops.sort(key=lambda r: r["minutes"])
+
+    grid, x0, y0 = _time_grid(seeds, lat0, lng0, max_s, max_walk_m, ISOCHRONE_CELL_M)
+    to_lnglat = _unprojector(lat0, lng0, x0, y0, ISOCHRONE_CELL_M)
+    features = []
+    for band in bands:
+        polygons = trace_polygons(grid <= band * 60)
+        features.append({
+            "type": "Feature",
+            "properties": {"minutes": band},
+            "geometry": {"type": "MultiPolygon",
+                         "coordinates": [[[to_lnglat(x, y) for x, y in ring] for ring in poly]
+                                         for poly in polygons]},
+        })
+    return {
+        "origin": [lat0, lng0],
+        "departure": when.isoformat(),
+        "bands": list(bands),
+        "stops": stops,
+        "polygons": {"type": "FeatureCollection", "features": features},
+    }
+
+
+# ---------- Rasterising ----------
+
+def _time_grid(seeds, lat0: float, lng0: float, max_s: float, max_walk_m: float,
+               cell_m: float) -> Tuple[np.ndarray, float, float]:
+    """
+    Seconds to reach each grid cell centre: min over seeds of elapsed time
+    plus a walk of at most max_walk_m. Coordinates are metres east/north of
+    the origin; returns the grid (rows = north) and its lower-left corner.
+    """
+    kx = METERS_PER_DEG_LAT * cos(radians(lat0))
+    pts = np.asarray(seeds, dtype=np.float64)
+    xs = (pts[:, 1] - lng0) * kx
+    ys = (pts[:, 0] - lat0) * METERS_PER_DEG_LAT
+    elapsed = pts[:, 2]
+    secs_per_m = WALK_DETOUR / WALK_SPEED_MPS
+    reach = np.minimum(max_walk_m, (max_s - elapsed) / secs_per_m)
+
+    x0 = float((xs - reach).min()) - cell_m
+    y0 = float((ys - reach).min()) - cell_m
+    cols = int((float((xs + reach).max()) - x0) / cell_m) + 2
+    rows = int((float((ys + reach).max()) - y0) / cell_m) + 2
+    grid = np.full(rows * cols, np.inf)
+
+    # Each seed stamps a square window sized by its own reach; seeds with
+    # the same window go together, a bounded number of cells at a time
+    ci = np.floor((xs - x0) / cell_m).astype(np.int64)
+    ri = np.floor((ys - y0) / cell_m).astype(np.int64)
+    ws = (reach / cell_m).astype(np.int64) + 1
+    for w in np.unique(ws):
+        idx = np.nonzero(ws == w)[0]
+        offs = np.arange(-w, w + 1)
+        step = max(1, STAMP_CELLS // len(offs) ** 2)
+        for i in range(0, len(idx), step):
+            k = idx[i:i + step]
+            c = ci[k, None, None] + offs[None, None, :]
+            r = ri[k, None, None] + offs[None, :, None]
+            dist = np.hypot(x0 + (c + 0.5) * cell_m - xs[k, None, None],
+                            y0 + (r + 0.5) * cell_m - ys[k, None, None])
+            ok = (dist <= reach[k, None, None]) & (r >= 0) & (r < rows) & (c >= 0) & (c < cols)
+            np.minimum.at(grid, (r * cols + c)[ok], (elapsed[k, None, None] + dist * secs_per_m)[ok])
+    return grid.reshape(rows, cols), x0, y0
+
+
+def _unprojector(lat0: float, lng0: float, x0: float, y0: float, cell_m: float):
+    kx = METERS_PER_DEG_LAT * cos(radians(lat0))
+
+    def to_lnglat(x: int, y: int) -> List[float]:
+        return [round(lng0 + (x0 + x * cell_m) / kx, 6),
+                round(lat0 + (y0 + y * cell_m) / METERS_PER_DEG_LAT, 6)]
+    return to_lnglat
+
+
+# ---------- Outlines ----------
+
+def trace_polygons(mask: np.ndarray) -> List[List[List[Tuple[int, int]]]]:
+    """
+    Outline the True cells of `mask` (row 0 = south) as polygons of grid
+    corner coordinates (x = column, y = row): [[outer ring, hole, ...], ...],
+    outer rings counter-clockwise, holes clockwise, rings closed.
+    """
+    if not mask.any():
+        return []
+    m = np.pad(mask, 1)
+    inner = m[1:-1, 1:-1]
+    # Boundary edges, directed with the inside on the left
+    edges: Dict[Tuple[int, int], List[Tuple[int, int]]] = defaultdict(list)
+    for dr, dc, start, end in ((-1, 0, (0, 0), (1, 0)),    # south side
+                               (0, 1, (1, 0), (1, 1)),     # east side
+                               (1, 0, (1, 1), (0, 1)),     # north side
+                               (0, -1, (0, 1), (0, 0))):   # west side
+        side = inner & ~m[1 + dr:m.shape[0] - 1 + dr, 1 + dc:m.shape[1] - 1 + dc]
+        for r, c in zip(*np.nonzero(side)):
+            edges[(int(c) + start[0], int(r) + start[1])].append((int(c) + end[0], int(r) + end[1]))
+
+    rings = []
+    while edges:
+        # Start where the path is unambiguous so the ring closes on its own edge
+        first = next((v for v, out in edges.items() if len(out) == 1), next(iter(edges)))
+        ring = [first]
+        at = first
+        while True:
+            out = edges[at]
+            nxt = out.pop() if len(out) == 1 else _left_turn(ring[-2] if len(ring) > 1 else None, at, out)
+            if not out:
+                del edges[at]
+            if nxt == first:
+                break
+            ring.append(nxt)
+            at = nxt
+        ring = _drop_collinear(ring)
+        ring.append(ring[0])
+        rings.append(ring)
+
+    outers = [r for r in rings if _area(r) > 0]
+    polygons = [[r] for r in outers]
+    for hole in (r for r in rings if _area(r) < 0):
+        (ax, ay), (bx, by) = hole[0], hole[1]
+        # Centre of the filled cell to the left of the hole's first edge
+        probe = ((ax + bx) / 2 - (by - ay) / max(abs(by - ay), abs(bx - ax)) * 0.5,
+                 (ay + by) / 2 + (bx - ax) / max(abs(by - ay), abs(bx - ax)) * 0.5)
+        owners = [p for p in polygons if _contains(p[0], probe)]
+        if owners:
+            min(owners, key=lambda p: _area(p[0])).append(hole)
+    return polygons
+
+
+def _left_turn(prev, at, out: List[Tuple[int, int]]) -> Tuple[int, int]:
+    """
+    At a vertex shared by two diagonal cells, follow the left turn so each
+    ring hugs its own cell and rings never cross
+    """
+    if prev is None:
+        return out.pop()
+    dx, dy = at[0] - prev[0], at[1] - prev[1]
+    for i, (x, y) in enumerate(out):
+        if dx * (y - at[1]) - dy * (x - at[0]) > 0:
+            return out.pop(i)
+    return out.pop()
+
+
+def _drop_collinear(ring: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    out = []
+    n = len(ring)
+    for i in range(n):
+        (ax, ay), (bx, by), (cx, cy) = ring[i - 1], ring[i], ring[(i + 1) % n]
+        if (bx - ax) * (cy - by) != (by - ay) * (cx - bx):
+            out.append(ring[i])
+    return out
+
+
+def _area(ring: List[Tuple[int, int]]) -> float:
+    """Signed area (shoelace); positive for counter-clockwise"""
+    return sum(ax * by - bx * ay for (ax, ay), (bx, by) in zip(ring, ring[1:])) / 2
+
+
+def _contains(ring: List[Tuple[int, int]], pt: Tuple[float, float]) -> bool:
+    x, y = pt
+    inside = False
+    for (ax, ay), (bx, by) in zip(ring, ring[1:]):
+        if (ay > y) != (by > y) and x < ax + (y - ay) * (bx - ax) / (by - ay):
+            inside = not inside
+    return inside
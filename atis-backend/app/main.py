@@ -1,22 +1,38 @@
-from fastapi import FastAPI, Response, Header, HTTPException, Depends
+from fastapi import FastAPI, Request, Response, Header, HTTPException, Depends, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Literal, Dict
-import time, io, os, json
+from concurrent.futures import Future, TimeoutError as StepTimeout
+import time, io, os, json, sqlite3, threading, asyncio
 
 from .pdf import itinerary_pdf
-from .providers import Providers
-from .store import (nearby_stops, sample_departures, sample_itineraries,
-                    sample_weather, sample_traffic, suggest_reroute, sample_alerts)
+from .providers import Providers, ProviderUnavailable, provider_stats
+from .spatial import get_stop_index
+from .routing import get_timetable, parse_when, local_now, apply_realtime, LOCAL_TZ
+from .realtime import departure_board, start_realtime, realtime_stats
+from .matrix import stream_matrix, MAX_MATRIX_PAIRS
+from .isochrone import isochrone, ISOCHRONE_BANDS, MAX_BAND_MIN, MAX_WALK_KM
+from .db import pool_stats
+from .push import hub, parse_subscription
+from .incidents import IncidentFeed, incident_store, parse_bbox, parse_time
+from .reroute import WatchList, affecting, itinerary_routes, itinerary_cells, suggest_reroute
+from .cache import TTLCache, StaleCache, cache_stats, data_changed, snap, time_bucket
+from .encoding import EncodingMiddleware, JSON, dumps, json_response
+from .http_cache import Representation, conditional, conditional_stats, STATIC, REVALIDATE
+from .store import (nearby_stops, nearby_stops_batch, sample_departures, plan_itineraries,
+                    sample_weather, weather_alert, sample_traffic, sample_alerts)
 from .auth import (register_user, verify_user, issue_token, decode_token,
                    is_mfa_enabled, verify_mfa_code, generate_qr_code, 
-                   enable_mfa, disable_mfa, get_mfa_secret)
+                   enable_mfa, disable_mfa, get_mfa_secret, revoke_token, revoke_user_tokens,
+                   token_cache)
 from .environmental import (calculate_itinerary_emissions, compare_modal_emissions, 
                             calculate_cumulative_impact)
 from .mcda import MCDAScorer, create_comparison_chart_data, customize_weights_for_profile
 from .analytics import get_analytics
+from .passwords import hash_pool, HashPoolBusy
 
-app = FastAPI(title="ATIS Demo API", version="0.8.0")
+app = FastAPI(title="ATIS Demo API", version="0.8.0", default_response_class=ORJSONResponse)
 
 # CORS configuration - supports environment variables for production
 cors_origins = os.getenv("CORS_ORIGINS", "*").split(",") if os.getenv("CORS_ORIGINS") else ["*"]
@@ -27,29 +43,76 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# msgpack for clients that ask for it, brotli/gzip above a size threshold
+app.add_middleware(EncodingMiddleware)
 
-def require_auth(authorization: Optional[str] = Header(None)) -> str:
+def _bearer(authorization: Optional[str]) -> str:
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing token")
-    token = authorization.split(" ", 1)[1].strip()
-    data = decode_token(token)
+    return authorization.split(" ", 1)[1].strip()
+
+def require_auth(authorization: Optional[str] = Header(None)) -> str:
+    # Cached by token digest after the first full verification (see tokens.py)
+    data = decode_token(_bearer(authorization))
     if not data:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return data["sub"]
 
+@app.on_event("startup")
+def warm_indexes():
+    # Build the stop grid once up front instead of on the first /stops/nearby
+    try:
+        get_stop_index()
+    except sqlite3.Error as e:
+        print(f"Stop index not built (run init_db first?): {e}")
+        return
+    # The timetable takes a few seconds on a city feed; load it off the startup path
+    threading.Thread(target=_warm_timetable, daemon=True).start()
+    # GTFS-Realtime trip updates, if ATIS_GTFS_RT_PATH is set
+    start_realtime(get_timetable, tz=LOCAL_TZ)
+    incident_feed.start()
+
+def _warm_timetable():
+    try:
+        get_timetable()
+    except sqlite3.Error as e:
+        print(f"Timetable not loaded: {e}")
+
+@app.exception_handler(ProviderUnavailable)
+def provider_unavailable(request, exc: ProviderUnavailable):
+    # Upstream down and nothing cached to fall back on
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "30"})
+
+@app.exception_handler(HashPoolBusy)
+def hash_pool_busy(request, exc: HashPoolBusy):
+    # Login storm: shed load instead of queueing without bound
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after_s)})
+
 @app.get("/health")
 def health():
     return {"status": "ok", "ts": int(time.time())}
 
+@app.get("/metrics")
+def metrics():
+    """Internal counters for tuning (pool checkouts, waits, cache hits, ...)"""
+    return {"db_pool": pool_stats(), "caches": cache_stats(), "conditional": conditional_stats(),
+            "push": hub.snapshot(),
+            "realtime": realtime_stats(), "providers": provider_stats(),
+            "incidents": {**incident_store.snapshot(), "feed": incident_feed.snapshot()},
+            "watches": watches.snapshot(), "tokens": token_cache.snapshot(), "passwords": hash_pool.snapshot(),
+            "analytics_log": get_analytics().log.snapshot()}
+
 # ---------- Auth ----------
 class AuthReq(BaseModel):
     username: str
     password: str
     mfa_code: Optional[str] = None
 
+# Register and login are async so bcrypt waits on the hashing pool, not in a request thread
 @app.post("/auth/register")
-def auth_register(req: AuthReq):
-    ok = register_user(req.username, req.password)
+async def auth_register(req: AuthReq):
+    ok = await hash_pool.run(register_user, req.username, req.password)
     if not ok:
         raise HTTPException(400, "Username already exists")
     token = issue_token(req.username)
@@ -61,9 +124,9 @@ def auth_register(req: AuthReq):
     }
 
 @app.post("/auth/login")
-def auth_login(req: AuthReq):
-    # First verify username and password
-    if not verify_user(req.username, req.password):
+async def auth_login(req: AuthReq):
+    # First verify username and password (the user record is cached for the checks below)
+    if not await hash_pool.run(verify_user, req.username, req.password):
         raise HTTPException(401, "Invalid credentials")
     
     # Check if MFA is enabled
@@ -84,6 +147,13 @@ def auth_login(req: AuthReq):
         "mfa_enabled": is_mfa_enabled(req.username)
     }
 
+@app.post("/auth/logout")
+def auth_logout(authorization: Optional[str] = Header(None)):
+    """Revoke the presented token"""
+    if not revoke_token(_bearer(authorization)):
+        raise HTTPException(401, "Invalid or expired token")
+    return {"success": True}
+
 @app.post("/auth/verify")
 def auth_verify(authorization: str = Header(None)):
     """Verify if a token is valid"""
@@ -145,8 +215,11 @@ def mfa_disable(req: MFAVerifyReq, user: str = Depends(require_auth)):
         raise HTTPException(400, "Invalid MFA code. Cannot disable MFA.")
     
     disable_mfa(user)
+    # Sessions that may have been opened with the second factor end here; this one continues on a new token
+    revoke_user_tokens(user)
     return {
         "success": True,
+        "token": issue_token(user),
         "message": "MFA disabled successfully"
     }
 
@@ -159,15 +232,64 @@ def mfa_status(user: str = Depends(require_auth)):
     }
 
 # ---------- Stops & Departures ----------
+# Open panels re-ask for the same point; answers only change with the feed
+stops_nearby_cache = TTLCache("stops_nearby", max_entries=int(os.getenv("ATIS_STOPS_NEARBY_CACHE_SIZE", "4096")),
+                              ttl_s=float(os.getenv("ATIS_STOPS_NEARBY_CACHE_TTL", "3600")), topics=("feed",))
+
 @app.get("/stops/nearby")
-def stops_nearby(lat: float, lng: float, radius: float = 900, user: str = Depends(require_auth)):
-    return {"stops": nearby_stops(lat, lng, radius)}
+def stops_nearby(request: Request, lat: float, lng: float, radius: Optional[float] = None,
+                 k: Optional[int] = None, user: str = Depends(require_auth)):
+    # k-nearest mode is uncapped unless a radius is given explicitly
+    if radius is None and not k:
+        radius = 900
+    rep = stops_nearby_cache.get_or_compute(
+        (lat, lng, radius, k),
+        lambda: Representation.of({"stops": nearby_stops(lat, lng, radius, k=k)}, "private, max-age=300"))
+    return conditional(request, rep)
+
+MAX_BATCH_POINTS = 500
+
+class NearbyBatchRequest(BaseModel):
+    points: List[List[float]]
+    radius: Optional[float] = None
+    k: Optional[int] = None
+
+@app.post("/stops/nearby/batch")
+def stops_nearby_batch(req: NearbyBatchRequest, user: str = Depends(require_auth)):
+    if len(req.points) > MAX_BATCH_POINTS:
+        raise HTTPException(400, f"At most {MAX_BATCH_POINTS} points per batch")
+    if any(len(p) != 2 for p in req.points):
+        raise HTTPException(400, "Each point must be [lat, lng]")
+    radius = req.radius
+    if radius is None and not req.k:
+        radius = 900
+    results = nearby_stops_batch(req.points, radius, k=req.k)
+    return {"results": [{"point": p, "stops": s} for p, s in zip(req.points, results)]}
+
+# Every open stop panel polls its board; share one upstream fetch per stop.
+# Boards are fresh for the TTL, then served stale while one refresh runs.
+departures_cache = StaleCache("departures", max_entries=int(os.getenv("ATIS_DEPARTURES_CACHE_SIZE", "2000")),
+                              ttl_s=float(os.getenv("ATIS_DEPARTURES_CACHE_TTL", "15")),
+                              stale_s=float(os.getenv("ATIS_DEPARTURES_CACHE_STALE", "30")),
+                              topics=("feed", "realtime"))
+
+def _fetch_board(stop_id: str):
+    prov = Providers()
+    if prov.USE_REAL:
+        return prov.departures(stop_id)
+    try:
+        tt = get_timetable()
+    except sqlite3.Error:
+        tt = None
+    if tt is not None and stop_id in tt.stop_pos:
+        # Scheduled departures with GTFS-Realtime delays applied
+        return departure_board(tt, stop_id, local_now())
+    return sample_departures(stop_id)
 
 @app.get("/departures")
 def departures(stop_id: str, user: str = Depends(require_auth)):
-    prov = Providers()
-    data = prov.departures(stop_id) if prov.USE_REAL else sample_departures(stop_id)
-    return {"stop_id": stop_id, "departures": data}
+    data = departures_cache.get_or_compute(stop_id, lambda: _fetch_board(stop_id))
+    return json_response({"stop_id": stop_id, "departures": data})
 
 # ---------- Plan & Reroute ----------
 class PlanRequest(BaseModel):
@@ -181,16 +303,35 @@ class PlanRequest(BaseModel):
     bike_ok: Optional[bool] = False
     modes: Optional[List[Literal["bus","train","ferry","walk","bike"]]] = ["bus","train","walk"]
 
-@app.post("/plan")
-def plan(req: PlanRequest, user: str = Depends(require_auth)):
-    itins = sample_itineraries(
+# Plan results are shared by requests whose endpoints fall in the same
+# ~100 m cell, with the same options and departure minute
+PLAN_CACHE_GRID_DEG = float(os.getenv("ATIS_PLAN_CACHE_GRID_DEG", "0.001"))
+PLAN_CACHE_BUCKET_S = int(os.getenv("ATIS_PLAN_CACHE_BUCKET_S", "60"))
+plan_cache = TTLCache("plan", max_entries=int(os.getenv("ATIS_PLAN_CACHE_SIZE", "2048")),
+                      ttl_s=float(os.getenv("ATIS_PLAN_CACHE_TTL", "60")),
+                      topics=("feed", "incidents", "realtime"))
+
+def _plan_key(req: PlanRequest):
+    when = parse_when(req.arrive_by or req.depart_at) or parse_when("now")
+    return (snap(req.origin[0], req.origin[1], PLAN_CACHE_GRID_DEG),
+            snap(req.destination[0], req.destination[1], PLAN_CACHE_GRID_DEG),
+            bool(req.arrive_by), time_bucket(when, PLAN_CACHE_BUCKET_S),
+            req.optimize, req.max_walk_km, req.avoid_stairs, req.bike_ok,
+            tuple(sorted(req.modes or ())))
+
+def _plan_pipeline(req: PlanRequest):
+    # Scheduled times; realtime delays go on per request, after the cache
+    itins = plan_itineraries(
         req.origin, req.destination,
+        depart_at=req.depart_at,
+        arrive_by=req.arrive_by,
         prefers_fewer_transfers=(req.optimize=="fewest_transfers"),
         optimize=req.optimize,
         max_walk_km=req.max_walk_km,
         avoid_stairs=req.avoid_stairs,
         bike_ok=req.bike_ok,
-        modes=req.modes
+        modes=req.modes,
+        realtime=False
     )
     
     # Add environmental calculations
@@ -200,12 +341,177 @@ def plan(req: PlanRequest, user: str = Depends(require_auth)):
     # Add MCDA scoring
     mcda = MCDAScorer()
     scored_itins = mcda.score_all_itineraries(itins)
-    
-    return {
-        "itineraries": scored_itins, 
-        "context": {"weatherAlert": sample_weather(req.origin)},
-        "mcda_chart_data": create_comparison_chart_data(scored_itins)
+    return {"itineraries": scored_itins,
+            "mcda_chart_data": create_comparison_chart_data(scored_itins)}
+
+# Weather and incidents are fetched while routing runs; whatever isn't done
+# (realtime delays included) when the budget runs out is left out of the
+# response instead of waited for
+PLAN_BUDGET_S = float(os.getenv("ATIS_PLAN_BUDGET_MS", "800")) / 1000
+
+def _ready(value) -> Future:
+    f = Future()
+    f.set_result(value)
+    return f
+
+def _plan_weather(origin: List[float]) -> Future:
+    tile = weather_tile(origin[0], origin[1])
+    prov = Providers()
+    if weather_cache.get(tile) is not None or not prov.USE_REAL:
+        # Fresh or stale (refreshed in the background): no upstream wait
+        return _ready(_weather_forecast(origin[0], origin[1]))
+    # Cold tile: fetch under the plan's deadline, and keep the answer even if the plan gave up on it
+    f = prov.start_weather(*_tile_centre(tile))
+    def keep(done: Future):
+        # Runs on the provider loop: must not wait on a /weather/point fetch of the same tile
+        if not done.cancelled() and done.exception() is None:
+            weather_cache.offer(tile, done.result())
+    f.add_done_callback(keep)
+    return f
+
+def _plan_incidents(origin: List[float], destination: List[float]) -> Future:
+    """Incidents in the box around both endpoints (~1 km margin)"""
+    lats, lngs = (origin[0], destination[0]), (origin[1], destination[1])
+    box = (min(lngs) - 0.01, min(lats) - 0.01, max(lngs) + 0.01, max(lats) + 0.01)
+    prov = Providers()
+    if prov.USE_REAL and not incident_feed.loaded:
+        # Store not filled yet: ask NZTA directly, under the plan's deadline
+        return prov.start_incidents(",".join(f"{v:.4f}" for v in box))
+    incident_feed.ensure_current()
+    return _ready([rec for _, rec in incident_store.query(box, sources=("traffic",))])
+
+def _with_affected(incidents: List[dict], itineraries: List[dict]) -> List[dict]:
+    """Tag each incident with the ids of itineraries riding one of its routes"""
+    routes = {i.get("id"): {d.get("route") for d in i.get("leg_details", ()) if d.get("route")}
+              for i in itineraries}
+    return [{**inc, "affects": [iid for iid, rs in routes.items()
+                                if rs.intersection(inc.get("affected_routes") or ())]}
+            for inc in incidents]
+
+def _compact_plan(payload: dict) -> dict:
+    """Drop what the client can rebuild: MCDA weights repeated per itinerary (sent once) and chart data"""
+    itins = payload["itineraries"]
+    return {"itineraries": [{k: v for k, v in i.items() if k != "mcda_weights"} for i in itins],
+            "mcda_weights": itins[0].get("mcda_weights") if itins else None,
+            "context": payload["context"]}
+
+@app.post("/plan")
+def plan(req: PlanRequest, compact: bool = False, user: str = Depends(require_auth)):
+    started = time.perf_counter()
+    deadline = started + PLAN_BUDGET_S
+    timings: Dict[str, float] = {}
+
+    def timed(step, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            timings[step] = time.perf_counter() - t0
+
+    def finished(step, future):
+        if not future.cancelled():
+            timings[step] = time.perf_counter() - started
+
+    # Upstream requests run on the provider loop, so no thread waits on them
+    steps = {"weather": _plan_weather(req.origin), "incidents": _plan_incidents(req.origin, req.destination)}
+    for step, future in steps.items():
+        future.add_done_callback(lambda f, step=step: finished(step, f))
+    try:
+        # Routing is the answer itself, so it is the one step never cut short
+        result = timed("route", plan_cache.get_or_compute, _plan_key(req), lambda: _plan_pipeline(req))
+    except ValueError:
+        for f in steps.values():
+            f.cancel()
+        raise HTTPException(400, "Invalid depart_at/arrive_by time")
+
+    itineraries, omitted = result["itineraries"], []
+    if time.perf_counter() < deadline:
+        itineraries = timed("realtime", apply_realtime, itineraries)
+    else:
+        omitted.append("realtime")
+    context = {}
+    for step, future in steps.items():
+        try:
+            value = future.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except StepTimeout:
+            future.cancel()    # frees the upstream slot too
+            omitted.append(step)
+            continue
+        except ProviderUnavailable:
+            omitted.append(step)
+            continue
+        if step == "weather":
+            context["weatherAlert"] = weather_alert(value)
+        else:
+            context["incidents"] = _with_affected(value, itineraries)
+    context["omitted"] = omitted
+
+    payload = {
+        "itineraries": itineraries,
+        "context": context,
+        "mcda_chart_data": result["mcda_chart_data"]
     }
+    body = timed("encode", dumps, _compact_plan(payload) if compact else payload)
+
+    # Per-step breakdown for debugging slow plans (browser devtools show it)
+    timings["total"] = time.perf_counter() - started
+    server_timing = ", ".join([f"{k};dur={v * 1000:.1f}" for k, v in list(timings.items())] +
+                              [f'{k};desc="omitted"' for k in omitted])
+    return Response(body, media_type=JSON, headers={"Server-Timing": server_timing})
+
+class MatrixRequest(BaseModel):
+    origins: List[List[float]]
+    destinations: List[List[float]]
+    depart_at: Optional[str] = "now"
+    arrive_by: Optional[str] = None
+    optimize: Optional[Literal["fastest","fewest_transfers","least_walking","reliable"]] = "fastest"
+    max_walk_km: Optional[float] = 1.2
+    modes: Optional[List[Literal["bus","train","ferry","walk","bike"]]] = ["bus","train","walk"]
+
+@app.post("/plan/matrix")
+def plan_matrix(req: MatrixRequest, user: str = Depends(require_auth)):
+    """Every origin x destination pair, streamed as NDJSON rows as they finish"""
+    if not req.origins or not req.destinations:
+        raise HTTPException(400, "Need at least one origin and one destination")
+    if len(req.origins) * len(req.destinations) > MAX_MATRIX_PAIRS:
+        raise HTTPException(400, f"At most {MAX_MATRIX_PAIRS} origin/destination pairs per matrix")
+    if any(len(p) != 2 for p in req.origins + req.destinations):
+        raise HTTPException(400, "Each point must be [lat, lng]")
+    try:
+        parse_when(req.arrive_by or req.depart_at)
+    except ValueError:
+        raise HTTPException(400, "Invalid depart_at/arrive_by time")
+    try:
+        get_timetable()
+    except sqlite3.Error:
+        raise HTTPException(503, "No GTFS feed loaded")
+
+    params = {"depart_at": req.depart_at, "arrive_by": req.arrive_by, "optimize": req.optimize,
+              "max_walk_km": req.max_walk_km, "modes": req.modes}
+    rows = stream_matrix(req.origins, req.destinations, params)
+    return StreamingResponse((dumps(row) + b"\n" for row in rows),
+                             media_type="application/x-ndjson")
+
+@app.get("/isochrone")
+def get_isochrone(lat: float, lng: float, depart_at: Optional[str] = "now",
+                  bands: Optional[str] = None, max_walk_km: float = 1.2,
+                  modes: Optional[str] = None, user: str = Depends(require_auth)):
+    """Stops and areas reachable from a point within each time band (minutes, e.g. 10,20,30,45)"""
+    try:
+        band_list = [int(b) for b in bands.split(",")] if bands else list(ISOCHRONE_BANDS)
+    except ValueError:
+        raise HTTPException(400, "bands must be comma-separated minutes")
+    if not band_list or any(b <= 0 or b > MAX_BAND_MIN for b in band_list):
+        raise HTTPException(400, f"Each band must be between 1 and {MAX_BAND_MIN} minutes")
+    if not 0 <= max_walk_km <= MAX_WALK_KM:
+        raise HTTPException(400, f"max_walk_km must be between 0 and {MAX_WALK_KM:g}")
+    mode_list = [m for m in modes.split(",") if m] if modes else None
+    try:
+        return json_response(isochrone((lat, lng), depart_at, band_list, mode_list, max_walk_km))
+    except ValueError:
+        raise HTTPException(400, "Invalid depart_at time")
+    except sqlite3.Error:
+        raise HTTPException(503, "No GTFS feed loaded")
 
 class RerouteRequest(BaseModel):
     current_itinerary: dict
@@ -214,11 +520,31 @@ class RerouteRequest(BaseModel):
     destination: Optional[List[float]] = None
     preferences: Optional[dict] = {}
 
+def _stop_coords(stop_id: Optional[str]):
+    """(lat, lng) of a GTFS stop, for placing an itinerary's road legs on the incident grid"""
+    try:
+        tt = get_timetable()
+    except sqlite3.Error:
+        return None
+    i = tt.stop_pos.get(stop_id) if stop_id else None
+    return (tt.stop_lats[i], tt.stop_lons[i]) if i is not None else None
+
+# Saved and active itineraries; new or changed incidents re-check only the
+# ones sharing a route or road cell and push a "reroute" event to the owner
+watches = WatchList(coords=_stop_coords, notify=hub.notify_user)
+incident_store.add_listener(watches.on_incidents)
+
 @app.post("/routes/suggest")
 def routes_suggest(req: RerouteRequest, user: str = Depends(require_auth)):
-    prov = Providers()
-    incidents = prov.incidents() if prov.USE_REAL else (req.incidents or [])
-    alternative = suggest_reroute(req.current_itinerary, incidents)
+    itin = req.current_itinerary
+    if Providers().USE_REAL:
+        incident_feed.ensure_current()
+        incidents = [rec for _, rec in incident_store.matching(itinerary_routes(itin),
+                                                               itinerary_cells(itin, _stop_coords))]
+    else:
+        # Client-supplied incidents: keep the ones on this itinerary's routes or roads
+        incidents = affecting(itin, req.incidents or [], _stop_coords)
+    alternative = suggest_reroute(req.current_itinerary, incidents, _stop_coords, req.origin, req.destination)
     
     # Enhance with detailed comparison and recommendations
     current_duration = req.current_itinerary.get('duration', 0)
@@ -273,30 +599,237 @@ def routes_suggest(req: RerouteRequest, user: str = Depends(require_auth)):
         "alternative": alternative,
         "reason": reason,
         "benefits": benefits,
-        "warnings": warnings
+        "warnings": warnings,
+        "incidents": [i.get("id") for i in incidents]
     }
 
+class WatchRequest(BaseModel):
+    itinerary: dict
+    id: Optional[str] = None
+    saved: Optional[bool] = False
+
+@app.post("/itineraries/watch")
+def watch_itinerary(req: WatchRequest, user: str = Depends(require_auth)):
+    """Watch an itinerary for incidents; active ones until arrival, saved ones until removed"""
+    incident_feed.ensure_current()
+    try:
+        w = watches.watch(user, req.itinerary, req.id, bool(req.saved))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    # Incidents already in force are reported now; later ones arrive as "reroute" push events
+    current = [rec for _, rec in incident_store.matching(w.routes, w.cells)]
+    watches.acknowledge(w, current)
+    return {**w.describe(), "current_incidents": current, "suggestion": suggest_reroute(w.itinerary, current, _stop_coords)}
+
+@app.get("/itineraries/watch")
+def watched_itineraries(user: str = Depends(require_auth)):
+    return {"watches": [w.describe() for w in watches.for_user(user)]}
+
+@app.delete("/itineraries/watch/{watch_id}")
+def unwatch_itinerary(watch_id: str, user: str = Depends(require_auth)):
+    if not watches.unwatch(user, watch_id):
+        raise HTTPException(404, "Not watching that itinerary")
+    return {"ok": True}
+
 # ---------- Alerts & Weather ----------
-@app.get("/alerts")
-def alerts(bbox: Optional[str] = None, user: str = Depends(require_auth)):
+def _traffic_feed():
+    prov = Providers()
+    return prov.incidents() if prov.USE_REAL else sample_traffic()
+
+# NZTA incidents and service alerts, polled region-wide into the indexed store
+incident_feed = IncidentFeed({"alerts": sample_alerts, "traffic": _traffic_feed})
+
+def _alerts_payload(bbox: Optional[str], start: Optional[float] = None, end: Optional[float] = None):
+    incident_feed.ensure_current()
+    out = {"alerts": [], "traffic": []}
+    for source, rec in incident_store.query(parse_bbox(bbox) if bbox else None, start, end):
+        out[source].append(rec)
+    return out
+
+# Forecasts are shared per ~2 km tile: one upstream fetch serves everyone in
+# it until MetService's next issue (entries turn over on the cadence boundary)
+WEATHER_TILE_DEG = float(os.getenv("ATIS_WEATHER_TILE_DEG", "0.02"))
+WEATHER_CADENCE_S = float(os.getenv("ATIS_WEATHER_CADENCE_S", "3600"))
+weather_cache = StaleCache("weather", max_entries=int(os.getenv("ATIS_WEATHER_CACHE_SIZE", "4096")),
+                           ttl_s=WEATHER_CADENCE_S,
+                           stale_s=float(os.getenv("ATIS_WEATHER_CACHE_STALE", "1800")),
+                           align_s=WEATHER_CADENCE_S,
+                           jitter_s=float(os.getenv("ATIS_WEATHER_JITTER_S", "300")))
+
+def weather_tile(lat: float, lng: float):
+    return snap(lat, lng, WEATHER_TILE_DEG)
+
+def _tile_centre(tile):
+    return tile[0] * WEATHER_TILE_DEG, tile[1] * WEATHER_TILE_DEG
+
+def _fetch_weather(tile):
+    lat, lng = _tile_centre(tile)
     prov = Providers()
-    traffic = prov.incidents() if prov.USE_REAL else sample_traffic(bbox or '174.70,-36.88,174.80,-36.80')
-    return {"alerts": sample_alerts(), "traffic": traffic}
+    return prov.weather(lat, lng) if prov.USE_REAL else sample_weather([lat, lng], raw=True)
+
+def _weather_forecast(lat: float, lng: float):
+    tile = weather_tile(lat, lng)
+    return weather_cache.get_or_compute(tile, lambda: _fetch_weather(tile))
+
+# Polled every 30 s by each open map; one serialized payload per bbox and incident update
+alerts_cache = StaleCache("alerts", max_entries=int(os.getenv("ATIS_ALERTS_CACHE_SIZE", "512")),
+                          ttl_s=float(os.getenv("ATIS_ALERTS_CACHE_TTL", "30")),
+                          stale_s=float(os.getenv("ATIS_ALERTS_CACHE_STALE", "60")),
+                          topics=("incidents",))
+
+@app.get("/alerts")
+def alerts(request: Request, bbox: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+           user: str = Depends(require_auth)):
+    """Alerts and incidents inside bbox (minLng,minLat,maxLng,maxLat) overlapping [start, end] (default: not yet over)"""
+    try:
+        box = parse_bbox(bbox) if bbox else None
+        window = (parse_time(start), parse_time(end))
+    except ValueError:
+        raise HTTPException(400, "bbox must be minLng,minLat,maxLng,maxLat and start/end ISO 8601 times")
+    # Expiring an incident publishes "incidents", which clears alerts_cache before the lookup
+    incident_feed.ensure_current()
+    key = (box, window)
+    rep = alerts_cache.get_or_compute(key, lambda: Representation.of(_alerts_payload(bbox, *window), "private, no-cache"))
+    return conditional(request, rep)
 
 @app.get("/weather/point")
 def weather_point(lat: float, lng: float, user: str = Depends(require_auth)):
-    prov = Providers()
-    data = prov.weather(lat, lng) if prov.USE_REAL else sample_weather([lat, lng], raw=True)
-    return {"lat": lat, "lng": lng, "forecast": data}
+    """Forecast for the ~2 km tile containing the point"""
+    return {"lat": lat, "lng": lng, "forecast": _weather_forecast(lat, lng)}
+
+# ---------- Push (SSE / WebSocket) ----------
+# Records per topic, keyed by id so producers can send only what changed
+def _board_records(stop_id: str):
+    board = departures_cache.get_or_compute(stop_id, lambda: _fetch_board(stop_id))
+    return {d["trip_id"]: d for d in board}
+
+def _alert_records(bbox: str):
+    data = _alerts_payload(bbox)
+    records = {a["id"]: {"kind": "alert", **a} for a in data["alerts"]}
+    records.update({t["id"]: {"kind": "traffic", **t} for t in data["traffic"]})
+    return records
+
+def _weather_records(cell):
+    lat, lng = cell
+    return {"forecast": {"id": "forecast", "lat": lat, "lng": lng, **_weather_forecast(lat, lng)}}
+
+hub.register("departures", _board_records, interval_s=departures_cache.ttl_s, data_topics=("feed", "realtime"))
+hub.register("alerts", _alert_records, interval_s=30, data_topics=("incidents",))
+# Forecasts turn over hourly (weather_cache); polling is prompt enough, no topic publishes them
+hub.register("weather", _weather_records, interval_s=120)
+
+def _stream_auth(authorization: Optional[str], token: Optional[str]):
+    """JWT checked once per connection; EventSource cannot set headers, so ?token= also works"""
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization.split(" ", 1)[1].strip()
+    data = decode_token(token) if token else None
+    if not data:
+        raise HTTPException(status_code=401, detail="Missing or invalid token")
+    return data["sub"], data.get("exp")
+
+def _parse_floats(value: Optional[str]):
+    return [float(x) for x in value.split(",")] if value else None
+
+@app.get("/stream")
+async def stream(stops: Optional[str] = None, bbox: Optional[str] = None, weather: Optional[str] = None,
+                 reroutes: bool = False, token: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """Server-sent events: a snapshot per topic, then diffs as the data changes (plus the user's reroute events)"""
+    user, exp = _stream_auth(authorization, token)
+    try:
+        wanted = parse_subscription(stops.split(",") if stops else None, bbox, _parse_floats(weather),
+                                    weather_cell_deg=WEATHER_TILE_DEG)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if not wanted and not reroutes:
+        raise HTTPException(400, "Subscribe to at least one of stops, bbox, weather, reroutes")
+    sub = hub.connect(user, exp)
+    try:
+        for kind, key, arg in wanted:
+            hub.subscribe(sub, kind, key, arg)
+    except ValueError as e:
+        hub.disconnect(sub)
+        raise HTTPException(400, str(e))
+    return StreamingResponse(_sse_events(sub), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _sse_events(sub):
+    try:
+        yield ": connected\n\n"
+        while True:
+            event, payload = await sub.queue.get()
+            if event == "ping":
+                if sub.expired:
+                    yield "event: expired\ndata: {}\n\n"
+                    return
+                yield ": ping\n\n"
+            elif event == "resync":
+                hub.resync(sub)
+            else:
+                yield f"event: {event}\ndata: {payload}\n\n"
+    finally:
+        hub.disconnect(sub)
+
+@app.websocket("/ws")
+async def ws(websocket: WebSocket, token: Optional[str] = None):
+    """
+    Same topics over a WebSocket; the client sends
+    {"subscribe": {"stops": [...], "bbox": "...", "weather": [lat, lng]}} or
+    {"unsubscribe": {...}} at any time
+    """
+    try:
+        user, exp = _stream_auth(websocket.headers.get("authorization"), token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    sub = hub.connect(user, exp)
+    sender = asyncio.create_task(_ws_send(websocket, sub))
+    try:
+        while True:
+            try:
+                msg = json.loads(await websocket.receive_text())
+                for action in ("subscribe", "unsubscribe"):
+                    spec = msg.get(action)
+                    if not spec:
+                        continue
+                    for kind, key, arg in parse_subscription(spec.get("stops"), spec.get("bbox"),
+                                                             spec.get("weather"),
+                                                             weather_cell_deg=WEATHER_TILE_DEG):
+                        if action == "subscribe":
+                            hub.subscribe(sub, kind, key, arg)
+                        else:
+                            hub.unsubscribe(sub, f"{kind}:{key}")
+            except (ValueError, TypeError, AttributeError) as e:
+                sub.send("error", json.dumps({"type": "error", "detail": str(e)}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        hub.disconnect(sub)
+
+async def _ws_send(websocket: WebSocket, sub):
+    while True:
+        event, payload = await sub.queue.get()
+        if event == "ping":
+            if sub.expired:
+                await websocket.close(code=1008)
+                return
+            await websocket.send_text('{"type":"ping"}')
+        elif event == "resync":
+            hub.resync(sub)
+        else:
+            await websocket.send_text(payload)
 
 # ---------- Safety ----------
+SAFETY_CONTACTS = Representation.of({"contacts": [
+    {"name": "Emergency (NZ)", "phone": "111"},
+    {"name": "Non-Emergency Police", "phone": "105"},
+    {"name": "AT HOP / Transport Info", "phone": "09 366 6400"},
+]}, STATIC)
+
 @app.get("/safety/contacts")
-def safety_contacts():
-    return {"contacts": [
-        {"name": "Emergency (NZ)", "phone": "111"},
-        {"name": "Non-Emergency Police", "phone": "105"},
-        {"name": "AT HOP / Transport Info", "phone": "09 366 6400"},
-    ]}
+def safety_contacts(request: Request):
+    return conditional(request, SAFETY_CONTACTS)
 
 # ---------- Reviews (auth to post) ----------
 REVIEWS = []
@@ -306,13 +839,18 @@ class Review(BaseModel):
     rating: int
     comment: str
 
+# Serialized once per change to the list
+reviews_cache = TTLCache("reviews", max_entries=1, ttl_s=86400, topics=("reviews",))
+
 @app.get("/reviews")
-def get_reviews():
-    return {"reviews": REVIEWS}
+def get_reviews(request: Request):
+    return conditional(request, reviews_cache.get_or_compute(
+        "all", lambda: Representation.of({"reviews": REVIEWS}, REVALIDATE)))
 
 @app.post("/reviews")
 def add_review(r: Review, user: str = Depends(require_auth)):
     REVIEWS.append({"ts": int(time.time()), "user": user, **r.dict()})
+    data_changed("reviews")
     return {"ok": True}
 
 # ---------- Preferences (auth) ----------
@@ -341,15 +879,23 @@ def save_prefs(p: Prefs, user: str = Depends(require_auth)):
 @app.post("/environmental/compare")
 def environmental_compare(req: PlanRequest, user: str = Depends(require_auth)):
     """Compare environmental impact of different routes"""
-    itins = sample_itineraries(
-        req.origin, req.destination,
-        prefers_fewer_transfers=(req.optimize=="fewest_transfers"),
-        optimize=req.optimize,
-        max_walk_km=req.max_walk_km,
-        avoid_stairs=req.avoid_stairs,
-        bike_ok=req.bike_ok,
-        modes=req.modes
-    )
+    try:
+        itins = plan_itineraries(
+            req.origin, req.destination,
+            depart_at=req.depart_at,
+            arrive_by=req.arrive_by,
+            prefers_fewer_transfers=(req.optimize=="fewest_transfers"),
+            optimize=req.optimize,
+            max_walk_km=req.max_walk_km,
+            avoid_stairs=req.avoid_stairs,
+            bike_ok=req.bike_ok,
+            modes=req.modes
+        )
+    except ValueError:
+        raise HTTPException(400, "Invalid depart_at/arrive_by time")
+    
+    if not itins:
+        raise HTTPException(404, "No route found")
     
     # Add environmental data to each itinerary
     for itin in itins:
@@ -388,26 +934,28 @@ def mcda_score(req: MCDARequest, user: str = Depends(require_auth)):
         "weights_used": mcda.weights
     }
 
+MCDA_PROFILES = Representation.of({
+    "profiles": {
+        "commuter": customize_weights_for_profile("commuter"),
+        "budget": customize_weights_for_profile("budget"),
+        "eco": customize_weights_for_profile("eco"),
+        "comfort": customize_weights_for_profile("comfort"),
+        "reliable": customize_weights_for_profile("reliable"),
+        "balanced": customize_weights_for_profile("balanced")
+    },
+    "criteria": {
+        "time": "Trip duration and speed",
+        "cost": "Estimated fare",
+        "comfort": "Transfers and walking distance",
+        "reliability": "On-time performance",
+        "environmental": "CO2 emissions"
+    }
+}, STATIC)
+
 @app.get("/mcda/profiles")
-def mcda_profiles():
+def mcda_profiles(request: Request):
     """Get available MCDA weight profiles"""
-    return {
-        "profiles": {
-            "commuter": customize_weights_for_profile("commuter"),
-            "budget": customize_weights_for_profile("budget"),
-            "eco": customize_weights_for_profile("eco"),
-            "comfort": customize_weights_for_profile("comfort"),
-            "reliable": customize_weights_for_profile("reliable"),
-            "balanced": customize_weights_for_profile("balanced")
-        },
-        "criteria": {
-            "time": "Trip duration and speed",
-            "cost": "Estimated fare",
-            "comfort": "Transfers and walking distance",
-            "reliability": "On-time performance",
-            "environmental": "CO2 emissions"
-        }
-    }
+    return conditional(request, MCDA_PROFILES)
 
 # ---------- Analytics Dashboard ----------
 @app.post("/analytics/track/trip")
@@ -435,10 +983,12 @@ def analytics_popular_routes(limit: int = 10, user: str = Depends(require_auth))
     return {"popular_routes": analytics.get_popular_routes(limit)}
 
 @app.get("/analytics/usage/heatmap")
-def analytics_usage_heatmap(user: str = Depends(require_auth)):
-    """Get usage heatmap by hour and day"""
+def analytics_usage_heatmap(compact: bool = False, user: str = Depends(require_auth)):
+    """Get usage heatmap by hour and day (compact: 7x24 counts, Monday first)"""
     analytics = get_analytics()
-    return {"heatmap": analytics.get_hourly_usage_heatmap()}
+    if compact:
+        return json_response(analytics.get_hourly_usage_matrix())
+    return json_response({"heatmap": analytics.get_hourly_usage_heatmap()})
 
 @app.get("/analytics/modes")
 def analytics_modes(user: str = Depends(require_auth)):
@@ -0,0 +1,172 @@
+"""
+Origin-Destination Matrix Planning for ATIS
+Plans every origin x destination pair for /plan/matrix on a pool of worker
+processes. One RAPTOR search covers a whole chunk of pairs (all the
+destinations of one origin, or all the origins of one destination for
+arrive-by), and each pair is ranked, given its emissions and MCDA-scored
+exactly as /plan would.
+
+Workers start from a forkserver rather than forking the API process, which
+by then runs the provider loop, pollers and writer threads: a forked child
+can inherit a lock one of those threads held and hang on it. Each worker
+loads its own timetable; the memory-mapped footpath graph is still shared
+through the page cache. A worker that dies breaks its pool, which is then
+replaced for the next request.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+import time
+
+from . import db
+from .db import add_swap_listener
+from .environmental import calculate_itinerary_emissions
+from .mcda import MCDAScorer
+from .routing import get_timetable, route_batch
+from .store import rank_itineraries
+
+MATRIX_WORKERS = int(os.getenv("ATIS_MATRIX_WORKERS", "0")) or os.cpu_count() or 1
+MAX_MATRIX_PAIRS = int(os.getenv("ATIS_MATRIX_MAX_PAIRS", "20000"))
+CHUNK_SIZE = 100               # pairs sharing one search in a worker task
+
+
+def _context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # The server imports the routing code once; workers fork from it, single-threaded
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _init_worker(db_path: str):
+    # Workers don't inherit runtime settings, only the environment
+    db.DB_PATH = db_path
+    get_timetable()
+
+
+def solve_chunk(origin_idx: Sequence[int], origins: Sequence[Sequence[float]],
+                dest_idx: Sequence[int], destinations: Sequence[Sequence[float]],
+                params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Worker task: one NDJSON row per origin x destination pair in the chunk"""
+    found = route_batch(origins, destinations, params.get("depart_at"), params.get("arrive_by"),
+                        params.get("modes"), params.get("max_walk_km"))
+    scorer = MCDAScorer()
+    rows = []
+    for oi, per_dest in zip(origin_idx, found):
+        for di, options in zip(dest_idx, per_dest):
+            rows.append(_pair_row(oi, di, options, params, scorer))
+    return rows
+
+
+def _pair_row(oi: int, di: int, options: List[Dict[str, Any]], params: Dict[str, Any],
+              scorer: MCDAScorer) -> Dict[str, Any]:
+    options = rank_itineraries(options, params.get("optimize") or "fastest",
+                               params.get("optimize") == "fewest_transfers")
+    if not options:
+        return {"origin": oi, "destination": di, "status": "no_route"}
+    for itin in options:
+        itin["environmental"] = calculate_itinerary_emissions(itin)
+    best = scorer.score_all_itineraries(options)[0]
+    return {
+        "origin": oi, "destination": di, "status": "ok",
+        "durationMin": best["durationMin"], "transfers": best["transfers"],
+        "walk_km": best["walk_km"], "modes": best["modes"],
+        "departure": best["departure"], "arrival": best["arrival"],
+        "co2_kg": best["environmental"]["total_co2_kg"],
+        "mcda_score": best["mcda_score"],
+    }
+
+
+def _chunks(origins, destinations, arrive_by) -> Iterator[tuple]:
+    """(origin indices, destination indices) per task; the search side has one point"""
+    if arrive_by:
+        for di in range(len(destinations)):
+            for start in range(0, len(origins), CHUNK_SIZE):
+                yield list(range(start, min(start + CHUNK_SIZE, len(origins)))), [di]
+    else:
+        for oi in range(len(origins)):
+            for start in range(0, len(destinations), CHUNK_SIZE):
+                yield [oi], list(range(start, min(start + CHUNK_SIZE, len(destinations))))
+
+
+# ---------- Worker pool ----------
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_matrix_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=MATRIX_WORKERS, mp_context=_context(),
+                                            initializer=_init_worker, initargs=(db.DB_PATH,))
+    return _pool
+
+
+def reset_matrix_pool(broken: Optional[ProcessPoolExecutor] = None):
+    """
+    Retire the workers; their timetable copy is stale after a feed swap.
+    With `broken`, only that pool is retired (a request that saw it fail
+    must not take down a replacement another request already started).
+    """
+    global _pool
+    with _pool_lock:
+        if broken is not None and _pool is not broken:
+            return
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit_all(origins, destinations, params) -> tuple:
+    for attempt in range(2):
+        pool = get_matrix_pool()
+        try:
+            return pool, [pool.submit(solve_chunk, oi, [origins[i] for i in oi],
+                                      di, [destinations[j] for j in di], params)
+                          for oi, di in _chunks(origins, destinations, params.get("arrive_by"))]
+        except BrokenProcessPool:
+            # A worker died since the last request; start over on a fresh pool once
+            reset_matrix_pool(pool)
+            if attempt:
+                raise
+
+
+add_swap_listener(reset_matrix_pool)
+
+
+def stream_matrix(origins: List[List[float]], destinations: List[List[float]],
+                  params: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Yield pair rows as worker tasks complete (in completion order), then a
+    final summary row. Pending tasks are cancelled if the consumer stops.
+    """
+    started = time.perf_counter()
+    pool, futures = _submit_all(origins, destinations, params)
+    routed = total = 0
+    error = None
+    try:
+        for fut in as_completed(futures):
+            for row in fut.result():
+                total += 1
+                routed += row["status"] == "ok"
+                yield row
+    except BrokenProcessPool:
+        # A worker died mid-matrix (killed, out of memory): the rows so far stand,
+        # and the next request gets a new pool
+        reset_matrix_pool(pool)
+        error = "worker process died; matrix incomplete"
+    finally:
+        for fut in futures:
+            fut.cancel()
+    summary = {"pairs": total, "routed": routed, "seconds": round(time.perf_counter() - started, 3)}
+    if error:
+        summary["error"] = error
+    yield {"summary": summary}
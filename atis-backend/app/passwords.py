@@ -0,0 +1,130 @@
+"""
+Password Hashing for ATIS
+Passwords are stored as bcrypt hashes. A bcrypt check costs a few hundred
+milliseconds of CPU by design, so hashing and verification run on their
+own small thread pool instead of the request threadpool: a login storm
+queues behind the hashing workers while /departures and the other
+endpoints keep their threads. The pool admits a bounded backlog; beyond
+that it raises HashPoolBusy, which the API turns into 503 + Retry-After.
+
+Hashes from earlier versions (one salted SHA-256) are still accepted and
+replaced with bcrypt on the next successful login.
+"""
+
+from typing import Any, Callable, Dict
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import hashlib
+import hmac
+import math
+import os
+import threading
+import time
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.getenv("ATIS_BCRYPT_ROUNDS", "12"))
+# Hashing threads (0 = one per CPU), logins allowed to wait for one, and
+# the threads' nice value so request threads win the CPU (Linux)
+HASH_WORKERS = int(os.getenv("ATIS_HASH_WORKERS", "0")) or os.cpu_count() or 1
+HASH_QUEUE = int(os.getenv("ATIS_HASH_QUEUE", "4"))
+HASH_NICE = int(os.getenv("ATIS_HASH_NICE", "5"))
+
+
+class HashPoolBusy(Exception):
+    """The hashing backlog is full; try again after `retry_after_s`"""
+
+    def __init__(self, retry_after_s: int):
+        super().__init__(f"Too many logins in progress, retry in {retry_after_s} s")
+        self.retry_after_s = retry_after_s
+
+
+def _lower_priority():
+    try:
+        # On Linux a thread's nice value is its own; elsewhere this is skipped
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), HASH_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+class HashPool:
+    """Bounded executor for password work, with admission control"""
+
+    def __init__(self, workers: int = HASH_WORKERS, queue: int = HASH_QUEUE):
+        self.workers = workers
+        self.queue = queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="passwords",
+                                            initializer=_lower_priority if HASH_NICE else None)
+        self._pending = 0
+        self._avg_s = 0.25   # running mean of one job, seeds Retry-After
+        self._lock = threading.Lock()
+        self.stats = {"jobs": 0, "rejected": 0, "max_pending": 0}
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog should have drained"""
+        return max(1, math.ceil(self._pending / self.workers * self._avg_s))
+
+    def submit(self, fn: Callable[..., Any], *args) -> Future:
+        with self._lock:
+            if self._pending >= self.workers + self.queue:
+                self.stats["rejected"] += 1
+                raise HashPoolBusy(self.retry_after())
+            self._pending += 1
+            self.stats["jobs"] += 1
+            self.stats["max_pending"] = max(self.stats["max_pending"], self._pending)
+
+        def job():
+            t = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    self._avg_s += (time.perf_counter() - t - self._avg_s) * 0.2
+        return self._executor.submit(job)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Await `fn(*args)` on the pool from async code; raises HashPoolBusy when saturated"""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"workers": self.workers, "queue": self.queue, "pending": self._pending,
+                    "avg_ms": round(self._avg_s * 1000, 1), "rounds": BCRYPT_ROUNDS, **self.stats}
+
+
+hash_pool = HashPool()
+
+
+def _bcrypt_input(password: str) -> bytes:
+    # bcrypt only reads 72 bytes; newer releases reject longer input instead of truncating
+    return password.encode()[:72]
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(_bcrypt_input(password), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+
+
+def legacy_hash(password: str, salt: str) -> str:
+    return hashlib.sha256((salt + ":" + password).encode()).hexdigest()
+
+
+def is_legacy(stored: str) -> bool:
+    return not stored.startswith("$2")
+
+
+def check_password(password: str, stored: str, salt: str = "") -> bool:
+    if is_legacy(stored):
+        return hmac.compare_digest(legacy_hash(password, salt), stored)
+    return bcrypt.checkpw(_bcrypt_input(password), stored.encode())
+
+
+_dummy = None
+
+def check_nobody(password: str) -> bool:
+    """Same work as a real check, so unknown usernames don't answer faster"""
+    global _dummy
+    if _dummy is None:
+        _dummy = hash_password("not a password")
+    check_password(password, _dummy)
+    return False
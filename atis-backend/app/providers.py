@@ -1,7 +1,312 @@
+"""
+Upstream Data Providers for ATIS
+Departures (Auckland Transport), traffic incidents (NZTA) and weather
+(MetService) over HTTP. Each upstream has one shared httpx.AsyncClient
+with keep-alive pooling, its own timeout, a cap on concurrent requests,
+retries with jittered backoff and a circuit breaker. While the breaker is
+open, or after retries run out, callers get the last good response for
+the same request.
+
+All clients live on one background event loop, so the sync endpoints and
+cache refresh threads can call Providers directly. Base URLs can be
+pointed at local stand-in servers for tests and benchmarks.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import concurrent.futures
 import os
+import random
+import threading
+import time
+
+import httpx
+
+
+class ProviderUnavailable(Exception):
+    """Upstream failed and there is no earlier response to fall back on"""
+
+
+def _env(upstream: str, key: str, default: str) -> str:
+    return os.getenv(f"ATIS_{upstream}_{key}", default)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failures; after `reset_s` one trial
+    request is let through (half-open) and its outcome closes or re-opens it.
+    """
+
+    def __init__(self, failures: int = 5, reset_s: float = 30.0):
+        self.failures = failures
+        self.reset_s = reset_s
+        self.state = "closed"
+        self._count = 0
+        self._opened_at = 0.0
+        self._trial = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_s:
+            self.state = "half_open"
+            self._trial = False
+        if self.state == "half_open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def success(self):
+        self.state = "closed"
+        self._count = 0
+
+    def failure(self):
+        self._count += 1
+        if self.state == "half_open" or self._count >= self.failures:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def abandon(self):
+        """The caller gave up on a request (cancelled): a trial counts as failed, so another can follow"""
+        if self.state == "half_open":
+            self.failure()
+
+
+class Upstream:
+    """One upstream API: pooled client, timeout, concurrency cap, retries, breaker, last good data"""
+
+    def __init__(self, name: str, base_url: str, headers: Dict[str, str], timeout_s: float,
+                 concurrency: int, retries: int = 2, backoff_s: float = 0.1,
+                 deadline_s: Optional[float] = None, breaker: Optional[CircuitBreaker] = None,
+                 keep_last: int = 2048):
+        self.name = name
+        self.base_url = base_url
+        self.headers = headers
+        self.timeout_s = timeout_s
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff_s = backoff_s
+        # Retries fit inside this: fast failures get all of them, a hung upstream about two
+        self.deadline_s = deadline_s or 2 * timeout_s
+        self.breaker = breaker or CircuitBreaker()
+        self.keep_last = keep_last
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._last_good: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self.stats = {"requests": 0, "upstream_calls": 0, "retries": 0, "timeouts": 0, "errors": 0,
+                      "served_last_good": 0, "rejected_open": 0, "in_flight": 0}
+
+    @classmethod
+    def from_env(cls, name: str, base_url: str, key_header: str, key_env: str,
+                 timeout_s: float, concurrency: int) -> "Upstream":
+        key = os.getenv(key_env)
+        timeout_s = float(_env(name, "TIMEOUT_S", str(timeout_s)))
+        return cls(name, _env(name, "BASE_URL", base_url),
+                   {key_header: key} if key else {},
+                   timeout_s,
+                   int(_env(name, "CONCURRENCY", str(concurrency))),
+                   retries=int(_env(name, "RETRIES", "2")),
+                   deadline_s=float(_env(name, "DEADLINE_S", str(2 * timeout_s))),
+                   breaker=CircuitBreaker(int(_env(name, "BREAKER_FAILURES", "5")),
+                                          float(_env(name, "BREAKER_RESET_S", "30"))))
+
+    def _ensure_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, headers=self.headers,
+                timeout=httpx.Timeout(self.timeout_s, connect=min(self.timeout_s, 2.0)),
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency))
+            self._slots = asyncio.Semaphore(self.concurrency)
+
+    async def get_json(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """GET path -> parsed JSON, falling back to the last good response for the same request"""
+        self._ensure_client()
+        key = (path, tuple(sorted((params or {}).items())))
+        self.stats["requests"] += 1
+        if not self.breaker.allow():
+            self.stats["rejected_open"] += 1
+            return self._fallback(key, f"{self.name} circuit open")
+        healthy = None
+        try:
+            # One deadline over queueing for a slot, every attempt and the backoff
+            data = await asyncio.wait_for(self._fetch(path, params), self.deadline_s)
+            healthy = True
+        except httpx.HTTPStatusError as e:
+            # 4xx: the upstream is healthy, it just rejected this request
+            healthy = e.response.status_code < 500 and e.response.status_code != 429
+            if healthy:
+                return self._fallback(key, f"{self.name} rejected request: {e}")
+            return self._fallback(key, f"{self.name} unavailable: {e}")
+        except Exception as e:
+            healthy = False
+            return self._fallback(key, f"{self.name} unavailable: {e!r}")
+        finally:
+            # Every outcome settles the breaker, including a cancel (CancelledError is a
+            # BaseException), so a half-open trial is never left holding it
+            if healthy is None:
+                self.breaker.abandon()
+            elif healthy:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+        self._last_good[key] = data
+        self._last_good.move_to_end(key)
+        while len(self._last_good) > self.keep_last:
+            self._last_good.popitem(last=False)
+        return data
+
+    async def _fetch(self, path: str, params: Optional[Dict[str, Any]]) -> Any:
+        attempt = 0
+        while True:
+            try:
+                async with self._slots:
+                    self.stats["upstream_calls"] += 1
+                    self.stats["in_flight"] += 1
+                    try:
+                        resp = await self._client.get(path, params=params)
+                    finally:
+                        self.stats["in_flight"] -= 1
+                if resp.status_code < 500 and resp.status_code != 429:
+                    resp.raise_for_status()   # 4xx: our request is wrong, retrying won't help
+                    return resp.json()
+                error: Exception = httpx.HTTPStatusError(f"HTTP {resp.status_code}",
+                                                         request=resp.request, response=resp)
+            except httpx.TimeoutException as e:
+                self.stats["timeouts"] += 1
+                error = e
+            except httpx.TransportError as e:
+                error = e
+            except httpx.HTTPStatusError:
+                self.stats["errors"] += 1
+                raise
+            if attempt >= self.retries:
+                self.stats["errors"] += 1
+                raise error
+            attempt += 1
+            self.stats["retries"] += 1
+            # Full jitter: spread retries so a blip doesn't turn into a synchronized burst
+            await asyncio.sleep(random.uniform(0, self.backoff_s * 2 ** attempt))
+
+    def _fallback(self, key, reason: str) -> Any:
+        if key in self._last_good:
+            self.stats["served_last_good"] += 1
+            return self._last_good[key]
+        raise ProviderUnavailable(reason)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "breaker": self.breaker.state, "base_url": self.base_url,
+                "timeout_s": self.timeout_s, "deadline_s": self.deadline_s, "concurrency": self.concurrency}
+
+
+# ---------- Provider loop ----------
+
+class _Loop:
+    """Background event loop that owns every upstream client"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="providers", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coro):
+        """Run on the provider loop, blocking the calling thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self.get()).result()
+
+    async def submit(self, coro):
+        """Run on the provider loop, awaited from another event loop"""
+        return await asyncio.wrap_future(self.start(coro))
+
+    def start(self, coro) -> concurrent.futures.Future:
+        """Run on the provider loop without waiting; cancelling the future cancels the request"""
+        return asyncio.run_coroutine_threadsafe(coro, self.get())
+
+
+_loop = _Loop()
+
+
 class Providers:
-    USE_REAL = False
+    """
+    AT / NZTA / MetService. Upstream clients are shared by every instance;
+    the sync methods block the calling thread, the a* coroutines can be
+    awaited from any event loop and the start_* methods return a
+    concurrent.futures.Future. All raise ProviderUnavailable when an
+    upstream fails and nothing earlier can be served.
+    """
+    USE_REAL = os.getenv("ATIS_USE_REAL_PROVIDERS", "0") == "1"
+
+    at = Upstream.from_env("AT", "https://api.at.govt.nz/realtime/legacy", "Ocp-Apim-Subscription-Key",
+                           "AT_API_KEY", timeout_s=2.0, concurrency=16)
+    nzta = Upstream.from_env("NZTA", "https://api.nzta.govt.nz/traffic", "x-api-key",
+                             "NZTA_API_KEY", timeout_s=3.0, concurrency=8)
+    metservice = Upstream.from_env("METSERVICE", "https://api.metservice.com/forecast", "x-api-key",
+                                   "METSERVICE_API_KEY", timeout_s=3.0, concurrency=8)
+
     def __init__(self):
         self.AT_API_KEY = os.getenv("AT_API_KEY")
         self.NZTA_API_KEY = os.getenv("NZTA_API_KEY")
         self.METSERVICE_API_KEY = os.getenv("METSERVICE_API_KEY")
+
+    # --- requests (run on the provider loop) ---
+
+    async def _departures(self, stop_id: str):
+        data = await self.at.get_json(f"/departures/{stop_id}")
+        return data.get("departures", []) if isinstance(data, dict) else data
+
+    async def _incidents(self, bbox: Optional[str] = None):
+        data = await self.nzta.get_json("/incidents", {"bbox": bbox} if bbox else None)
+        return data.get("incidents", []) if isinstance(data, dict) else data
+
+    async def _weather(self, lat: float, lng: float):
+        # ~1 km rounding so nearby points share the fallback entry
+        data = await self.metservice.get_json("/point", {"lat": round(lat, 2), "lon": round(lng, 2)})
+        return data.get("forecast", data) if isinstance(data, dict) else data
+
+    # --- async ---
+
+    async def adepartures(self, stop_id: str):
+        return await _loop.submit(self._departures(stop_id))
+
+    async def aincidents(self, bbox: Optional[str] = None):
+        return await _loop.submit(self._incidents(bbox))
+
+    async def aweather(self, lat: float, lng: float):
+        return await _loop.submit(self._weather(lat, lng))
+
+    # --- futures ---
+
+    def start_incidents(self, bbox: Optional[str] = None) -> concurrent.futures.Future:
+        return _loop.start(self._incidents(bbox))
+
+    def start_weather(self, lat: float, lng: float) -> concurrent.futures.Future:
+        return _loop.start(self._weather(lat, lng))
+
+    # --- sync ---
+
+    def departures(self, stop_id: str):
+        return _loop.run(self._departures(stop_id))
+
+    def incidents(self, bbox: Optional[str] = None):
+        return _loop.run(self._incidents(bbox))
+
+    def weather(self, lat: float, lng: float):
+        return _loop.run(self._weather(lat, lng))
+
+
+def provider_stats() -> Dict[str, Any]:
+    return {"use_real": Providers.USE_REAL,
+            **{u.name.lower(): u.snapshot() for u in (Providers.at, Providers.nzta, Providers.metservice)}}
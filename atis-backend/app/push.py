@@ -0,0 +1,270 @@
+"""
+Server Push for ATIS
+Clients subscribe to topics (a stop's departure board, the alerts for a
+bbox, the weather for a cell) over SSE or a WebSocket instead of polling.
+Each topic has one producer task that re-reads its source, diffs the new
+records against the last ones by id and fans the change out to every
+subscriber as one pre-serialised message. Producers also wake early when
+their data topic is published through cache.data_changed. Messages meant
+for one user (reroute notices) go to all of that user's connections.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from math import ceil, floor
+import asyncio
+import json
+import os
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from .cache import add_change_listener
+
+HEARTBEAT_S = float(os.getenv("ATIS_PUSH_HEARTBEAT_S", "15"))
+QUEUE_SIZE = int(os.getenv("ATIS_PUSH_QUEUE_SIZE", "64"))
+MAX_TOPICS_PER_SUBSCRIBER = 50
+
+
+# ---------- Diffs ----------
+
+def diff_records(old: Optional[Dict[str, dict]], new: Dict[str, dict]) -> Optional[Dict[str, Any]]:
+    """Upserts and removals turning `old` into `new` (both keyed by id); None if equal"""
+    if old is None:
+        return {"upsert": list(new.values()), "remove": []}
+    upsert = [rec for rid, rec in new.items() if old.get(rid) != rec]
+    remove = [rid for rid in old if rid not in new]
+    if not upsert and not remove:
+        return None
+    return {"upsert": upsert, "remove": remove}
+
+
+# ---------- Subscribers & topics ----------
+
+class Subscriber:
+    """One connected client: a bounded queue of encoded messages"""
+
+    def __init__(self, user: str, expires_at: Optional[float] = None):
+        self.user = user
+        self.expires_at = expires_at
+        self.topics: Set[str] = set()
+        self.queue: "asyncio.Queue[Tuple[str, str]]" = asyncio.Queue(QUEUE_SIZE)
+
+    def send(self, event: str, payload: str) -> bool:
+        """Enqueue without blocking; a client that falls behind is reset to snapshots"""
+        try:
+            self.queue.put_nowait((event, payload))
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(("resync", ""))
+            return False
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+
+class Kind:
+    """A family of topics sharing a source: fetch(arg) -> {id: record}"""
+
+    def __init__(self, name: str, fetch: Callable[[Any], Dict[str, dict]], interval_s: float,
+                 data_topics: Tuple[str, ...] = ()):
+        self.name = name
+        self.fetch = fetch
+        self.interval_s = interval_s
+        self.data_topics = data_topics
+
+
+class Topic:
+    def __init__(self, key: str, kind: Kind, arg: Any):
+        self.key = key
+        self.kind = kind
+        self.arg = arg
+        self.subscribers: Set[Subscriber] = set()
+        self.records: Optional[Dict[str, dict]] = None
+        self.version = 0
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def message(self, typ: str, body: Dict[str, Any]) -> str:
+        return json.dumps({"topic": self.key, "type": typ, "version": self.version, **body},
+                          separators=(",", ":"), default=str)
+
+    def snapshot(self) -> str:
+        return self.message("snapshot", {"upsert": list((self.records or {}).values()), "remove": []})
+
+
+class PushHub:
+    """Topic registry and producers; lives on the server's event loop"""
+
+    def __init__(self):
+        self.kinds: Dict[str, Kind] = {}
+        self.topics: Dict[str, Topic] = {}
+        self.subscribers: Set[Subscriber] = set()
+        self._by_user: Dict[str, Set[Subscriber]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self.stats = {"messages": 0, "deliveries": 0, "dropped": 0, "fetches": 0,
+                      "unchanged": 0, "fetch_errors": 0, "notifications": 0}
+        add_change_listener(self._data_changed)
+
+    def register(self, name: str, fetch: Callable[[Any], Dict[str, dict]], interval_s: float,
+                 data_topics: Tuple[str, ...] = ()):
+        self.kinds[name] = Kind(name, fetch, interval_s, data_topics)
+
+    # --- subscriptions ---
+
+    def connect(self, user: str, expires_at: Optional[float] = None) -> Subscriber:
+        self._loop = asyncio.get_running_loop()
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = self._loop.create_task(self._beat())
+        sub = Subscriber(user, expires_at)
+        self.subscribers.add(sub)
+        self._by_user.setdefault(user, set()).add(sub)
+        return sub
+
+    def disconnect(self, sub: Subscriber):
+        for key in list(sub.topics):
+            self.unsubscribe(sub, key)
+        self.subscribers.discard(sub)
+        mine = self._by_user.get(sub.user)
+        if mine is not None:
+            mine.discard(sub)
+            if not mine:
+                del self._by_user[sub.user]
+
+    def subscribe(self, sub: Subscriber, kind: str, key: str, arg: Any):
+        key = f"{kind}:{key}"
+        if key in sub.topics:
+            return
+        if len(sub.topics) >= MAX_TOPICS_PER_SUBSCRIBER:
+            raise ValueError(f"At most {MAX_TOPICS_PER_SUBSCRIBER} topics per connection")
+        topic = self.topics.get(key)
+        if topic is None:
+            topic = self.topics[key] = Topic(key, self.kinds[kind], arg)
+            topic.task = asyncio.get_running_loop().create_task(self._produce(topic))
+        elif topic.records is not None:
+            sub.send("snapshot", topic.snapshot())
+        topic.subscribers.add(sub)
+        sub.topics.add(key)
+
+    def unsubscribe(self, sub: Subscriber, key: str):
+        sub.topics.discard(key)
+        topic = self.topics.get(key)
+        if topic is None:
+            return
+        topic.subscribers.discard(sub)
+        if not topic.subscribers:
+            topic.task.cancel()
+            del self.topics[key]
+
+    def resync(self, sub: Subscriber):
+        """Re-send current snapshots to a subscriber whose queue overflowed"""
+        for key in sub.topics:
+            topic = self.topics.get(key)
+            if topic is not None and topic.records is not None:
+                sub.send("snapshot", topic.snapshot())
+
+    # --- producers ---
+
+    async def _produce(self, topic: Topic):
+        while True:
+            topic.wake.clear()
+            try:
+                records = await run_in_threadpool(topic.kind.fetch, topic.arg)
+            except Exception:
+                self.stats["fetch_errors"] += 1
+                records = None
+            self.stats["fetches"] += 1
+            if records is not None:
+                self._publish(topic, records)
+            try:
+                await asyncio.wait_for(topic.wake.wait(), topic.kind.interval_s)
+            except asyncio.TimeoutError:
+                pass
+
+    def _publish(self, topic: Topic, records: Dict[str, dict]):
+        first = topic.records is None
+        change = diff_records(topic.records, records)
+        topic.records = records
+        if change is None:
+            self.stats["unchanged"] += 1
+            return
+        topic.version += 1
+        typ = "snapshot" if first else "diff"
+        payload = topic.message(typ, change)   # encoded once for every subscriber
+        self.stats["messages"] += 1
+        for sub in topic.subscribers:
+            if sub.send(typ, payload):
+                self.stats["deliveries"] += 1
+            else:
+                self.stats["dropped"] += 1
+
+    def notify_user(self, user: str, event: str, payload: str):
+        """Send one message to every open connection of `user`; callable from any thread"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or user not in self._by_user:
+            return
+        loop.call_soon_threadsafe(self._deliver, user, event, payload)
+
+    def _deliver(self, user: str, event: str, payload: str):
+        for sub in list(self._by_user.get(user, ())):
+            self.stats["notifications"] += 1
+            if sub.send(event, payload):
+                self.stats["deliveries"] += 1
+            else:
+                self.stats["dropped"] += 1
+
+    async def _beat(self):
+        while self.subscribers:
+            await asyncio.sleep(HEARTBEAT_S)
+            for sub in list(self.subscribers):
+                sub.send("ping", "")
+
+    def _data_changed(self, data_topic: str):
+        # Called from whichever thread published the change
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        for topic in list(self.topics.values()):
+            if data_topic in topic.kind.data_topics:
+                loop.call_soon_threadsafe(topic.wake.set)
+
+    def snapshot(self) -> Dict[str, Any]:
+        by_kind: Dict[str, int] = {}
+        for topic in list(self.topics.values()):
+            by_kind[topic.kind.name] = by_kind.get(topic.kind.name, 0) + 1
+        return {"subscribers": len(self.subscribers), "topics": len(self.topics),
+                "topics_by_kind": by_kind, **self.stats}
+
+
+hub = PushHub()
+
+
+def parse_subscription(stops: Optional[List[str]] = None, bbox: Optional[str] = None,
+                       weather: Optional[List[float]] = None, weather_cell_deg: float = 0.02
+                       ) -> List[Tuple[str, str, Any]]:
+    """(kind, key, arg) for each requested topic; raises ValueError on bad input"""
+    subs: List[Tuple[str, str, Any]] = []
+    for stop_id in stops or []:
+        stop_id = stop_id.strip()
+        if stop_id:
+            subs.append(("departures", stop_id, stop_id))
+    if bbox:
+        parts = [float(x) for x in bbox.split(",")]
+        if len(parts) != 4:
+            raise ValueError("bbox must be minLng,minLat,maxLng,maxLat")
+        # Nearby viewports share a producer; its box is rounded outward to
+        # 0.01 degrees so it always covers the viewport
+        lo = [floor(round(x * 100, 6)) / 100 for x in parts[:2]]
+        hi = [ceil(round(x * 100, 6)) / 100 for x in parts[2:]]
+        key = ",".join(f"{x:.2f}" for x in lo + hi)
+        subs.append(("alerts", key, key))
+    if weather:
+        if len(weather) != 2:
+            raise ValueError("weather must be lat,lng")
+        cell = (round(weather[0] / weather_cell_deg), round(weather[1] / weather_cell_deg))
+        subs.append(("weather", f"{cell[0]},{cell[1]}",
+                     (cell[0] * weather_cell_deg, cell[1] * weather_cell_deg)))
+    return subs
@@ -0,0 +1,496 @@
+"""
+GTFS-Realtime Trip Updates for ATIS
+Reads TripUpdates feed snapshots (protobuf) from a file or an injected
+fetcher. Each snapshot is compared to the previous one entity by entity
+on a hash of the raw bytes, and only new or changed entities are decoded. They are
+resolved against the timetable into per-stop delays and stored in an
+overlay keyed by trip_id, which /departures and the router read in O(1).
+Decoding uses a small wire-format reader for the fields ATIS needs, so
+no protobuf runtime is required.
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+from array import array
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+
+from .cache import data_changed
+from .db import add_swap_listener
+
+RT_PATH = os.getenv("ATIS_GTFS_RT_PATH")
+RT_INTERVAL_S = float(os.getenv("ATIS_GTFS_RT_INTERVAL", "30"))
+
+# TripDescriptor / StopTimeUpdate schedule_relationship values
+TRIP_CANCELED = 3
+STOP_SKIPPED = 1
+FEED_DIFFERENTIAL = 1
+
+
+# ---------- Protobuf wire format ----------
+
+def _varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(v: int) -> int:
+    """int32/int64 fields are two's complement varints"""
+    return v - (1 << 64) if v >= 1 << 63 else v
+
+
+def _fields(buf: bytes, pos: int, end: int) -> Iterator[Tuple[int, Any]]:
+    """(field number, value); length-delimited values are (start, end) spans into buf"""
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wt = key & 7
+        if wt == 0:
+            v, pos = _varint(buf, pos)
+        elif wt == 2:
+            n, pos = _varint(buf, pos)
+            v = (pos, pos + n)
+            pos += n
+        elif wt == 1:
+            v = int.from_bytes(buf[pos:pos + 8], "little")
+            pos += 8
+        elif wt == 5:
+            v = int.from_bytes(buf[pos:pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wt}")
+        yield key >> 3, v
+
+
+def _text(buf: bytes, span: Tuple[int, int]) -> str:
+    return buf[span[0]:span[1]].decode("utf-8")
+
+
+def scan_feed(buf: bytes) -> Tuple[Dict[str, Any], List[Tuple[int, int]]]:
+    """FeedMessage header fields and the byte span of every entity, without decoding them"""
+    header: Dict[str, Any] = {"incrementality": 0, "timestamp": None}
+    entities = []
+    for fn, v in _fields(buf, 0, len(buf)):
+        if fn == 2:
+            entities.append(v)
+        elif fn == 1:
+            for hf, hv in _fields(buf, *v):
+                if hf == 2:
+                    header["incrementality"] = hv
+                elif hf == 3:
+                    header["timestamp"] = hv
+    return header, entities
+
+
+def _entity_key(buf: bytes, span: Tuple[int, int]) -> Tuple[str, int]:
+    """
+    Entity id and a hash of its content. Producers often restamp every
+    TripUpdate each cycle, so its timestamp is left out of the hash.
+    """
+    eid = ""
+    parts = []
+    for fn, v in _fields(buf, *span):
+        if fn == 1:
+            eid = _text(buf, v)
+        elif fn == 3:
+            for tf, tv in _fields(buf, *v):
+                if tf != 4:
+                    parts.append(buf[tv[0]:tv[1]] if isinstance(tv, tuple) else tv)
+        else:
+            parts.append(buf[v[0]:v[1]] if isinstance(v, tuple) else v)
+    return eid, hash(tuple(parts))
+
+
+def _stop_time_event(buf: bytes, span) -> Tuple[Optional[int], Optional[int]]:
+    delay = when = None
+    for fn, v in _fields(buf, *span):
+        if fn == 1:
+            delay = _signed(v)
+        elif fn == 2:
+            when = _signed(v)
+    return delay, when
+
+
+def decode_entity(buf: bytes, span: Tuple[int, int]) -> Dict[str, Any]:
+    """The TripUpdate parts of one FeedEntity (trip_update is None for other entity types)"""
+    ent: Dict[str, Any] = {"id": "", "deleted": False, "trip_update": None}
+    for fn, v in _fields(buf, *span):
+        if fn == 1:
+            ent["id"] = _text(buf, v)
+        elif fn == 2:
+            ent["deleted"] = bool(v)
+        elif fn == 3:
+            tu: Dict[str, Any] = {"trip_id": None, "start_date": None, "relationship": 0,
+                                  "delay": None, "timestamp": None, "updates": []}
+            for tf, tv in _fields(buf, *v):
+                if tf == 1:
+                    for df, dv in _fields(buf, *tv):
+                        if df == 1:
+                            tu["trip_id"] = _text(buf, dv)
+                        elif df == 3:
+                            tu["start_date"] = _text(buf, dv)
+                        elif df == 4:
+                            tu["relationship"] = dv
+                elif tf == 2:
+                    # (stop_sequence, stop_id, arrival (delay, time), departure (delay, time), skipped)
+                    seq = stop_id = None
+                    arr = dep = (None, None)
+                    skipped = False
+                    for sf, sv in _fields(buf, *tv):
+                        if sf == 1:
+                            seq = sv
+                        elif sf == 2:
+                            arr = _stop_time_event(buf, sv)
+                        elif sf == 3:
+                            dep = _stop_time_event(buf, sv)
+                        elif sf == 4:
+                            stop_id = _text(buf, sv)
+                        elif sf == 5:
+                            skipped = sv == STOP_SKIPPED
+                    tu["updates"].append((seq, stop_id, arr, dep, skipped))
+                elif tf == 4:
+                    tu["timestamp"] = tv
+                elif tf == 5:
+                    tu["delay"] = _signed(tv)
+            ent["trip_update"] = tu
+    return ent
+
+
+# ---------- Overlay ----------
+
+class TripRealtime:
+    """
+    Realtime state of one trip. For trips in the timetable, arr/dep hold
+    the delay in seconds at every stop of its pattern (propagated
+    downstream from the last update); `delay` is the trip-level fallback.
+    """
+    __slots__ = ("trip_id", "trip", "pattern", "canceled", "delay", "arr", "dep", "skipped", "timestamp")
+
+    def __init__(self, trip_id: str, trip: int = -1, pattern: int = -1, canceled: bool = False,
+                 delay: int = 0, arr: Optional[array] = None, dep: Optional[array] = None,
+                 skipped: Tuple[int, ...] = (), timestamp: Optional[int] = None):
+        self.trip_id = trip_id
+        self.trip = trip
+        self.pattern = pattern
+        self.canceled = canceled
+        self.delay = delay
+        self.arr = arr
+        self.dep = dep
+        self.skipped = skipped
+        self.timestamp = timestamp
+
+    def arrival_delay(self, i: int) -> int:
+        return self.arr[i] if self.arr is not None else self.delay
+
+    def departure_delay(self, i: int) -> int:
+        return self.dep[i] if self.dep is not None else self.delay
+
+
+class RealtimeOverlay:
+    """trip_id -> TripRealtime, plus the timetable indices of cancelled trips"""
+
+    def __init__(self):
+        self.trips: Dict[str, TripRealtime] = {}
+        self.canceled: Set[int] = set()
+        self.version = 0
+        self._lock = threading.Lock()
+        self._running: Optional[Tuple[int, int, bytearray]] = None
+
+    def get(self, trip_id: str) -> Optional[TripRealtime]:
+        return self.trips.get(trip_id)
+
+    def apply(self, upserts: List[TripRealtime], removals: List[str]):
+        with self._lock:
+            for trip_id in removals:
+                old = self.trips.pop(trip_id, None)
+                if old is not None:
+                    self.canceled.discard(old.trip)
+            for rt in upserts:
+                old = self.trips.get(rt.trip_id)
+                if old is not None:
+                    self.canceled.discard(old.trip)
+                self.trips[rt.trip_id] = rt
+                if rt.canceled and rt.trip >= 0:
+                    self.canceled.add(rt.trip)
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self.trips = {}
+            self.canceled = set()
+            self.version += 1
+
+    def running(self, active: bytearray) -> bytearray:
+        """`active` with cancelled trips switched off (cached per service day and version)"""
+        if not self.canceled:
+            return active
+        cached = self._running
+        if cached is not None and cached[0] == id(active) and cached[1] == self.version:
+            return cached[2]
+        with self._lock:
+            version, canceled = self.version, list(self.canceled)
+        masked = bytearray(active)
+        for t in canceled:
+            masked[t] = 0
+        self._running = (id(active), version, masked)
+        return masked
+
+    def stats(self) -> Dict[str, int]:
+        return {"trips": len(self.trips), "canceled": len(self.canceled), "version": self.version}
+
+
+overlay = RealtimeOverlay()
+
+
+def resolve(tt, tu: Dict[str, Any], tz=None, feed_ts: Optional[int] = None) -> TripRealtime:
+    """Turn a decoded TripUpdate into per-stop delays along its timetable pattern"""
+    trip_id = tu["trip_id"]
+    canceled = tu["relationship"] == TRIP_CANCELED
+    base = tu["delay"] or 0
+    t = tt.trip_pos.get(trip_id, -1)
+    p = tt.trip_pattern[t] if t >= 0 else -1
+    if p < 0:
+        # Added or unknown trip: keep a trip-level delay only
+        first = next((a for _, _, (a, _), _, _ in tu["updates"] if a is not None), None)
+        return TripRealtime(trip_id, t, -1, canceled, base if tu["delay"] is not None else (first or 0),
+                            timestamp=tu["timestamp"])
+
+    stops, seqs = tt.pat_stops[p], tt.pat_seq[p]
+    nt, col = len(tt.pat_trips[p]), tt.trip_col[t]
+    m = len(stops)
+    arr: List[Optional[int]] = [None] * m
+    dep: List[Optional[int]] = [None] * m
+    skipped = []
+    midnight = None
+    pos = 0
+    for seq, stop_id, (a_delay, a_time), (d_delay, d_time), skip in tu["updates"]:
+        i = _match(tt, stops, seqs, pos, seq, stop_id)
+        if i is None:
+            continue
+        pos = i
+        if (a_delay is None and a_time is not None) or (d_delay is None and d_time is not None):
+            if midnight is None:
+                midnight = _service_midnight(tu["start_date"], feed_ts, tz)
+            if a_delay is None and a_time is not None:
+                a_delay = a_time - midnight - tt.pat_arr[p][i * nt + col]
+            if d_delay is None and d_time is not None:
+                d_delay = d_time - midnight - tt.pat_dep[p][i * nt + col]
+        arr[i], dep[i] = a_delay, d_delay
+        if skip:
+            skipped.append(i)
+
+    # Delays carry downstream until the next update
+    cur = base
+    for i in range(m):
+        a = arr[i] if arr[i] is not None else (dep[i] if dep[i] is not None else cur)
+        d = dep[i] if dep[i] is not None else a
+        arr[i], dep[i] = a, d
+        cur = d
+    return TripRealtime(trip_id, t, p, canceled, base, array("i", arr), array("i", dep),
+                        tuple(skipped), tu["timestamp"])
+
+
+def _match(tt, stops, seqs, pos: int, seq: Optional[int], stop_id: Optional[str]) -> Optional[int]:
+    """Pattern index of a stop time update at or after `pos`"""
+    if seq is not None:
+        for i in range(pos, len(seqs)):
+            if seqs[i] == seq:
+                return i
+    if stop_id is not None:
+        s = tt.stop_pos.get(stop_id)
+        if s is not None:
+            for i in range(pos, len(stops)):
+                if stops[i] == s:
+                    return i
+    return None
+
+
+def _service_midnight(start_date: Optional[str], feed_ts: Optional[int], tz) -> int:
+    """Epoch seconds of the service day's local midnight (for absolute stop times)"""
+    if start_date:
+        day = datetime.strptime(start_date, "%Y%m%d")
+        day = day.replace(tzinfo=tz) if tz else day
+    else:
+        now = datetime.fromtimestamp(feed_ts or time.time(), tz)
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    # GTFS times count from noon minus 12 h, which differs from midnight on DST change days
+    return int(day.replace(hour=12).timestamp()) - 12 * 3600
+
+
+# ---------- Ingestion ----------
+
+class TripUpdatesFeed:
+    """
+    Polls a TripUpdates snapshot and applies the difference to the overlay.
+    `source` is a file path or a callable returning the feed bytes.
+    """
+
+    def __init__(self, source: Union[str, Callable[[], bytes]], timetable: Callable[[], Any],
+                 target: RealtimeOverlay = overlay, tz=None):
+        self.source = source
+        self.timetable = timetable
+        self.overlay = target
+        self.tz = tz
+        self._seen: Dict[str, Tuple[int, Optional[str]]] = {}   # entity id -> (bytes hash, trip_id)
+        self._tt = None
+        self.last: Dict[str, Any] = {}
+        self.stats = {"polls": 0, "errors": 0, "entities_decoded": 0, "entities_skipped": 0}
+        add_swap_listener(self.reset)
+
+    def reset(self):
+        """Forget the previous snapshot so the next poll re-applies everything"""
+        self._seen = {}
+        self._tt = None
+        self.overlay.clear()
+
+    def _read(self) -> bytes:
+        if callable(self.source):
+            return self.source()
+        with open(self.source, "rb") as f:
+            return f.read()
+
+    def poll(self) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        buf = self._read()
+        t1 = time.perf_counter()
+        tt = self.timetable()
+        if tt is not self._tt:
+            self.reset()
+            self._tt = tt
+        header, spans = scan_feed(buf)
+        differential = header["incrementality"] == FEED_DIFFERENTIAL
+
+        seen = dict(self._seen) if differential else {}
+        upserts: List[TripRealtime] = []
+        removals: List[str] = []
+        decode_s = 0.0
+        for span in spans:
+            eid, h = _entity_key(buf, span)
+            prev = self._seen.get(eid)
+            if prev is not None and prev[0] == h:
+                seen[eid] = prev
+                continue
+            d0 = time.perf_counter()
+            ent = decode_entity(buf, span)
+            tu = ent["trip_update"]
+            if ent["deleted"]:
+                seen.pop(eid, None)
+                if prev is not None and prev[1]:
+                    removals.append(prev[1])
+            elif tu is not None and tu["trip_id"]:
+                if prev is not None and prev[1] and prev[1] != tu["trip_id"]:
+                    removals.append(prev[1])
+                upserts.append(resolve(tt, tu, self.tz, header["timestamp"]))
+                seen[eid] = (h, tu["trip_id"])
+            else:
+                seen[eid] = (h, None)
+            decode_s += time.perf_counter() - d0
+        t2 = time.perf_counter()
+        if not differential:
+            removals += [tid for eid, (_, tid) in self._seen.items() if tid and eid not in seen]
+        self._seen = seen
+        if upserts or removals:
+            self.overlay.apply(upserts, removals)
+            data_changed("realtime")
+        t3 = time.perf_counter()
+
+        self.stats["polls"] += 1
+        self.stats["entities_decoded"] += len(upserts)
+        self.stats["entities_skipped"] += len(spans) - len(upserts)
+        self.last = {
+            "bytes": len(buf), "entities": len(spans), "changed": len(upserts), "removed": len(removals),
+            "feed_timestamp": header["timestamp"],
+            "read_ms": round((t1 - t0) * 1000, 2),
+            "diff_ms": round((t2 - t1 - decode_s) * 1000, 2),
+            "decode_ms": round(decode_s * 1000, 2),
+            "apply_ms": round((t3 - t2) * 1000, 2),
+        }
+        return self.last
+
+
+_feed: Optional[TripUpdatesFeed] = None
+
+
+def start_realtime(timetable: Callable[[], Any], source: Union[str, Callable[[], bytes], None] = None,
+                   interval_s: float = RT_INTERVAL_S, tz=None) -> Optional[TripUpdatesFeed]:
+    """Poll `source` (default ATIS_GTFS_RT_PATH) in a daemon thread; None if unconfigured"""
+    global _feed
+    source = source or RT_PATH
+    if not source:
+        return None
+    feed = _feed = TripUpdatesFeed(source, timetable, tz=tz)
+
+    def loop():
+        while True:
+            try:
+                feed.poll()
+            except Exception as e:
+                feed.stats["errors"] += 1
+                print(f"GTFS-Realtime poll failed: {e}")
+            time.sleep(interval_s)
+
+    threading.Thread(target=loop, name="gtfs-rt", daemon=True).start()
+    return feed
+
+
+def realtime_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {"overlay": overlay.stats()}
+    if _feed is not None:
+        out.update(_feed.stats)
+        out["last_poll"] = _feed.last
+    return out
+
+
+# ---------- Departure boards ----------
+
+def departure_board(tt, stop_id: str, now: datetime, limit: int = 10) -> List[Dict[str, Any]]:
+    """Next departures at a stop from the timetable, with realtime delays applied"""
+    s = tt.stop_pos[stop_id]
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    secs = int((now - day_start).total_seconds())
+    active = tt.active_trips(now.date())
+    # Look back a little so late-running trips still show. A busy stop can have
+    # more than `want` departures in that half hour, all gone: fetch more until
+    # `limit` are still to come or the day runs out
+    want = limit * 3
+    while True:
+        scheduled = tt.departures_at(s, secs - 1800, active, want)
+        board = _board_rows(tt, scheduled, day_start, secs)
+        if len(board) >= limit or len(scheduled) < want:
+            break
+        want *= 4
+    board.sort(key=lambda d: d["departure_time"])
+    return board[:limit]
+
+
+def _board_rows(tt, scheduled, day_start: datetime, secs: int) -> List[Dict[str, Any]]:
+    """Board entries for scheduled departures still to come once delays are applied"""
+    board = []
+    for sched, p, i, j in scheduled:
+        t = tt.pat_trips[p][j]
+        trip_id = tt.trip_ids[t]
+        rt = overlay.get(trip_id)
+        delay = rt.departure_delay(i) if rt is not None else 0
+        expected = sched + delay
+        if expected < secs:
+            continue
+        route = tt.pat_route[p]
+        board.append({
+            "route": tt.route_short[route],
+            "headsign": tt.trip_headsign[t],
+            "departure_time": (day_start + timedelta(seconds=expected)).isoformat(),
+            "scheduled_time": (day_start + timedelta(seconds=sched)).isoformat(),
+            "departure_in_min": (expected - secs) // 60,
+            "delay_min": round(delay / 60),
+            "mode": tt.pat_mode[p],
+            "realtime": rt is not None,
+            "canceled": bool(rt is not None and (rt.canceled or i in rt.skipped)),
+            "trip_id": trip_id,
+        })
+    return board
@@ -0,0 +1,350 @@
+"""
+Incident Matching and Reroute Watches for ATIS
+Matches incidents to itineraries by key instead of scanning either side.
+An itinerary is reduced to the routes it rides and the incident-grid
+cells its road legs (bus, car, bike) pass through; an incident lists the
+same kinds of keys (affected_routes, the cells of its geometry), so
+/routes/suggest asks the incident store for just the incidents sharing a
+key. suggest_reroute re-plans an affected trip between the same stops
+without the disrupted routes.
+
+WatchList keeps users' saved and active itineraries in inverted indexes
+from route and cell to watch. When the incident store reports new or
+changed incidents, only the watches sharing a key are re-evaluated, and
+their owners are notified over the push hub.
+"""
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from math import ceil, hypot
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from .encoding import dumps
+from .incidents import INCIDENT_CELL_DEG, extent, grid_cells, parse_time, route_key
+from .store import plan_itineraries
+
+# Modes that share the road with traffic incidents; rail and ferry legs
+# only match incidents that name their route
+ROAD_MODES = {"bus", "car", "rideshare", "taxi", "bike", "replacement bus"}
+
+MAX_WATCHES_PER_USER = int(os.getenv("ATIS_WATCHES_PER_USER", "20"))
+# Active (unsaved) itineraries are watched until arrival plus this grace,
+# or for the fallback TTL when the itinerary has no arrival time
+WATCH_GRACE_S = float(os.getenv("ATIS_WATCH_GRACE_S", "1800"))
+WATCH_TTL_S = float(os.getenv("ATIS_WATCH_TTL_S", "86400"))
+
+Coords = Callable[[str], Optional[Tuple[float, float]]]
+Cell = Tuple[int, int]
+
+
+def itinerary_routes(itinerary: Dict[str, Any]) -> Set[str]:
+    """route_key of every ride leg, from leg_details or labels like "Bus NX1" """
+    details = itinerary.get("leg_details")
+    if details:
+        return {route_key(d["route"]) for d in details if d.get("mode") != "walk" and d.get("route")}
+    routes = set()
+    for label in itinerary.get("legs") or ():
+        mode, _, route = str(label).partition(" ")
+        if route and mode.lower() not in ("walk", "bike"):
+            routes.add(route_key(route))
+    return routes
+
+
+def _segment_cells(a: Tuple[float, float], b: Tuple[float, float], cell_deg: float) -> Set[Cell]:
+    """Cells along the straight line between two (lat, lng) points, sampled at half a cell"""
+    steps = max(1, ceil(hypot(b[0] - a[0], b[1] - a[1]) / (cell_deg / 2)))
+    cells = set()
+    for i in range(steps + 1):
+        t = i / steps
+        lat, lng = a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t
+        cells.add((int(lng // cell_deg), int(lat // cell_deg)))
+    return cells
+
+
+def itinerary_cells(itinerary: Dict[str, Any], coords: Optional[Coords],
+                    cell_deg: float = INCIDENT_CELL_DEG) -> Set[Cell]:
+    """Incident-grid cells crossed by the road legs whose stops `coords` can place"""
+    cells: Set[Cell] = set()
+    if coords is None:
+        return cells
+    for d in itinerary.get("leg_details") or ():
+        if d.get("mode") not in ROAD_MODES:
+            continue
+        a, b = coords(d.get("from_stop_id")), coords(d.get("to_stop_id"))
+        if a is not None and b is not None:
+            cells |= _segment_cells(a, b, cell_deg)
+    return cells
+
+
+def incident_cells(record: Dict[str, Any], cell_deg: float = INCIDENT_CELL_DEG) -> List[Cell]:
+    box = extent(record)
+    return (grid_cells(box, cell_deg) or []) if box is not None else []
+
+
+def affecting(itinerary: Dict[str, Any], incidents: Iterable[Dict[str, Any]],
+              coords: Optional[Coords] = None) -> List[Dict[str, Any]]:
+    """The incidents in a (short) list that name one of the itinerary's routes or lie on a road leg"""
+    routes = itinerary_routes(itinerary)
+    cells = itinerary_cells(itinerary, coords)
+    return [inc for inc in incidents
+            if routes.intersection(route_key(r) for r in inc.get("affected_routes") or ())
+            or cells.intersection(incident_cells(inc))]
+
+
+# ---------- Re-planning ----------
+
+def _serious(incident: Dict[str, Any]) -> bool:
+    return incident.get("severity") == "high" or (incident.get("expected_delay_min") or 0) >= 10
+
+
+def _road_routes(itinerary: Dict[str, Any]) -> Set[str]:
+    details = itinerary.get("leg_details")
+    if details:
+        return {route_key(d["route"]) for d in details if d.get("mode") in ROAD_MODES and d.get("route")}
+    routes = set()
+    for label in itinerary.get("legs") or ():
+        mode, _, route = str(label).partition(" ")
+        if route and mode.lower() in ROAD_MODES:
+            routes.add(route_key(route))
+    return routes
+
+
+def disrupted_routes(itinerary: Dict[str, Any], incidents: Iterable[Dict[str, Any]]) -> Set[str]:
+    """
+    Routes a re-plan must not ride: every route the incidents name and,
+    for an incident that names none of the itinerary's routes (matched on
+    the road), the itinerary's own road-leg routes
+    """
+    own = itinerary_routes(itinerary)
+    avoid: Set[str] = set()
+    for inc in incidents:
+        named = {route_key(r) for r in inc.get("affected_routes") or ()}
+        avoid |= named
+        if not named & own:
+            avoid |= _road_routes(itinerary)
+    return avoid
+
+
+def _endpoints(itinerary: Dict[str, Any], coords: Optional[Coords]):
+    """Where the itinerary boards its first vehicle and leaves its last one"""
+    rides = [d for d in itinerary.get("leg_details") or () if d.get("mode") != "walk"]
+    if not rides or coords is None:
+        return None, None
+    return coords(rides[0].get("from_stop_id")), coords(rides[-1].get("to_stop_id"))
+
+
+def suggest_reroute(itinerary: Dict[str, Any], incidents: Iterable[Dict[str, Any]],
+                    coords: Optional[Coords] = None, origin=None, destination=None,
+                    memo: Optional[Dict[Any, List[Dict[str, Any]]]] = None) -> Dict[str, Any]:
+    """
+    `incidents` are the ones already matched to this itinerary. When a
+    serious one (high severity or 10+ minutes of delay) disrupts a route
+    the itinerary rides, the trip is planned again from origin to
+    destination (default: its first boarding and last alighting stop)
+    without the disrupted routes. `memo` shares plans between watches
+    re-evaluated for the same incident.
+    """
+    serious = [i for i in incidents if _serious(i)]
+    avoid = disrupted_routes(itinerary, serious)
+    if not avoid & itinerary_routes(itinerary):
+        return {"note": "Current route ok"}
+    ids = [i.get("id") for i in serious]
+    if origin is None or destination is None:
+        start, end = _endpoints(itinerary, coords)
+        origin, destination = origin or start, destination or end
+    if origin is None or destination is None:
+        return {"note": "No alternative found", "avoids": ids}
+
+    depart_at = "now"
+    try:
+        if (parse_time(itinerary.get("departure")) or 0) > time.time():
+            depart_at = itinerary["departure"]
+    except ValueError:
+        pass
+    key = (tuple(origin), tuple(destination), depart_at, frozenset(avoid))
+    options = memo.get(key) if memo is not None else None
+    if options is None:
+        options = [o for o in plan_itineraries(origin, destination, depart_at, avoid_routes=sorted(avoid))
+                   if not itinerary_routes(o) & avoid]
+        if memo is not None:
+            memo[key] = options
+    if not options:
+        return {"note": "No alternative avoiding the incident", "avoids": ids}
+    return {**options[0], "note": "Avoids incident area", "avoids": ids}
+
+
+# ---------- Watches ----------
+
+class Watch:
+    __slots__ = ("key", "user", "id", "itinerary", "routes", "cells", "until", "seen", "status")
+
+    def __init__(self, user: str, watch_id: str, itinerary: Dict[str, Any], routes: Set[str],
+                 cells: Set[Cell], until: Optional[float]):
+        self.key = (user, watch_id)
+        self.user = user
+        self.id = watch_id
+        self.itinerary = itinerary
+        self.routes = routes
+        self.cells = cells
+        self.until = until
+        self.seen: Dict[str, Dict[str, Any]] = {}   # incident id -> record last notified
+        self.status: Optional[Dict[str, Any]] = None
+
+    def describe(self) -> Dict[str, Any]:
+        return {"id": self.id, "routes": sorted(self.routes), "cells": len(self.cells),
+                "until": self.until, "notified": sorted(self.seen), "status": self.status}
+
+
+class WatchList:
+    """
+    Users' saved and active itineraries, indexed by route and road cell.
+    `notify(user, event, payload)` is called with each reroute message.
+    """
+
+    def __init__(self, coords: Optional[Coords] = None,
+                 notify: Optional[Callable[[str, str, str], None]] = None,
+                 cell_deg: float = INCIDENT_CELL_DEG, max_per_user: int = MAX_WATCHES_PER_USER,
+                 clock: Callable[[], float] = time.time):
+        self.coords = coords
+        self.notify = notify
+        self.cell_deg = cell_deg
+        self.max_per_user = max_per_user
+        self.clock = clock
+        self._watches: Dict[Tuple[str, str], Watch] = {}
+        self._by_user: Dict[str, Dict[str, Watch]] = {}
+        self._by_route: Dict[str, Set[Tuple[str, str]]] = {}
+        self._by_cell: Dict[Cell, Set[Tuple[str, str]]] = {}
+        self._ends: List[Tuple[float, int, Tuple[str, str]]] = []
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self.stats = {"watched": 0, "unwatched": 0, "expired": 0, "incidents": 0,
+                      "evaluated": 0, "notified": 0}
+
+    def __len__(self):
+        return len(self._watches)
+
+    # Index maintenance; callers hold the lock
+
+    def _index(self, w: Watch):
+        for route in w.routes:
+            self._by_route.setdefault(route, set()).add(w.key)
+        for cell in w.cells:
+            self._by_cell.setdefault(cell, set()).add(w.key)
+
+    def _unindex(self, key: Tuple[str, str]) -> Optional[Watch]:
+        w = self._watches.pop(key, None)
+        if w is None:
+            return None
+        del self._by_user[w.user][w.id]
+        if not self._by_user[w.user]:
+            del self._by_user[w.user]
+        for index, keys in ((self._by_route, w.routes), (self._by_cell, w.cells)):
+            for k in keys:
+                members = index[k]
+                members.discard(key)
+                if not members:
+                    del index[k]
+        return w
+
+    def _expire(self, now: float):
+        while self._ends and self._ends[0][0] < now:
+            until, _, key = heapq.heappop(self._ends)
+            w = self._watches.get(key)
+            if w is not None and w.until == until:
+                self._unindex(key)
+                self.stats["expired"] += 1
+
+    # API
+
+    def watch(self, user: str, itinerary: Dict[str, Any], watch_id: Optional[str] = None,
+              saved: bool = False) -> Watch:
+        """Start (or replace) a watch; raises ValueError past max_per_user"""
+        now = self.clock()
+        watch_id = str(watch_id or itinerary.get("id") or f"w{next(self._seq)}")
+        until = None
+        if not saved:
+            try:
+                arrival = parse_time(itinerary.get("arrival"))
+            except ValueError:
+                arrival = None
+            until = arrival + WATCH_GRACE_S if arrival is not None else now + WATCH_TTL_S
+        w = Watch(user, watch_id, itinerary, itinerary_routes(itinerary),
+                  itinerary_cells(itinerary, self.coords, self.cell_deg), until)
+        with self._lock:
+            self._expire(now)
+            mine = self._by_user.get(user, {})
+            if watch_id not in mine and len(mine) >= self.max_per_user:
+                raise ValueError(f"At most {self.max_per_user} watched itineraries per user")
+            self._unindex(w.key)
+            self._watches[w.key] = w
+            self._by_user.setdefault(user, {})[watch_id] = w
+            self._index(w)
+            if until is not None:
+                heapq.heappush(self._ends, (until, next(self._seq), w.key))
+            self.stats["watched"] += 1
+        return w
+
+    def acknowledge(self, w: Watch, records: Iterable[Dict[str, Any]]):
+        """Incidents the user has already been shown for this watch; not notified again unless they change"""
+        for rec in records:
+            w.seen[str(rec.get("id"))] = rec
+
+    def unwatch(self, user: str, watch_id: str) -> bool:
+        with self._lock:
+            found = self._unindex((user, watch_id)) is not None
+            self.stats["unwatched"] += found
+        return found
+
+    def for_user(self, user: str) -> List[Watch]:
+        with self._lock:
+            self._expire(self.clock())
+            return list(self._by_user.get(user, {}).values())
+
+    def affected_by(self, record: Dict[str, Any]) -> List[Watch]:
+        """Watches sharing a route or road cell with an incident"""
+        keys: Set[Tuple[str, str]] = set()
+        with self._lock:
+            for r in record.get("affected_routes") or ():
+                members = self._by_route.get(route_key(r))
+                if members:
+                    keys |= members
+            for cell in incident_cells(record, self.cell_deg):
+                members = self._by_cell.get(cell)
+                if members:
+                    keys |= members
+            return [self._watches[k] for k in keys]
+
+    def on_incidents(self, changes: List[Tuple[str, Dict[str, Any]]]):
+        """Incident store listener: re-evaluate the watches each new or changed incident touches"""
+        with self._lock:
+            self._expire(self.clock())
+        now = int(self.clock())
+        memo: Dict[Any, List[Dict[str, Any]]] = {}
+        for source, record in changes:
+            self.stats["incidents"] += 1
+            iid = str(record.get("id"))
+            incident_json = None
+            for w in self.affected_by(record):
+                if w.seen.get(iid) == record:
+                    continue
+                w.seen[iid] = record
+                self.stats["evaluated"] += 1
+                suggestion = suggest_reroute(w.itinerary, [record], self.coords, memo=memo)
+                w.status = {"incident": iid, "source": source, "severity": record.get("severity"),
+                            "at": now, **suggestion}
+                if self.notify is not None:
+                    # The incident is encoded once and spliced into every watcher's message
+                    if incident_json is None:
+                        incident_json = dumps(record).decode()
+                    payload = (f'{{"type":"reroute","watch":{dumps(w.id).decode()},"incident":{incident_json},'
+                               f'"suggestion":{dumps(suggestion).decode()}}}')
+                    self.notify(w.user, "reroute", payload)
+                    self.stats["notified"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"watches": len(self._watches), "users": len(self._by_user),
+                    "routes": len(self._by_route), "cells": len(self._by_cell), **self.stats}
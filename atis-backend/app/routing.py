@@ -0,0 +1,832 @@
+"""
+Timetable Routing (RAPTOR) for ATIS
+Round-based public transit routing over the imported GTFS timetable.
+Each round k finds the earliest arrival at every stop using at most k
+vehicles, so a single query yields the Pareto set of (arrival, transfers).
+Arrive-by queries run the same rounds backwards in time.
+
+Trips are grouped into patterns (same route, same stop sequence, no
+overtaking); a pattern's stop times live in flat stop-major int arrays so a
+trip lookup is a bisect over one row.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from itertools import groupby
+import os
+import threading
+
+from .db import connection, add_swap_listener, haversine
+from .incidents import route_key
+from .footpaths import FootpathGraph, load_footpaths, walk_seconds, WALK_DETOUR
+from .realtime import overlay
+from .spatial import get_stop_index
+
+try:
+    from zoneinfo import ZoneInfo
+    LOCAL_TZ = ZoneInfo(os.getenv("ATIS_TIMEZONE", "Pacific/Auckland"))
+except Exception:  # no tz database available (e.g. Windows without tzdata)
+    LOCAL_TZ = None
+
+INF = float("inf")
+MAX_ROUNDS = 5                 # vehicles per journey (4 transfers)
+MAX_TRIP_S = 3 * 3600          # search horizon after departure
+MIN_CHANGE_S = 60              # slack when changing vehicles at a stop
+ACCESS_STOPS = 12              # nearest stops considered at each end
+
+# GTFS route_type (basic + extended) to ATIS mode
+def route_mode(route_type: Optional[int]) -> str:
+    t = route_type if route_type is not None else 3
+    if t in (0, 1, 2, 5, 7, 12) or 100 <= t < 200 or 400 <= t < 500 or 900 <= t < 1000:
+        return "train"
+    if t == 4 or 1000 <= t < 1300:
+        return "ferry"
+    return "bus"
+
+# Typical on-time share per mode, used for the itinerary reliability figure
+MODE_RELIABILITY = {"train": 0.92, "ferry": 0.88, "bus": 0.84}
+
+
+class Timetable:
+    """
+    Array-backed timetable.
+    Pattern p serves stops pat_stops[p]; its arrival/departure times are
+    stored stop-major, so the times of all n trips at the i-th stop are
+    pat_dep[p][i*n:(i+1)*n], sorted by departure.
+    """
+
+    def __init__(self):
+        self.stop_ids: List[str] = []
+        self.stop_names: List[str] = []
+        self.stop_lats: List[float] = []
+        self.stop_lons: List[float] = []
+        self.stop_pos: Dict[str, int] = {}
+
+        self.route_short: List[str] = []
+        self.route_mode: List[str] = []
+
+        self.trip_ids: List[str] = []
+        self.trip_pos: Dict[str, int] = {}
+        self.trip_headsign: List[str] = []
+        self.trip_service = array("i")
+        # Where each trip sits: pattern and column within it (-1 if unused)
+        self.trip_pattern = array("i")
+        self.trip_col = array("i")
+        self.service_ids: List[str] = []
+
+        self.pat_route = array("i")
+        self.pat_mode: List[str] = []
+        self.pat_stops: List[array] = []
+        self.pat_trips: List[array] = []
+        self.pat_arr: List[array] = []
+        self.pat_dep: List[array] = []
+        self.pat_seq: List[array] = []     # GTFS stop_sequence per stop, from the first trip
+        self.stop_patterns: List[List[Tuple[int, int]]] = []
+
+        # Walking transfers between stops (CSR, same stop order)
+        self.footpaths: Optional[FootpathGraph] = None
+
+        self._calendar: Dict[str, Tuple[Tuple[int, ...], str, str]] = {}
+        self._calendar_dates: Dict[str, Dict[str, int]] = {}
+        self._active_cache: "OrderedDict[date, bytearray]" = OrderedDict()
+        self._active_lock = threading.Lock()
+
+    @property
+    def n_stop_times(self) -> int:
+        return sum(len(a) for a in self.pat_dep)
+
+    # ---------- Loading ----------
+
+    @classmethod
+    def from_db(cls) -> "Timetable":
+        tt = cls()
+        # Same stop order as the spatial index, so the footpath graph built
+        # from it lines up with the timetable's stop numbers
+        index = get_stop_index()
+        tt.stop_ids = list(index.stop_ids)
+        tt.stop_names = [name or sid for sid, name in zip(index.stop_ids, index.names)]
+        tt.stop_lats, tt.stop_lons = index.lats, index.lons
+        tt.stop_pos = {sid: i for i, sid in enumerate(tt.stop_ids)}
+        with connection() as con:
+            route_pos = {}
+            for rid, short, long_name, rtype in con.execute(
+                    "SELECT route_id, short_name, long_name, route_type FROM routes"):
+                route_pos[rid] = len(tt.route_short)
+                tt.route_short.append(short or long_name or rid)
+                tt.route_mode.append(route_mode(rtype))
+
+            service_pos = {}
+            trip_route = {}
+            for tid, rid, service, headsign in con.execute(
+                    "SELECT trip_id, route_id, service_id, headsign FROM trips"):
+                if rid not in route_pos:
+                    continue
+                if service not in service_pos:
+                    service_pos[service] = len(tt.service_ids)
+                    tt.service_ids.append(service)
+                trip_route[tid] = (len(tt.trip_ids), route_pos[rid])
+                tt.trip_pos[tid] = len(tt.trip_ids)
+                tt.trip_ids.append(tid)
+                tt.trip_headsign.append(headsign or "")
+                tt.trip_service.append(service_pos[service])
+
+            tt._load_calendar(con)
+
+            # (route, stop sequence) -> [(first departure, trip, arr, dep, stop_sequence)]
+            groups: Dict[Tuple[int, Tuple[int, ...]], List] = {}
+            rows = con.execute("SELECT trip_id, stop_id, arrival, departure, stop_sequence FROM stop_times "
+                               "ORDER BY trip_id, stop_sequence")
+            stop_pos = tt.stop_pos
+            for tid, trip_rows in groupby(rows, key=lambda r: r[0]):
+                if tid not in trip_route:
+                    continue
+                trip, route = trip_route[tid]
+                stops, arr, dep, seq = [], [], [], []
+                for _, sid, a, d, q in trip_rows:
+                    s = stop_pos.get(sid)
+                    if s is None:
+                        continue
+                    stops.append(s)
+                    arr.append(a if a is not None else d)
+                    dep.append(d if d is not None else a)
+                    seq.append(q)
+                if len(stops) < 2 or not _interpolate(arr, dep):
+                    continue
+                groups.setdefault((route, tuple(stops)), []).append((dep[0], trip, arr, dep, seq))
+
+        tt._build_patterns(groups)
+        tt.footpaths = load_footpaths(index)
+        return tt
+
+    def _load_calendar(self, con):
+        try:
+            for row in con.execute("SELECT service_id, monday, tuesday, wednesday, thursday, "
+                                   "friday, saturday, sunday, start_date, end_date FROM calendar"):
+                self._calendar[row[0]] = (tuple(row[1:8]), row[8], row[9])
+            for service, day, kind in con.execute(
+                    "SELECT service_id, date, exception_type FROM calendar_dates"):
+                self._calendar_dates.setdefault(day, {})[service] = kind
+        except Exception:
+            # Older databases without calendar tables: every trip runs daily
+            self._calendar, self._calendar_dates = {}, {}
+
+    def _build_patterns(self, groups):
+        n_stops = len(self.stop_ids)
+        self.stop_patterns = [[] for _ in range(n_stops)]
+        self.trip_pattern = array("i", [-1]) * len(self.trip_ids)
+        self.trip_col = array("i", [-1]) * len(self.trip_ids)
+        for (route, stops), trips in groups.items():
+            trips.sort(key=lambda t: t[0])
+            # Split into FIFO sub-patterns so each stop's times stay sorted
+            subs: List[List] = []
+            for t in trips:
+                for sub in subs:
+                    last = sub[-1]
+                    if all(a >= b for a, b in zip(t[3], last[3])) and \
+                            all(a >= b for a, b in zip(t[2], last[2])):
+                        sub.append(t)
+                        break
+                else:
+                    subs.append([t])
+            for sub in subs:
+                p = len(self.pat_stops)
+                n = len(sub)
+                arr = array("i", bytes(4 * n * len(stops)))
+                dep = array("i", bytes(4 * n * len(stops)))
+                for j, (_, trip, a_times, d_times, _) in enumerate(sub):
+                    self.trip_pattern[trip] = p
+                    self.trip_col[trip] = j
+                    for i in range(len(stops)):
+                        arr[i * n + j] = a_times[i]
+                        dep[i * n + j] = d_times[i]
+                self.pat_route.append(route)
+                self.pat_mode.append(self.route_mode[route])
+                self.pat_stops.append(array("i", stops))
+                self.pat_trips.append(array("i", (t[1] for t in sub)))
+                self.pat_arr.append(arr)
+                self.pat_dep.append(dep)
+                self.pat_seq.append(array("i", sub[0][4]))
+                for i, s in enumerate(stops):
+                    self.stop_patterns[s].append((p, i))
+
+    # ---------- Service days ----------
+
+    def active_trips(self, day: date) -> bytearray:
+        """1 for every trip running on `day` (calendar + calendar_dates)"""
+        with self._active_lock:
+            cached = self._active_cache.get(day)
+            if cached is not None:
+                self._active_cache.move_to_end(day)
+                return cached
+        ymd = day.strftime("%Y%m%d")
+        weekday = day.weekday()
+        exceptions = self._calendar_dates.get(ymd, {})
+        running = []
+        for service in self.service_ids:
+            kind = exceptions.get(service)
+            if kind is not None:
+                running.append(kind == 1)
+                continue
+            cal = self._calendar.get(service)
+            if cal is None:
+                running.append(not self._calendar)
+                continue
+            days, start, end = cal
+            running.append(bool(days[weekday]) and start <= ymd <= end)
+        active = bytearray(running[s] for s in self.trip_service)
+        with self._active_lock:
+            self._active_cache[day] = active
+            while len(self._active_cache) > 4:
+                self._active_cache.popitem(last=False)
+        return active
+
+    def departures_at(self, s: int, secs: int, active: bytearray, limit: int = 10
+                      ) -> List[Tuple[int, int, int, int]]:
+        """Next `limit` scheduled departures from stop s as (time, pattern, index, trip column)"""
+        out = []
+        for p, i in self.stop_patterns[s]:
+            if i == len(self.pat_stops[p]) - 1:
+                continue   # terminus: arrivals only
+            trips, dep = self.pat_trips[p], self.pat_dep[p]
+            nt = len(trips)
+            lo = i * nt
+            found = 0
+            for j in range(bisect_left(dep, secs, lo, lo + nt) - lo, nt):
+                if active[trips[j]]:
+                    out.append((dep[lo + j], p, i, j))
+                    found += 1
+                    if found == limit:
+                        break
+        out.sort()
+        return out[:limit]
+
+    # ---------- Access / egress ----------
+
+    def nearby(self, lat: float, lng: float, max_walk_m: float) -> List[Tuple[int, int, float]]:
+        """[(stop, walk seconds, metres)] for the nearest stops within walking range"""
+        out = []
+        for hit in get_stop_index().nearest(lat, lng, ACCESS_STOPS, max_radius=max_walk_m):
+            s = self.stop_pos.get(hit["stop_id"])
+            if s is not None:
+                out.append((s, walk_seconds(hit["distance_m"]), hit["distance_m"]))
+        return out
+
+    # ---------- Search ----------
+
+    def _allowed_patterns(self, modes, avoid_routes=None) -> Optional[bytearray]:
+        if not modes and not avoid_routes:
+            return None
+        allowed = set(modes) if modes else None
+        avoid = {route_key(r) for r in avoid_routes or ()}
+        return bytearray((allowed is None or m in allowed) and route_key(self.route_short[r]) not in avoid
+                         for m, r in zip(self.pat_mode, self.pat_route))
+
+    def earliest_arrival(self, access, egress, depart: int, active: bytearray,
+                         modes=None, max_walk_m: Optional[float] = None,
+                         max_rounds: int = MAX_ROUNDS):
+        """
+        Forward RAPTOR from `depart` (seconds after service-day midnight).
+        access/egress: [(stop, walk seconds, metres)]; transfer walks are
+        capped at max_walk_m.
+        Returns [(arrival, journey legs)], Pareto-optimal in
+        (arrival, vehicles), fewest vehicles first.
+        """
+        return self.earliest_arrival_many(access, [egress], depart, active, modes,
+                                          max_walk_m, max_rounds)[0]
+
+    def earliest_arrival_many(self, access, egresses, depart: int, active: bytearray,
+                              modes=None, max_walk_m: Optional[float] = None,
+                              max_rounds: int = MAX_ROUNDS, avoid_routes=None):
+        """
+        One forward search serving several destinations (one egress list
+        each). Pruning stops at the slowest destination's best arrival, so
+        the result for every destination is the same as a search of its own.
+        Patterns of routes named in avoid_routes are never boarded.
+        """
+        return self._forward(access, egresses, depart, active, modes, max_walk_m, max_rounds,
+                             avoid_routes=avoid_routes)[0]
+
+    def reach_times(self, access, depart: int, active: bytearray, max_s: int,
+                    modes=None, max_walk_m: Optional[float] = None,
+                    max_rounds: int = MAX_ROUNDS) -> List[float]:
+        """One-to-all: earliest arrival at every stop within max_s (INF if not reached)"""
+        return self._forward(access, [], depart, active, modes, max_walk_m, max_rounds, max_s)[1]
+
+    def _forward(self, access, egresses, depart: int, active: bytearray, modes,
+                 max_walk_m: Optional[float], max_rounds: int, max_s: int = MAX_TRIP_S,
+                 avoid_routes=None):
+        """Forward RAPTOR rounds; returns (per-destination journeys, final stop labels)"""
+        n = len(self.stop_ids)
+        allowed = self._allowed_patterns(modes, avoid_routes)
+        horizon = depart + max_s
+        label = [INF] * n           # best arrival so far with <= k vehicles
+        via_ride = bytearray(n)     # label set by alighting (needs change slack)
+        set_round = bytearray(n)    # round that set the label
+        access_at: Dict[int, Tuple[int, float]] = {}
+        marked = set()
+        for s, secs, meters in access:
+            if depart + secs < label[s]:
+                label[s] = depart + secs
+                access_at[s] = (secs, meters)
+                marked.add(s)
+        egress_ats = [{s: (secs, meters) for s, secs, meters in egress} for egress in egresses]
+        rides: List[Dict[int, Tuple]] = [dict()]
+        walks: List[Dict[int, Tuple]] = [dict()]
+
+        results: List[List] = [[] for _ in egresses]
+        target_best = [INF] * len(egresses)
+        pat_stops, pat_arr, pat_dep = self.pat_stops, self.pat_arr, self.pat_dep
+        pat_trips, stop_patterns = self.pat_trips, self.stop_patterns
+        fp_off, fp_to, fp_secs, fp_m = self.footpaths.offsets, self.footpaths.targets, \
+            self.footpaths.secs, self.footpaths.meters
+        walk_cut = max_walk_m if max_walk_m is not None and max_walk_m < self.footpaths.radius_m else None
+        for k in range(1, max_rounds + 1):
+            queue: Dict[int, int] = {}
+            for s in marked:
+                for p, i in stop_patterns[s]:
+                    if (allowed is None or allowed[p]) and queue.get(p, 1 << 30) > i:
+                        queue[p] = i
+            prev = list(label)
+            prev_ride = bytes(via_ride)
+            prev_round = bytes(set_round)
+            ride_k: Dict[int, Tuple] = {}
+            walk_k: Dict[int, Tuple] = {}
+            improved, marked = marked, set()
+
+            bound = min(max(target_best, default=INF), horizon)
+            for p, i0 in queue.items():
+                stops, arr, dep, trips = pat_stops[p], pat_arr[p], pat_dep[p], pat_trips[p]
+                nt = len(trips)
+                trip = board = board_round = -1
+                for i in range(i0, len(stops)):
+                    s = stops[i]
+                    if trip >= 0:
+                        a = arr[i * nt + trip]
+                        if a < label[s] and a < bound:
+                            label[s] = a
+                            via_ride[s] = 1
+                            set_round[s] = k
+                            ride_k[s] = (p, trip, i, board, board_round, a)
+                            marked.add(s)
+                    # Only stops improved last round can offer an earlier trip
+                    if s in improved and (trip < 0 or prev[s] <= dep[i * nt + trip]):
+                        ready = prev[s]
+                        if prev_ride[s]:
+                            ready += MIN_CHANGE_S
+                        lo = i * nt
+                        j = bisect_left(dep, ready, lo, lo + nt) - lo
+                        while j < nt and not active[trips[j]]:
+                            j += 1
+                        if j < nt and (trip < 0 or j < trip):
+                            trip, board, board_round = j, i, prev_round[s]
+
+            # Walking transfers, always from a vehicle arrival
+            for s, ride in list(ride_k.items()):
+                t0 = ride[5]
+                lo, hi = fp_off[s], fp_off[s + 1]
+                if walk_cut is not None:
+                    hi = bisect_right(fp_m, walk_cut, lo, hi)
+                for e in range(lo, hi):
+                    s2 = fp_to[e]
+                    t = t0 + fp_secs[e]
+                    if t < label[s2] and t < bound:
+                        label[s2] = t
+                        via_ride[s2] = 0
+                        set_round[s2] = k
+                        walk_k[s2] = (s, fp_secs[e], fp_m[e])
+                        marked.add(s2)
+
+            rides.append(ride_k)
+            walks.append(walk_k)
+            for d, egress_at in enumerate(egress_ats):
+                round_best, round_stop = INF, -1
+                for s, (secs, _) in egress_at.items():
+                    if set_round[s] == k and label[s] + secs < round_best:
+                        round_best, round_stop = label[s] + secs, s
+                if round_best < target_best[d]:
+                    target_best[d] = round_best
+                    results[d].append((round_best, self._trace(rides, walks, k, round_stop, access_at,
+                                                               egress_at[round_stop], forward=True)))
+            if not marked:
+                break
+        return results, label
+
+    def latest_departure(self, access, egress, arrive: int, active: bytearray,
+                         modes=None, max_walk_m: Optional[float] = None,
+                         max_rounds: int = MAX_ROUNDS):
+        """
+        Reverse RAPTOR: latest departures that still reach the destination
+        by `arrive`. Labels run backwards in time from the egress stops.
+        Returns [(departure, journey legs)], fewest vehicles first.
+        """
+        return self.latest_departure_many([access], egress, arrive, active, modes,
+                                          max_walk_m, max_rounds)[0]
+
+    def latest_departure_many(self, accesses, egress, arrive: int, active: bytearray,
+                              modes=None, max_walk_m: Optional[float] = None,
+                              max_rounds: int = MAX_ROUNDS, avoid_routes=None):
+        """One reverse search serving several origins (one access list each)"""
+        n = len(self.stop_ids)
+        allowed = self._allowed_patterns(modes, avoid_routes)
+        horizon = arrive - MAX_TRIP_S
+        NEG = -INF
+        label = [NEG] * n           # latest departure still making it
+        via_ride = bytearray(n)
+        set_round = bytearray(n)
+        egress_at: Dict[int, Tuple[int, float]] = {}
+        marked = set()
+        for s, secs, meters in egress:
+            if arrive - secs > label[s]:
+                label[s] = arrive - secs
+                egress_at[s] = (secs, meters)
+                marked.add(s)
+        access_ats = [{s: (secs, meters) for s, secs, meters in access} for access in accesses]
+        rides: List[Dict[int, Tuple]] = [dict()]
+        walks: List[Dict[int, Tuple]] = [dict()]
+
+        results: List[List] = [[] for _ in accesses]
+        origin_best = [NEG] * len(accesses)
+        pat_stops, pat_arr, pat_dep = self.pat_stops, self.pat_arr, self.pat_dep
+        pat_trips, stop_patterns = self.pat_trips, self.stop_patterns
+        fp_off, fp_to, fp_secs, fp_m = self.footpaths.offsets, self.footpaths.targets, \
+            self.footpaths.secs, self.footpaths.meters
+        walk_cut = max_walk_m if max_walk_m is not None and max_walk_m < self.footpaths.radius_m else None
+        for k in range(1, max_rounds + 1):
+            queue: Dict[int, int] = {}
+            for s in marked:
+                for p, i in stop_patterns[s]:
+                    if (allowed is None or allowed[p]) and queue.get(p, -1) < i:
+                        queue[p] = i
+            prev = list(label)
+            prev_ride = bytes(via_ride)
+            prev_round = bytes(set_round)
+            ride_k: Dict[int, Tuple] = {}
+            walk_k: Dict[int, Tuple] = {}
+            improved, marked = marked, set()
+
+            bound = max(min(origin_best, default=NEG), horizon)
+            for p, i0 in queue.items():
+                stops, arr, dep, trips = pat_stops[p], pat_arr[p], pat_dep[p], pat_trips[p]
+                nt = len(trips)
+                trip = alight = alight_round = -1
+                for i in range(i0, -1, -1):
+                    s = stops[i]
+                    if trip >= 0:
+                        d = dep[i * nt + trip]
+                        if d > label[s] and d > bound:
+                            label[s] = d
+                            via_ride[s] = 1
+                            set_round[s] = k
+                            ride_k[s] = (p, trip, i, alight, alight_round, d)
+                            marked.add(s)
+                    if s in improved and (trip < 0 or prev[s] >= arr[i * nt + trip]):
+                        ready = prev[s]
+                        if prev_ride[s]:
+                            ready -= MIN_CHANGE_S
+                        lo = i * nt
+                        j = bisect_right(arr, ready, lo, lo + nt) - lo - 1
+                        while j >= 0 and not active[trips[j]]:
+                            j -= 1
+                        if j >= 0 and (trip < 0 or j > trip):
+                            trip, alight, alight_round = j, i, prev_round[s]
+
+            for s, ride in list(ride_k.items()):
+                t0 = ride[5]
+                lo, hi = fp_off[s], fp_off[s + 1]
+                if walk_cut is not None:
+                    hi = bisect_right(fp_m, walk_cut, lo, hi)
+                for e in range(lo, hi):
+                    s2 = fp_to[e]
+                    t = t0 - fp_secs[e]
+                    if t > label[s2] and t > bound:
+                        label[s2] = t
+                        via_ride[s2] = 0
+                        set_round[s2] = k
+                        walk_k[s2] = (s, fp_secs[e], fp_m[e])
+                        marked.add(s2)
+
+            rides.append(ride_k)
+            walks.append(walk_k)
+            for o, access_at in enumerate(access_ats):
+                round_best, round_stop = NEG, -1
+                for s, (secs, _) in access_at.items():
+                    if set_round[s] == k and label[s] - secs > round_best:
+                        round_best, round_stop = label[s] - secs, s
+                if round_best > origin_best[o]:
+                    origin_best[o] = round_best
+                    results[o].append((round_best, self._trace(rides, walks, k, round_stop, egress_at,
+                                                               access_at[round_stop], forward=False)))
+            if not marked:
+                break
+        return results
+
+    # ---------- Journey reconstruction ----------
+
+    def _ride_leg(self, p, trip, a, b) -> Dict[str, Any]:
+        """Ride on pattern p's trip from stop index a to b (a < b)"""
+        nt = len(self.pat_trips[p])
+        stops = self.pat_stops[p]
+        t = self.pat_trips[p][trip]
+        lats, lons = self.stop_lats, self.stop_lons
+        dist = sum(haversine(lats[x], lons[x], lats[y], lons[y])
+                   for x, y in zip(stops[a:b], stops[a + 1:b + 1]))
+        return {"mode": self.pat_mode[p], "route": self.route_short[self.pat_route[p]],
+                "trip_id": self.trip_ids[t], "headsign": self.trip_headsign[t],
+                "from_stop": stops[a], "to_stop": stops[b], "from_pos": a, "to_pos": b,
+                "start": self.pat_dep[p][a * nt + trip], "end": self.pat_arr[p][b * nt + trip],
+                "stops": b - a, "meters": dist}
+
+    def _trace(self, rides, walks, k, stop, start_at, end_leg, forward) -> List[Dict[str, Any]]:
+        """
+        Follow parent pointers back from `stop` (labelled in round k) to the
+        search's starting stops. Ride entries are (pattern, trip, index of
+        this stop, index to continue from, round to continue in, time).
+        Returns legs in travel order.
+        """
+        def walk(a, b, secs, meters):
+            return {"mode": "walk", "from_stop": a, "to_stop": b, "secs": secs, "meters": meters}
+
+        secs, meters = end_leg
+        legs = [walk(stop, None, secs, meters) if forward else walk(None, stop, secs, meters)]
+        s = stop
+        while k > 0:
+            if s in walks[k]:
+                other, secs, meters = walks[k][s]
+                legs.append(walk(other, s, secs, meters) if forward else walk(s, other, secs, meters))
+                s = other
+            p, trip, here, there, k, _ = rides[k][s]
+            legs.append(self._ride_leg(p, trip, min(here, there), max(here, there)))
+            s = self.pat_stops[p][there]
+        secs, meters = start_at[s]
+        legs.append(walk(None, s, secs, meters) if forward else walk(s, None, secs, meters))
+        if forward:
+            legs.reverse()
+        return legs
+
+
+def _interpolate(arr: List, dep: List) -> bool:
+    """Fill untimed stops linearly between timed ones; False if ends are untimed"""
+    if arr[0] is None or arr[-1] is None:
+        return False
+    if None not in arr:
+        return True
+    last = 0
+    for i in range(1, len(arr)):
+        if arr[i] is not None:
+            for j in range(last + 1, i):
+                t = dep[last] + (arr[i] - dep[last]) * (j - last) // (i - last)
+                arr[j] = dep[j] = t
+            last = i
+    return True
+
+
+# ---------- Global timetable ----------
+
+_timetable: Optional[Timetable] = None
+_timetable_lock = threading.Lock()
+
+
+def get_timetable() -> Timetable:
+    """Get or load the global timetable from the feed database"""
+    global _timetable
+    if _timetable is None:
+        with _timetable_lock:
+            if _timetable is None:
+                _timetable = Timetable.from_db()
+    return _timetable
+
+
+def reset_timetable():
+    global _timetable
+    with _timetable_lock:
+        _timetable = None
+
+
+add_swap_listener(reset_timetable)
+
+
+# ---------- Request handling ----------
+
+def local_now() -> datetime:
+    return datetime.now(LOCAL_TZ) if LOCAL_TZ else datetime.now()
+
+
+def parse_when(value: Optional[str], now: Optional[datetime] = None) -> Optional[datetime]:
+    """'now', 'HH:MM' (today, local time) or an ISO datetime"""
+    if not value:
+        return None
+    now = now or local_now()
+    if value == "now":
+        return now
+    if len(value) <= 5 and ":" in value:
+        h, m = value.split(":")
+        return now.replace(hour=int(h), minute=int(m), second=0, microsecond=0)
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is not None and LOCAL_TZ is not None:
+        dt = dt.astimezone(LOCAL_TZ)
+    elif dt.tzinfo is None and now.tzinfo is not None:
+        dt = dt.replace(tzinfo=now.tzinfo)
+    return dt
+
+
+def _clock(day_start: datetime, secs: int) -> datetime:
+    return day_start + timedelta(seconds=int(secs))
+
+
+def _itinerary(tt: Timetable, legs: List[Dict[str, Any]], day_start: datetime) -> Dict[str, Any]:
+    """Scheduled itinerary for traced legs; apply_realtime() adds the delays"""
+    rides = [l for l in legs if l["mode"] != "walk"]
+    first, last = rides[0], rides[-1]
+    leave = first["start"] - legs[0]["secs"]
+    reach = last["end"] + legs[-1]["secs"]
+    walk_m = sum(l["meters"] for l in legs if l["mode"] == "walk")
+
+    labels, details, modes = [], [], []
+    for leg in legs:
+        if leg["mode"] == "walk":
+            if leg["meters"] < 1:
+                continue
+            to = tt.stop_names[leg["to_stop"]] if leg["to_stop"] is not None else "destination"
+            labels.append(f"Walk to {to}")
+            details.append({"mode": "walk", "to": to,
+                            "duration": round(leg["secs"] / 60, 1),
+                            "distance_km": round(leg["meters"] * WALK_DETOUR / 1000, 2)})
+            mode = "walk"
+        else:
+            mode = leg["mode"]
+            label = f"{mode.capitalize()} {leg['route']}"
+            labels.append(label)
+            details.append({"mode": mode, "route": leg["route"], "trip_id": leg["trip_id"],
+                            "headsign": leg["headsign"],
+                            "from": tt.stop_names[leg["from_stop"]], "to": tt.stop_names[leg["to_stop"]],
+                            "from_stop_id": tt.stop_ids[leg["from_stop"]],
+                            "to_stop_id": tt.stop_ids[leg["to_stop"]],
+                            "departure": _clock(day_start, leg["start"]).isoformat(),
+                            "arrival": _clock(day_start, leg["end"]).isoformat(),
+                            "stops": leg["stops"],
+                            "duration": round((leg["end"] - leg["start"]) / 60, 1),
+                            "distance_km": round(leg["meters"] / 1000, 2)})
+        if mode not in modes:
+            modes.append(mode)
+
+    reliability = min(MODE_RELIABILITY.get(l["mode"], 0.84) for l in rides) * 0.97 ** (len(rides) - 1)
+    return {
+        "durationMin": round((reach - leave) / 60),
+        "transfers": len(rides) - 1,
+        "walk_km": round(walk_m * WALK_DETOUR / 1000, 2),
+        "stairs": False,
+        "modes": modes,
+        "legs": labels,
+        "leg_details": details,
+        "reliability": round(reliability, 2),
+        "departure": _clock(day_start, leave).isoformat(),
+        "arrival": _clock(day_start, reach).isoformat(),
+    }
+
+
+def route_itineraries(origin: Sequence[float], destination: Sequence[float],
+                      depart_at: Optional[str] = "now", arrive_by: Optional[str] = None,
+                      modes: Optional[List[str]] = None, max_walk_km: float = 1.2,
+                      realtime: bool = True, avoid_routes=None) -> List[Dict[str, Any]]:
+    """
+    Run the timetable router for one origin/destination pair.
+    Returns itinerary dicts in the shape used by /plan (unscored), one per
+    Pareto-optimal transfer count; empty if nothing is reachable.
+    """
+    return route_batch([origin], [destination], depart_at, arrive_by, modes, max_walk_km, realtime,
+                       avoid_routes)[0][0]
+
+
+def route_batch(origins: Sequence[Sequence[float]], destinations: Sequence[Sequence[float]],
+                depart_at: Optional[str] = "now", arrive_by: Optional[str] = None,
+                modes: Optional[List[str]] = None, max_walk_km: float = 1.2,
+                realtime: bool = True, avoid_routes=None) -> List[List[List[Dict[str, Any]]]]:
+    """
+    Itineraries for every origin x destination pair, as [o][d] -> options.
+    Depart-at runs one forward search per origin for all destinations;
+    arrive-by runs one reverse search per destination for all origins.
+    Cancelled trips are always skipped; realtime=False leaves the times
+    as scheduled. Routes named in avoid_routes (e.g. an incident's
+    affected_routes) are not ridden.
+    """
+    when = parse_when(arrive_by) if arrive_by else (parse_when(depart_at) or local_now())
+    day_start = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    secs = int((when - day_start).total_seconds())
+
+    out: List[List[List[Dict[str, Any]]]] = [[[] for _ in destinations] for _ in origins]
+    tt = get_timetable()
+    max_walk_m = (1.2 if max_walk_km is None else max_walk_km) * 1000 / WALK_DETOUR
+    if tt.pat_stops:
+        access = [tt.nearby(o[0], o[1], max_walk_m) for o in origins]
+        egress = [tt.nearby(d[0], d[1], max_walk_m) for d in destinations]
+        transit_modes = [m for m in (modes or []) if m not in ("walk", "bike")] or None
+        active = overlay.running(tt.active_trips(when.date()))
+        if arrive_by:
+            reachable = [i for i, a in enumerate(access) if a]
+            for j, e in enumerate(egress):
+                if not e or not reachable:
+                    continue
+                found = tt.latest_departure_many([access[i] for i in reachable], e, secs, active,
+                                                 modes=transit_modes, max_walk_m=max_walk_m,
+                                                 avoid_routes=avoid_routes)
+                for i, journeys in zip(reachable, found):
+                    out[i][j] = [_itinerary(tt, legs, day_start) for _, legs in journeys]
+        else:
+            reachable = [j for j, e in enumerate(egress) if e]
+            for i, a in enumerate(access):
+                if not a or not reachable:
+                    continue
+                found = tt.earliest_arrival_many(a, [egress[j] for j in reachable], secs, active,
+                                                 modes=transit_modes, max_walk_m=max_walk_m,
+                                                 avoid_routes=avoid_routes)
+                for j, journeys in zip(reachable, found):
+                    out[i][j] = [_itinerary(tt, legs, day_start) for _, legs in journeys]
+
+    # Walking the whole way, when it is within the walking limit
+    if not modes or "walk" in modes:
+        for i, o in enumerate(origins):
+            for j, d in enumerate(destinations):
+                direct_m = haversine(o[0], o[1], d[0], d[1])
+                if direct_m <= max_walk_m:
+                    out[i][j].append(_walk_itinerary(direct_m, when, bool(arrive_by)))
+    if realtime and overlay.trips:
+        out = [[apply_realtime(options, tt) for options in row] for row in out]
+    return out
+
+
+def _walk_itinerary(direct_m: float, when: datetime, arrive_by: bool) -> Dict[str, Any]:
+    secs = walk_seconds(direct_m)
+    leave = when - timedelta(seconds=secs) if arrive_by else when
+    return {
+        "durationMin": round(secs / 60), "transfers": 0,
+        "walk_km": round(direct_m * WALK_DETOUR / 1000, 2), "stairs": False,
+        "modes": ["walk"], "legs": ["Walk to destination"],
+        "leg_details": [{"mode": "walk", "to": "destination", "duration": round(secs / 60, 1),
+                         "distance_km": round(direct_m * WALK_DETOUR / 1000, 2)}],
+        "reliability": 0.99,
+        "departure": leave.isoformat(),
+        "arrival": (leave + timedelta(seconds=secs)).isoformat(),
+    }
+
+
+def _ride_positions(tt: Timetable, trip: int, from_stop_id: str, to_stop_id: str) -> Optional[Tuple[int, int]]:
+    """Indices of a ride's boarding and alighting stops within its trip's pattern"""
+    p = tt.trip_pattern[trip] if 0 <= trip < len(tt.trip_pattern) else -1
+    if p < 0:
+        return None
+    stops = tt.pat_stops[p]
+    try:
+        a = stops.index(tt.stop_pos[from_stop_id])
+        return a, stops.index(tt.stop_pos[to_stop_id], a + 1)
+    except (KeyError, ValueError):
+        return None
+
+
+def _shift(iso: str, secs: int) -> str:
+    return (datetime.fromisoformat(iso) + timedelta(seconds=secs)).isoformat()
+
+
+def apply_realtime(itineraries: List[Dict[str, Any]], tt: Optional[Timetable] = None) -> List[Dict[str, Any]]:
+    """
+    GTFS-Realtime delays on scheduled itineraries. Rides with an update get
+    expected times plus realtime, delay_min and the scheduled_* times; the
+    itinerary's arrival follows its last ride. Returns new dicts for
+    itineraries that changed, so cached results can be passed in.
+    """
+    if not overlay.trips:
+        return itineraries
+    tt = tt or get_timetable()
+    out = []
+    for itin in itineraries:
+        details, changed, last_arr = [], False, 0
+        for d in itin.get("leg_details", ()):
+            if d["mode"] == "walk":
+                details.append(d)
+                continue
+            last_arr = 0
+            rt = overlay.get(d["trip_id"])
+            if rt is None:
+                pos = None
+            elif rt.arr is None:
+                pos = (0, 0)    # trip outside the timetable: trip-level delay only
+            else:
+                pos = _ride_positions(tt, rt.trip, d["from_stop_id"], d["to_stop_id"])
+            if pos is None:
+                details.append(d)
+                continue
+            dep, last_arr = rt.departure_delay(pos[0]), rt.arrival_delay(pos[1])
+            details.append({**d, "departure": _shift(d["departure"], dep), "arrival": _shift(d["arrival"], last_arr),
+                            "duration": round(d["duration"] + (last_arr - dep) / 60, 1),
+                            "realtime": True, "delay_min": round(dep / 60, 1),
+                            "scheduled_departure": d["departure"], "scheduled_arrival": d["arrival"]})
+            changed = True
+        if not changed:
+            out.append(itin)
+            continue
+        arrival = _shift(itin["arrival"], last_arr)
+        minutes = (datetime.fromisoformat(arrival) - datetime.fromisoformat(itin["departure"])).total_seconds() / 60
+        out.append({**itin, "leg_details": details, "arrival": arrival, "durationMin": round(minutes)})
+    return out
@@ -0,0 +1,309 @@
+"""
+Spatial index for transit stops
+Keeps the stop table in memory, bucketed on a lat/lng grid, so nearby and
+k-nearest lookups only touch the cells around the query point.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from math import radians, cos, floor, ceil, pi
+import heapq
+import threading
+
+import numpy as np
+
+from .db import connection, haversine, add_swap_listener
+
+EARTH_RADIUS_M = 6371000
+
+# On the same sphere as db.haversine, so bbox pruning never drops a hit
+METERS_PER_DEG_LAT = 2 * pi * EARTH_RADIUS_M / 360
+
+# ~550 m cells: a 900 m radius query touches a 5x5 block of cells
+DEFAULT_CELL_DEG = 0.005
+
+# Batch lookups: points sharing one distance matrix (at most BATCH_GROUP,
+# all within the same BATCH_BLOCK_CELLS-wide block of cells), and the first
+# search radius tried in k-nearest mode when the caller gives no radius
+BATCH_GROUP = 64
+BATCH_BLOCK_CELLS = 4
+BATCH_K_START_RADIUS_M = 1000.0
+
+
+def haversine_np(lat1, lon1, lat2, lon2):
+    """
+    Vectorized haversine in metres over degree arrays.
+    Inputs broadcast like any NumPy ufunc, e.g. (N, 1) against (M,) gives
+    an (N, M) distance matrix.
+    """
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = phi2 - phi1
+    dl = np.radians(lon2) - np.radians(lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class StopIndex:
+    """
+    Uniform grid over stop coordinates.
+    Cells are square in metres at the reference latitude, so the longitude
+    step is widened by 1/cos(lat).
+    """
+
+    def __init__(self, stops: List[Tuple[str, str, float, float]],
+                 cell_deg: float = DEFAULT_CELL_DEG):
+        self.stop_ids = [s[0] for s in stops]
+        self.names = [s[1] for s in stops]
+        self.lats = [float(s[2]) for s in stops]
+        self.lons = [float(s[3]) for s in stops]
+
+        # Radian copies for the vectorized batch kernel
+        self.lat_rad = np.radians(np.asarray(self.lats, dtype=np.float64))
+        self.lon_rad = np.radians(np.asarray(self.lons, dtype=np.float64))
+        self.cos_lat = np.cos(self.lat_rad)
+
+        ref_lat = sum(self.lats) / len(self.lats) if stops else 0.0
+        self.cell_lat = cell_deg
+        self.cell_lon = cell_deg / max(cos(radians(ref_lat)), 0.01)
+
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            self.cells.setdefault(self._cell(lat, lon), []).append(i)
+
+        if self.cells:
+            xs = [c[0] for c in self.cells]
+            ys = [c[1] for c in self.cells]
+            self.bounds = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            self.bounds = (0, 0, -1, -1)
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return floor(lat / self.cell_lat), floor(lon / self.cell_lon)
+
+    def _cell_edge_m(self, lat: float) -> float:
+        """Shortest cell edge in metres at `lat`; bounds ring searches"""
+        return min(self.cell_lat * METERS_PER_DEG_LAT,
+                   self.cell_lon * METERS_PER_DEG_LAT * cos(radians(lat)))
+
+    def _row(self, i: int, d: float) -> Dict:
+        name = self.names[i]
+        return {"stop_id": self.stop_ids[i], "stop_name": name, "name": name,
+                "lat": self.lats[i], "lng": self.lons[i], "distance_m": round(d, 1)}
+
+    def candidates_in_bbox(self, min_lat: float, min_lon: float,
+                           max_lat: float, max_lon: float) -> List[int]:
+        """Indices of stops in the grid cells overlapping the bbox"""
+        x0, y0 = floor(min_lat / self.cell_lat), floor(min_lon / self.cell_lon)
+        x1, y1 = floor(max_lat / self.cell_lat), floor(max_lon / self.cell_lon)
+        bx0, by0, bx1, by1 = self.bounds
+        x0, y0, x1, y1 = max(x0, bx0), max(y0, by0), min(x1, bx1), min(y1, by1)
+        out = []
+        cells = self.cells
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                bucket = cells.get((x, y))
+                if bucket:
+                    out.extend(bucket)
+        return out
+
+    def within(self, lat: float, lng: float, radius: float) -> List[Dict]:
+        """All stops within `radius` metres, nearest first"""
+        dlat = radius / METERS_PER_DEG_LAT
+        # Widest longitude span is at the poleward edge of the box
+        dlon = radius / (METERS_PER_DEG_LAT * max(cos(radians(min(abs(lat) + dlat, 89.0))), 0.01))
+        lats, lons = self.lats, self.lons
+        hits = []
+        for i in self.candidates_in_bbox(lat - dlat, lng - dlon, lat + dlat, lng + dlon):
+            # Cheap bbox reject before the trig
+            slat, slon = lats[i], lons[i]
+            if abs(slat - lat) > dlat or abs(slon - lng) > dlon:
+                continue
+            d = haversine(lat, lng, slat, slon)
+            if d <= radius:
+                hits.append((d, i))
+        hits.sort()
+        return [self._row(i, d) for d, i in hits]
+
+    def nearest(self, lat: float, lng: float, k: int,
+                max_radius: Optional[float] = None) -> List[Dict]:
+        """
+        k nearest stops, optionally capped at `max_radius` metres.
+        Grows a square ring of cells until the k-th best distance is closer
+        than anything the next ring could contain.
+        """
+        if k <= 0 or not self.stop_ids:
+            return []
+        cx, cy = self._cell(lat, lng)
+        edge_m = self._cell_edge_m(lat)
+        bx0, by0, bx1, by1 = self.bounds
+        max_ring = max(abs(cx - bx0), abs(cx - bx1), abs(cy - by0), abs(cy - by1))
+        if max_radius is not None:
+            max_ring = min(max_ring, int(ceil(max_radius / edge_m)) + 1)
+
+        lats, lons, cells = self.lats, self.lons, self.cells
+        heap: List[Tuple[float, int]] = []  # max-heap of (-d, i), size <= k
+        for r in range(max_ring + 1):
+            if r == 0:
+                ring = [(cx, cy)]
+            else:
+                ring = [(cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r, r + 1)]
+                ring += [(cx + dx, cy + dy) for dy in (-r, r) for dx in range(-r + 1, r)]
+            for cell in ring:
+                bucket = cells.get(cell)
+                if not bucket:
+                    continue
+                for i in bucket:
+                    d = haversine(lat, lng, lats[i], lons[i])
+                    if max_radius is not None and d > max_radius:
+                        continue
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, i))
+                    elif d < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d, i))
+            # Anything outside ring r is at least r cell edges away
+            if len(heap) == k and -heap[0][0] <= r * edge_m:
+                break
+        return [self._row(i, -nd) for nd, i in sorted(heap, reverse=True)]
+
+    def distance_matrix(self, lats: np.ndarray, lons: np.ndarray,
+                        idx: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        (len(lats), n) distances in metres from each point to the stops in
+        `idx` (all stops when omitted), straight off the cached radian arrays.
+        """
+        lat_rad, lon_rad, cos_lat = self.lat_rad, self.lon_rad, self.cos_lat
+        if idx is not None:
+            lat_rad, lon_rad, cos_lat = lat_rad[idx], lon_rad[idx], cos_lat[idx]
+        plat = np.radians(lats)[:, None]
+        plon = np.radians(lons)[:, None]
+        a = (np.sin((lat_rad - plat) / 2) ** 2
+             + np.cos(plat) * cos_lat * np.sin((lon_rad - plon) / 2) ** 2)
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    def _bbox_candidates(self, lat: float, lng: float, radius: float) -> List[int]:
+        dlat = radius / METERS_PER_DEG_LAT
+        dlon = radius / (METERS_PER_DEG_LAT * max(cos(radians(min(abs(lat) + dlat, 89.0))), 0.01))
+        return self.candidates_in_bbox(lat - dlat, lng - dlon, lat + dlat, lng + dlon)
+
+    def nearby_batch(self, points: Sequence[Sequence[float]], radius: Optional[float] = 900,
+                     k: Optional[int] = None) -> List[List[Dict]]:
+        """
+        Nearby stops for many points at once.
+        Points are grouped by grid block; each group gathers its candidate
+        stops from the grid and evaluates them in a single vectorized
+        distance matrix. Returns one list per point, nearest first; `k` keeps
+        only the k nearest, `radius` (metres) drops anything further away.
+        k-nearest without a radius starts from a small search radius and
+        doubles it for the points that have not yet seen k stops.
+        """
+        n_stops = len(self.stop_ids)
+        out: List[List[Dict]] = [[] for _ in points]
+        if not points or n_stops == 0:
+            return out
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if k:
+            k = min(k, n_stops)
+            search_r = radius if radius is not None else BATCH_K_START_RADIUS_M
+        else:
+            search_r = radius
+
+        pending = self._group_points(pts, range(len(pts)))
+        while pending:
+            retry: List[int] = []
+            for group in pending:
+                cand = set()
+                for i in group:
+                    cand.update(self._bbox_candidates(pts[i, 0], pts[i, 1], search_r))
+                idx = np.fromiter(cand, dtype=np.int64, count=len(cand))
+                exhaustive = len(idx) == n_stops
+                if len(idx) == 0:
+                    if k and radius is None:
+                        retry.extend(group)
+                    continue
+                g = np.asarray(group)
+                dist = self.distance_matrix(pts[g, 0], pts[g, 1], idx)
+                for row_i, p in enumerate(group):
+                    row = dist[row_i]
+                    hit = np.flatnonzero(row <= search_r)
+                    if k and radius is None and len(hit) < k and not exhaustive:
+                        retry.append(p)
+                        continue
+                    if exhaustive and radius is None:
+                        hit = np.arange(len(idx))
+                    hit = hit[np.argsort(row[hit], kind="stable")]
+                    if k:
+                        hit = hit[:k]
+                    out[p] = [self._row(int(idx[j]), float(row[j])) for j in hit]
+            search_r *= 2
+            pending = self._group_points(pts, retry)
+        return out
+
+    def within_batch(self, points: Sequence[Sequence[float]],
+                     radius: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Raw form of nearby_batch for bulk builds: for each point, the
+        (stop indices, metres) within `radius`, nearest first.
+        """
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        out: List[Tuple[np.ndarray, np.ndarray]] = [empty] * len(points)
+        if not len(points) or not self.stop_ids:
+            return out
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        for group in self._group_points(pts, range(len(pts))):
+            cand = set()
+            for i in group:
+                cand.update(self._bbox_candidates(pts[i, 0], pts[i, 1], radius))
+            if not cand:
+                continue
+            idx = np.fromiter(cand, dtype=np.int64, count=len(cand))
+            g = np.asarray(group)
+            dist = self.distance_matrix(pts[g, 0], pts[g, 1], idx)
+            for row_i, p in enumerate(group):
+                row = dist[row_i]
+                hit = np.flatnonzero(row <= radius)
+                hit = hit[np.argsort(row[hit], kind="stable")]
+                out[p] = (idx[hit], row[hit])
+        return out
+
+    def _group_points(self, pts: np.ndarray, which) -> List[List[int]]:
+        """Split points into groups of nearby points that share most candidates"""
+        blocks: Dict[Tuple[int, int], List[int]] = {}
+        for i in which:
+            cx, cy = self._cell(pts[i, 0], pts[i, 1])
+            blocks.setdefault((cx // BATCH_BLOCK_CELLS, cy // BATCH_BLOCK_CELLS), []).append(i)
+        return [members[j:j + BATCH_GROUP] for members in blocks.values()
+                for j in range(0, len(members), BATCH_GROUP)]
+
+
+# Global index, built once from the stops table
+_index: Optional[StopIndex] = None
+_index_lock = threading.Lock()
+
+
+def load_stops(db_path: Optional[str] = None) -> List[Tuple[str, str, float, float]]:
+    with connection(db_path) as con:
+        # Boardable stops only; parent stations and entrances are skipped
+        return con.execute("SELECT stop_id, name, lat, lon FROM stops "
+                           "WHERE location_type IS NULL OR location_type = 0").fetchall()
+
+
+def get_stop_index() -> StopIndex:
+    """Get or build the global stop index"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = StopIndex(load_stops())
+    return _index
+
+
+def reset_stop_index():
+    """Drop the cached index so the next lookup reloads the stops table"""
+    global _index
+    with _index_lock:
+        _index = None
+
+
+add_swap_listener(reset_stop_index)
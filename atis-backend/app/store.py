@@ -1,9 +1,14 @@
-import random
+import random, sqlite3
 from datetime import datetime, timedelta
-from .db import query_nearby_stops
+from .db import query_nearby_stops, query_nearby_stops_batch
+from .incidents import route_key
+from .routing import route_itineraries
 
-def nearby_stops(lat: float, lng: float, radius: float = 900):
-    return query_nearby_stops(lat, lng, radius)
+def nearby_stops(lat: float, lng: float, radius: float = 900, k: int = None):
+    return query_nearby_stops(lat, lng, radius, k=k)
+
+def nearby_stops_batch(points, radius: float = 900, k: int = None):
+    return query_nearby_stops_batch(points, radius, k=k)
 
 def sample_departures(stop_id: str):
     now = datetime.utcnow()
@@ -57,7 +62,7 @@ def _score_option(o, optimize="fastest", prefers_fewer_transfers=True):
     return score
 
 def sample_itineraries(origin, destination, prefers_fewer_transfers=True, optimize="fastest",
-                       max_walk_km=1.2, avoid_stairs=False, bike_ok=False, modes=None):
+                       max_walk_km=1.2, avoid_stairs=False, bike_ok=False, modes=None, avoid_routes=None):
     options = _base_options()
     if modes:
         options = [o for o in options if any(m in modes for m in o["modes"])]
@@ -66,21 +71,58 @@ def sample_itineraries(origin, destination, prefers_fewer_transfers=True, optimi
         options = [o for o in options if not o["stairs"]]
     if not bike_ok:
         options = [o for o in options if "bike" not in o["modes"]]
+    if avoid_routes:
+        avoid = {route_key(r) for r in avoid_routes}
+        options = [o for o in options if not any(route_key(l.partition(" ")[2]) in avoid for l in o["legs"])]
     for o in options:
         o["score"] = _score_option(o, optimize=optimize, prefers_fewer_transfers=prefers_fewer_transfers)
     options.sort(key=lambda x: x["score"])
     return options[:3]
 
+def plan_itineraries(origin, destination, depart_at="now", arrive_by=None, prefers_fewer_transfers=True,
+                     optimize="fastest", max_walk_km=1.2, avoid_stairs=False, bike_ok=False, modes=None,
+                     realtime=True, avoid_routes=None):
+    """Timetable-routed itineraries; the static options only stand in when no feed is loaded"""
+    try:
+        options = route_itineraries(origin, destination, depart_at=depart_at, arrive_by=arrive_by,
+                                    modes=modes, max_walk_km=max_walk_km, realtime=realtime,
+                                    avoid_routes=avoid_routes)
+    except sqlite3.OperationalError:
+        # No GTFS tables yet (init_db not run)
+        return sample_itineraries(origin, destination, prefers_fewer_transfers, optimize,
+                                  max_walk_km, avoid_stairs, bike_ok, modes, avoid_routes)
+    return rank_itineraries(options, optimize, prefers_fewer_transfers)
+
+def rank_itineraries(options, optimize="fastest", prefers_fewer_transfers=True):
+    """Score routed options, keep the best three and label them A/B/C"""
+    for o in options:
+        o["score"] = _score_option(o, optimize=optimize, prefers_fewer_transfers=prefers_fewer_transfers)
+    options.sort(key=lambda x: x["score"])
+    options = options[:3]
+    for i, o in enumerate(options):
+        o["id"] = "ABC"[i]
+    return options
+
 def sample_weather(point, raw=False):
     cond = random.choice(["Clear", "Light rain", "Windy", "Overcast"])
-    alert = None
-    if cond in ("Light rain", "Windy"):
-        alert = f"Take a small buffer: {cond.lower()} may slow services."
     data = {"condition": cond, "tempC": 16 + random.randint(-2, 3), "windKph": 8 + random.randint(0,12)}
-    return data if raw else (alert or "")
+    return data if raw else weather_alert(data)
 
-def sample_traffic(bbox: str):
+def weather_alert(forecast):
+    """Travel advice for a forecast, "" when the weather shouldn't matter"""
+    cond = (forecast or {}).get("condition", "")
+    if cond in ("Light rain", "Windy"):
+        return f"Take a small buffer: {cond.lower()} may slow services."
+    return ""
+
+def _incident_clock():
+    # Sample incidents and alerts move on a 10-minute clock, so they read as
+    # unchanged (same bytes, same ETag) between ticks like a real feed would
     now = datetime.utcnow()
+    return now.replace(minute=now.minute - now.minute % 10, second=0, microsecond=0)
+
+def sample_traffic():
+    now = _incident_clock()
     return [
         {
             "id": "INC-1",
@@ -88,8 +130,10 @@ def sample_traffic(bbox: str):
             "summary": "Crash southbound SH1 near Esmonde Rd",
             "severity": "high",
             "start_time": (now - timedelta(minutes=15)).isoformat(),
+            "end_time": (now + timedelta(minutes=75)).isoformat(),
             "expected_delay_min": 20,
             "location": "SH1 southbound near Esmonde Rd",
+            "geometry": {"type": "Point", "coordinates": [174.7530, -36.7905]},
             "affected_routes": ["NX1", "NX2", "INN"],
             "advice": "Buses are diverting via Akoranga Dr. Consider transferring to the Northern Express at Akoranga Station."
         },
@@ -99,21 +143,17 @@ def sample_traffic(bbox: str):
             "summary": "Lane closure on Fanshawe St",
             "severity": "moderate",
             "start_time": (now - timedelta(minutes=5)).isoformat(),
+            "end_time": (now + timedelta(hours=4)).isoformat(),
             "expected_delay_min": 8,
             "location": "Fanshawe St city-bound",
+            "geometry": {"type": "LineString", "coordinates": [[174.7480, -36.8430], [174.7590, -36.8458]]},
             "affected_routes": ["82", "83", "Lower Link"],
             "advice": "Expect short delays around Wynyard Quarter. Allow an extra 5 minutes or alight one stop earlier."
         },
     ]
 
-def suggest_reroute(current_itinerary, incidents):
-    if any(i.get("severity") == "high" for i in incidents) and "bus" in (current_itinerary.get("modes") or []):
-        return {"id": "ALT1", "durationMin": current_itinerary.get("durationMin", 0)+3, "transfers": 1,
-                "walk_km": 0.7, "modes": ["walk","train"], "legs": ["Walk", "Train", "Walk"], "note": "Avoids incident area"}
-    return {"note": "Current route ok"}
-
 def sample_alerts():
-    now = datetime.utcnow()
+    now = _incident_clock()
     return [
         {
             "id": "ALERT-1",
@@ -123,6 +163,9 @@ def sample_alerts():
             "start_time": (now + timedelta(hours=1)).isoformat(),
             "end_time": (now + timedelta(hours=4)).isoformat(),
             "location": "Harbour Bridge and CBD waterfront",
+            "geometry": {"type": "Polygon", "coordinates": [[[174.7370, -36.8480], [174.7800, -36.8480],
+                                                            [174.7800, -36.8250], [174.7370, -36.8250],
+                                                            [174.7370, -36.8480]]]},
             "impact": "Gusts up to 80 km/h may affect double-decker buses and ferry sailings.",
             "affected_modes": ["bus", "ferry"],
             "affected_routes": ["NX1", "NX2", "Birkenhead Ferry"],
@@ -137,6 +180,7 @@ def sample_alerts():
             "start_time": (now + timedelta(hours=5)).isoformat(),
             "end_time": (now + timedelta(hours=9)).isoformat(),
             "location": "Spark Arena & Quay St",
+            "geometry": {"type": "Point", "coordinates": [174.7765, -36.8478]},
             "impact": "Increased crowd volumes and intermittent road closures around Quay St from 6pm.",
             "affected_modes": ["bus", "car", "rideshare"],
             "affected_routes": ["TMK", "InnerLink", "Train Eastern Line"],
@@ -150,6 +194,8 @@ def sample_alerts():
             "start_time": (now + timedelta(days=1, hours=10)).isoformat(),
             "end_time": (now + timedelta(days=2, hours=6)).isoformat(),
             "location": "Puhinui ⇄ Papakura",
+            "geometry": {"type": "LineString", "coordinates": [[174.8485, -36.9995], [174.8875, -37.0160],
+                                                               [174.9440, -37.0640]]},
             "impact": "Rail replacement buses operating every 20 minutes overnight.",
             "affected_modes": ["train", "replacement bus"],
             "affected_routes": ["Southern Line", "Rail replacement bus S1"],
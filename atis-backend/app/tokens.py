@@ -0,0 +1,159 @@
+"""
+Verified-token Cache for ATIS
+Nearly every request carries one of a handful of bearer tokens (the
+frontend polls continuously), so a token's HMAC and claims are checked
+once and the claims kept, keyed by a digest of the token, until the
+token's own exp. Revocation stays exact: every hit is also checked
+against a small revocation set of
+  - single tokens (logout), kept until the token would have expired, and
+  - per-user cutoffs (MFA disabled): tokens issued before the cutoff are
+    void; kept for one token lifetime, after which none can be left.
+Revocations are recorded in users.db, so other workers pick them up on
+their next sync (every ATIS_REVOCATION_SYNC_S seconds).
+"""
+
+from typing import Any, Callable, Dict, Optional
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+
+TOKEN_CACHE_SIZE = int(os.getenv("ATIS_TOKEN_CACHE_SIZE", "10000"))
+REVOCATION_SYNC_S = float(os.getenv("ATIS_REVOCATION_SYNC_S", "5"))
+
+
+def token_digest(token: str) -> str:
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+class Revocations:
+    """
+    Revoked token digests and per-user cutoffs, mirrored from the
+    repository returned by `repo()` (anything with add_revocation and
+    revocations_since, i.e. the UserRepository).
+    """
+
+    def __init__(self, repo: Callable[[], Any], lifetime_s: float, sync_s: float = REVOCATION_SYNC_S,
+                 clock: Callable[[], float] = time.time):
+        self.repo = repo
+        self.lifetime_s = lifetime_s
+        self.sync_s = sync_s
+        self.clock = clock
+        self._tokens: Dict[str, float] = {}   # digest -> token exp
+        self._users: Dict[str, float] = {}    # username -> tokens issued before this are void
+        self._synced = float("-inf")
+        self._seen_at = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"tokens_revoked": 0, "users_revoked": 0, "syncs": 0, "rejected": 0}
+
+    def _apply(self, key: str, at: float, until: float):
+        kind, _, name = key.partition(":")
+        if kind == "token":
+            self._tokens[name] = until
+        elif kind == "user":
+            self._users[name] = max(at, self._users.get(name, 0.0))
+        self._seen_at = max(self._seen_at, at)
+
+    def sync(self, force: bool = False):
+        """Pick up other workers' revocations and forget the ones that can no longer matter"""
+        now = self.clock()
+        if not force and now - self._synced < self.sync_s:
+            return
+        self._synced = now
+        # Overlap by one interval: a row committed late with an earlier `at` is still seen
+        rows = self.repo().revocations_since(self._seen_at - self.sync_s, now)
+        with self._lock:
+            for row in rows:
+                self._apply(*row)
+            self._tokens = {d: exp for d, exp in self._tokens.items() if exp > now}
+            self._users = {u: at for u, at in self._users.items() if at + self.lifetime_s > now}
+            self.stats["syncs"] += 1
+
+    def revoke_token(self, digest: str, exp: float):
+        now = self.clock()
+        self.repo().add_revocation(f"token:{digest}", now, exp)
+        with self._lock:
+            self._apply(f"token:{digest}", now, exp)
+            self.stats["tokens_revoked"] += 1
+
+    def revoke_user(self, username: str):
+        # Whole seconds, like iat: a token issued later in this same second stays valid
+        at = float(int(self.clock()))
+        self.repo().add_revocation(f"user:{username}", at, at + self.lifetime_s)
+        with self._lock:
+            self._apply(f"user:{username}", at, at + self.lifetime_s)
+            self.stats["users_revoked"] += 1
+
+    def is_revoked(self, digest: str, claims: Dict[str, Any]) -> bool:
+        self.sync()
+        cutoff = self._users.get(claims.get("sub"))
+        revoked = digest in self._tokens or (cutoff is not None and claims.get("iat", 0) < cutoff)
+        if revoked:
+            self.stats["rejected"] += 1
+        return revoked
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"tokens": len(self._tokens), "users": len(self._users), "sync_s": self.sync_s,
+                    **self.stats}
+
+
+class TokenCache:
+    """
+    Claims of verified tokens by digest, bounded LRU. `verify(token)` does
+    the full check (signature, issuer, exp) and returns the claims or None;
+    only successes are cached.
+    """
+
+    def __init__(self, verify: Callable[[str], Optional[Dict[str, Any]]], revocations: Revocations,
+                 max_entries: int = TOKEN_CACHE_SIZE, clock: Callable[[], float] = time.time):
+        self.verify = verify
+        self.revocations = revocations
+        self.max_entries = max_entries
+        self.clock = clock
+        self._data: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalid": 0, "expired": 0, "evictions": 0}
+
+    def claims(self, token: str) -> Optional[Dict[str, Any]]:
+        """Claims of a valid, unexpired, unrevoked token, else None"""
+        digest = token_digest(token)
+        with self._lock:
+            claims = self._data.get(digest)
+            if claims is not None:
+                self._data.move_to_end(digest)
+                self.stats["hits"] += 1
+        if claims is None:
+            claims = self.verify(token)
+            with self._lock:
+                self.stats["misses"] += 1
+                if claims is None:
+                    self.stats["invalid"] += 1
+                    return None
+                self._data[digest] = claims
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+                    self.stats["evictions"] += 1
+        if claims.get("exp", 0) <= self.clock():
+            with self._lock:
+                self._data.pop(digest, None)
+                self.stats["expired"] += 1
+            return None
+        if self.revocations.is_revoked(digest, claims):
+            return None
+        return claims
+
+    def discard(self, token: str):
+        with self._lock:
+            self._data.pop(token_digest(token), None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self.stats)
+            s["size"] = len(self._data)
+        lookups = s["hits"] + s["misses"]
+        s["hit_ratio"] = round(s["hits"] / lookups, 3) if lookups else 0.0
+        s["max_entries"] = self.max_entries
+        s["revocations"] = self.revocations.snapshot()
+        return s
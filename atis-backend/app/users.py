@@ -0,0 +1,181 @@
+"""
+User Repository for ATIS
+Accounts live in their own SQLite file, users.db (atis.db is replaced
+wholesale by every GTFS import), keyed by username. Each write is one
+statement on a pooled connection, so concurrent registrations and MFA
+changes cannot overwrite each other. Reads go through a read-through LRU
+cache; a write drops the cached row once it has committed.
+
+The cache is per process: with several workers, a change made in one is
+seen by the others within ATIS_USERS_CACHE_TTL seconds.
+
+users.json from earlier versions is imported the first time the
+repository opens and then renamed to users.json.migrated. The import can
+also be run by hand:
+
+    python -m app.users [users.json] [users.db]
+"""
+
+from typing import Any, Dict, Optional
+import json
+import os
+import sys
+import threading
+
+if __package__ in (None, ""):
+    # Allow `python app/users.py` as well as `python -m app.users`
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = "app"
+
+from .cache import TTLCache
+from .db import connection
+
+USERS_DB_PATH = os.getenv("ATIS_USERS_DB_PATH", os.path.join(os.path.dirname(__file__), "users.db"))
+LEGACY_USERS_PATH = os.path.join(os.path.dirname(__file__), "users.json")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    salt TEXT NOT NULL,
+    pw TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    mfa_secret TEXT,
+    mfa_enabled INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID
+"""
+# Revoked tokens ("token:<digest>") and per-user cutoffs ("user:<name>"),
+# kept until `until`; see tokens.py
+REVOCATIONS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS revocations (key TEXT PRIMARY KEY, at REAL NOT NULL, until REAL NOT NULL)"
+    " WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS revocations_at ON revocations (at)",
+)
+COLUMNS = ("salt", "pw", "created", "mfa_secret", "mfa_enabled")
+
+
+def _row(values) -> Dict[str, Any]:
+    u = dict(zip(COLUMNS, values))
+    u["mfa_enabled"] = bool(u["mfa_enabled"])
+    return u
+
+
+class UserRepository:
+    """Users by name in SQLite, with missing names cached too (failed logins repeat)"""
+
+    def __init__(self, path: str = USERS_DB_PATH, cache_size: Optional[int] = None,
+                 cache_ttl_s: Optional[float] = None):
+        self.path = path
+        self.cache = TTLCache("users",
+                              max_entries=cache_size or int(os.getenv("ATIS_USERS_CACHE_SIZE", "10000")),
+                              ttl_s=cache_ttl_s or float(os.getenv("ATIS_USERS_CACHE_TTL", "30")))
+        with connection(path) as con:
+            con.execute(SCHEMA)
+            for stmt in REVOCATIONS_SCHEMA:
+                con.execute(stmt)
+
+    def _load(self, username: str) -> Optional[Dict[str, Any]]:
+        with connection(self.path) as con:
+            row = con.execute(f"SELECT {', '.join(COLUMNS)} FROM users WHERE username = ?",
+                              (username,)).fetchone()
+        return _row(row) if row else None
+
+    def get(self, username: str) -> Optional[Dict[str, Any]]:
+        """The user's record (salt, pw, created, mfa_secret, mfa_enabled) or None; do not mutate it"""
+        return self.cache.get_or_compute(username, lambda: self._load(username))
+
+    def create(self, username: str, record: Dict[str, Any]) -> bool:
+        """Insert a new user; False if the name is taken"""
+        with connection(self.path) as con:
+            cur = con.execute(
+                f"INSERT INTO users (username, {', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (username) DO NOTHING",
+                (username, *(record.get(c) for c in COLUMNS[:-1]), int(bool(record.get("mfa_enabled")))))
+            created = cur.rowcount == 1
+        self.cache.discard(username)
+        return created
+
+    def update(self, username: str, **fields) -> bool:
+        """Set some columns of one user; False if there is no such user"""
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        if "mfa_enabled" in fields:
+            fields["mfa_enabled"] = int(bool(fields["mfa_enabled"]))
+        with connection(self.path) as con:
+            cur = con.execute(f"UPDATE users SET {', '.join(f'{c} = ?' for c in fields)} WHERE username = ?",
+                              (*fields.values(), username))
+            found = cur.rowcount == 1
+        self.cache.discard(username)
+        return found
+
+    def add_revocation(self, key: str, at: float, until: float):
+        with connection(self.path) as con:
+            con.execute("INSERT INTO revocations (key, at, until) VALUES (?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET at = excluded.at, until = max(until, excluded.until)",
+                        (key, at, until))
+            con.execute("DELETE FROM revocations WHERE until < ?", (at,))
+
+    def revocations_since(self, at: float, now: float):
+        """(key, at, until) of revocations recorded after `at` that still matter at `now`"""
+        with connection(self.path) as con:
+            return con.execute("SELECT key, at, until FROM revocations WHERE at > ? AND until > ?",
+                               (at, now)).fetchall()
+
+    def __len__(self):
+        with connection(self.path) as con:
+            return con.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_json(self, json_path: str) -> int:
+        """Add the users of a users.json file in one transaction; existing names are kept. Returns rows added"""
+        with open(json_path, encoding="utf-8") as f:
+            data = json.load(f)
+        rows = [(name, u["salt"], u["pw"], int(u.get("created", 0)), u.get("mfa_secret"),
+                 int(bool(u.get("mfa_enabled"))))
+                for name, u in data.items()]
+        with connection(self.path) as con:
+            before = con.total_changes
+            con.executemany(f"INSERT INTO users (username, {', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (username) DO NOTHING", rows)
+            added = con.total_changes - before
+        self.cache.invalidate()
+        return added
+
+
+def migrate_legacy(repo: UserRepository, json_path: str = LEGACY_USERS_PATH) -> Optional[int]:
+    """One-shot import of users.json, renamed afterwards so it is not imported again"""
+    if not os.path.exists(json_path):
+        return None
+    added = repo.import_json(json_path)
+    os.replace(json_path, json_path + ".migrated")
+    return added
+
+
+_users: Optional[UserRepository] = None
+_users_lock = threading.Lock()
+
+def get_users() -> UserRepository:
+    """Get or open the global user repository, importing users.json on first open"""
+    global _users
+    if _users is None:
+        with _users_lock:
+            if _users is None:
+                repo = UserRepository()
+                migrate_legacy(repo)
+                _users = repo
+    return _users
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    json_path = argv[0] if argv else LEGACY_USERS_PATH
+    db_path = argv[1] if len(argv) > 1 else USERS_DB_PATH
+    repo = UserRepository(db_path)
+    added = migrate_legacy(repo, json_path)
+    if added is None:
+        print(f"No {json_path} to migrate")
+    else:
+        print(f"Imported {added} users from {json_path} into {db_path} ({len(repo)} in total); "
+              f"original kept as {json_path}.migrated")
+
+if __name__ == "__main__":
+    main()
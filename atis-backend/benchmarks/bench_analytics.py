@@ -0,0 +1,97 @@
+"""
+Benchmark: analytics dashboard reads against history size.
+
+    python -m benchmarks.bench_analytics [max_history] [reads]
+
+For 10k, 100k and 1M planned trips (up to max_history), feeds the trips
+into an AnalyticsTracker's aggregates and times every dashboard read
+(/analytics/summary, /environmental/impact, modes, performance, both
+leaderboards, popular routes). For comparison the same reads are timed as
+full passes over the trip list, as they were computed before. Also reports
+the per-event cost of keeping the aggregates, and checks that both ways
+give the same numbers.
+"""
+
+import os, random, sys, tempfile, time
+from collections import Counter, defaultdict
+
+from app.analytics import AnalyticsTracker
+from benchmarks.bench_eventlog import trip
+
+NOW = int(time.time())
+
+
+def rescan(trips, users, week_ago):
+    """The dashboard reads as full passes over the trips (the old way)"""
+    n = len(trips)
+    summary = {
+        "total_trips": n,
+        "active_users_7d": sum(1 for u in users.values() if u["last_active"] > week_ago),
+        "total_co2_saved_kg": round(sum(t["environmental"]["co2_saved_kg"] for t in trips), 2),
+        "total_distance_km": round(sum(t["environmental"]["total_distance_km"] for t in trips), 2),
+        "avg_duration_min": round(sum(t["duration_min"] for t in trips) / max(n, 1), 1),
+        "avg_transfers": round(sum(t["transfers"] for t in trips) / max(n, 1), 2),
+        "avg_mcda_score": round(sum(t["mcda_score"] for t in trips) / max(n, 1), 1),
+    }
+    sum(t["environmental"]["co2_saved_kg"] for t in trips)                    # environmental impact
+    modes = Counter(m for t in trips for m in t["modes"])                      # modes
+    sum(t["mcda_score"] for t in trips), sum(1 for t in trips if t["mcda_score"] >= 50)  # performance
+    sorted(users.items(), key=lambda x: x[1]["trip_count"], reverse=True)[:10]  # leaderboard (trips)
+    co2 = defaultdict(float)
+    for t in trips:
+        co2[t["user"]] += t["environmental"]["co2_saved_kg"]
+    by_co2 = sorted(co2.items(), key=lambda x: x[1], reverse=True)[:10]       # leaderboard (environmental)
+    routes = Counter((tuple(t["origin"]), tuple(t["destination"])) for t in trips)
+    routes.most_common(10)                                                     # popular routes
+    return summary, dict(modes), [round(c, 2) for _, c in by_co2]
+
+
+def read_all(tracker):
+    summary = tracker.get_summary_stats()
+    tracker.get_environmental_impact()
+    modes = tracker.get_mode_popularity()
+    tracker.get_performance_metrics()
+    tracker.get_user_leaderboard("trips", 10)
+    by_co2 = tracker.get_user_leaderboard("environmental", 10)
+    tracker.get_popular_routes(10)
+    return summary, modes["counts"], [u["co2_saved_kg"] for u in by_co2]
+
+
+def main():
+    max_history = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rnd = random.Random(9)
+    print(f"{'history':>10} {'apply/event':>12} {'dashboard, aggregates':>22} {'dashboard, full scans':>22}")
+    for history in [n for n in (10_000, 100_000, 1_000_000) if n <= max_history]:
+        tracker = AnalyticsTracker(data_file="none.json", log_dir=os.path.join(tempfile.mkdtemp(), "log"))
+        trips = [trip(rnd, NOW - rnd.randrange(30 * 86400)) for _ in range(history)]
+        t = time.perf_counter()
+        for e in trips:
+            # In memory only, as the log replay does
+            tracker._apply("trip", dict(e))
+        apply_us = (time.perf_counter() - t) / history * 1e6
+
+        new = read_all(tracker)
+        t = time.perf_counter()
+        for _ in range(reads):
+            read_all(tracker)
+        new_ms = (time.perf_counter() - t) / reads * 1000
+
+        users = tracker.data["users"]
+        week_ago = int(time.time()) - 7 * 86400
+        scans = max(1, min(reads, 2_000_000 // history))
+        t = time.perf_counter()
+        for _ in range(scans):
+            old = rescan(trips, users, week_ago)
+        old_ms = (time.perf_counter() - t) / scans * 1000
+
+        summary = {k: v for k, v in new[0].items() if k in old[0]}
+        summary["active_users_7d"] = tracker.data["active"].count_after(week_ago)
+        assert (summary, new[1], new[2]) == old, (summary, old)
+        print(f"{history:>10,} {apply_us:>9.2f} us {new_ms:>19.3f} ms {old_ms:>19.1f} ms")
+        tracker.log.close()
+        del tracker, trips, users
+
+
+if __name__ == "__main__":
+    main()
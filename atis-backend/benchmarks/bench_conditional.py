@@ -0,0 +1,153 @@
+"""
+Benchmark: conditional GET on the endpoints the frontend polls.
+
+    python -m benchmarks.bench_conditional [clients] [refresh_rounds]
+
+Starts the API under uvicorn twice on the synthetic network: once with
+/alerts, /stops/nearby, /reviews, /safety/contacts and /mcda/profiles
+as they were (a fresh dict per request, serialized by FastAPI, no
+validators) and once as they are now. Each simulated client loads the
+page (all five endpoints) and then refreshes /alerts, /stops/nearby and
+/reviews, sending back the ETags it was given like a browser does.
+Reports server CPU and bytes sent per request.
+"""
+
+import asyncio, os, random, subprocess, sys, tempfile, time
+from typing import Optional
+
+import httpx
+
+from benchmarks.bench_providers import free_port, wait_for
+from benchmarks.bench_push import cpu_seconds
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+
+SIDE = 40
+CONCURRENCY = 16
+PATHS = ("/stops/nearby", "/alerts", "/reviews", "/safety/contacts", "/mcda/profiles")
+
+
+def serve(port: int, mode: str, db_path: str):
+    """Child process: the app, with the old handlers swapped back in for mode 'before'"""
+    import uvicorn
+    from fastapi import Depends
+    from app import db, main as api
+    db.DB_PATH = db_path
+    api.REVIEWS.extend({"ts": 1_700_000_000 + i, "user": f"user{i}", "location": f"Stop {i}",
+                        "rating": 1 + i % 5, "comment": "Shelter was clean and the bus on time."}
+                       for i in range(20))
+    if mode == "before":
+        api.app.router.routes[:] = [r for r in api.app.router.routes if getattr(r, "path", None) not in PATHS]
+
+        @api.app.get("/stops/nearby")
+        def stops_nearby(lat: float, lng: float, radius: Optional[float] = None, k: Optional[int] = None,
+                         user: str = Depends(api.require_auth)):
+            if radius is None and not k:
+                radius = 900
+            return {"stops": api.nearby_stops(lat, lng, radius, k=k)}
+
+        @api.app.get("/alerts")
+        def alerts(bbox: Optional[str] = None, user: str = Depends(api.require_auth)):
+            return api._alerts_payload(bbox)
+
+        @api.app.get("/reviews")
+        def get_reviews():
+            return {"reviews": api.REVIEWS}
+
+        @api.app.get("/safety/contacts")
+        def safety_contacts():
+            return {"contacts": [
+                {"name": "Emergency (NZ)", "phone": "111"},
+                {"name": "Non-Emergency Police", "phone": "105"},
+                {"name": "AT HOP / Transport Info", "phone": "09 366 6400"},
+            ]}
+
+        @api.app.get("/mcda/profiles")
+        def mcda_profiles():
+            import json
+            return json.loads(api.MCDA_PROFILES.body)
+    uvicorn.run(api.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def session(client: httpx.AsyncClient, origin, rounds: int, tally):
+    etags = {}
+
+    async def get(path, params=None):
+        key = (path, tuple(sorted((params or {}).items())))
+        headers = {"If-None-Match": etags[key]} if key in etags else {}
+        r = await client.get(path, params=params, headers=headers)
+        if "etag" in r.headers:
+            etags[key] = r.headers["etag"]
+        tally["requests"] += 1
+        tally["status"][r.status_code] = tally["status"].get(r.status_code, 0) + 1
+        # Body plus status line and headers as they went over the wire
+        tally["bytes"] += len(r.content) + 15 + sum(len(k) + len(v) + 4 for k, v in r.headers.items())
+
+    near = {"lat": origin[0], "lng": origin[1], "radius": 900}
+    for path in PATHS:
+        await get(path, near if path == "/stops/nearby" else None)
+    for _ in range(rounds):
+        await get("/alerts")
+        await get("/stops/nearby", near)
+        await get("/reviews")
+
+
+async def drive(port: int, token: str, origins, rounds: int):
+    tally = {"requests": 0, "bytes": 0, "status": {}}
+    limits = httpx.Limits(max_connections=CONCURRENCY, max_keepalive_connections=CONCURRENCY)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30,
+                                 headers={"Authorization": f"Bearer {token}"}) as client:
+        slots = asyncio.Semaphore(CONCURRENCY)
+
+        async def one(origin):
+            async with slots:
+                await session(client, origin, rounds, tally)
+        await asyncio.gather(*[one(o) for o in origins])
+    return tally
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]), sys.argv[3], sys.argv[4])
+        return
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=SIDE)
+    from app import db, gtfs
+    from app.auth import issue_token
+    db_path = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db_path, log=None)
+    token = issue_token("bench")
+
+    # Clients near a few dozen popular places, like a real map
+    rnd = random.Random(3)
+    places = [grid_point(SIDE, rnd) for _ in range(40)]
+    origins = [rnd.choice(places) for _ in range(clients)]
+
+    print(f"{clients} clients, page load + {rounds} refreshes each, {CONCURRENCY} at a time")
+    results = {}
+    for mode in ("before", "after"):
+        port = free_port()
+        server = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_conditional", "--serve",
+                                   str(port), mode, db_path])
+        try:
+            wait_for(port)
+            time.sleep(1)   # startup warm-up
+            c0, t0 = cpu_seconds(server.pid), time.perf_counter()
+            tally = asyncio.run(drive(port, token, origins, rounds))
+            wall, cpu = time.perf_counter() - t0, cpu_seconds(server.pid) - c0
+        finally:
+            server.terminate()
+            server.wait()
+        n = tally["requests"]
+        results[mode] = (cpu / n * 1000, tally["bytes"] / n)
+        print(f"  {mode:<7} {n:,} requests  {n / wall:6.0f} req/s  server CPU {cpu / n * 1000:5.2f} ms/req  "
+              f"{tally['bytes'] / n / 1024:5.2f} KB/req  status {dict(sorted(tally['status'].items()))}")
+    (cpu_b, bytes_b), (cpu_a, bytes_a) = results["before"], results["after"]
+    print(f"  server CPU per request {1 - cpu_a / cpu_b:.0%} lower, bytes out {1 - bytes_a / bytes_b:.0%} lower")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark: pooled SQLite connections versus a fresh connection per query.
+
+    python -m benchmarks.bench_db_pool [threads] [queries_per_thread]
+
+Runs a point lookup on the stops table from a thread pool, the way FastAPI
+runs sync endpoints, once opening/closing a connection per query (the old
+db.connect() pattern) and once through db.connection(). Prints throughput
+and the pool's checkout/wait counters.
+"""
+
+import os, sys, random, sqlite3, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import db
+
+N_STOPS = 20000
+
+
+def build_db(path):
+    rnd = random.Random(42)
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE stops (stop_id TEXT PRIMARY KEY, name TEXT, lat REAL, lon REAL)")
+    con.executemany("INSERT INTO stops VALUES (?, ?, ?, ?)",
+                    ((f"S{i}", f"Stop {i}", rnd.uniform(-37.1, -36.6), rnd.uniform(174.5, 175.0))
+                     for i in range(N_STOPS)))
+    con.commit()
+    con.close()
+
+
+SQL = "SELECT stop_id, name, lat, lon FROM stops WHERE stop_id = ?"
+
+
+def per_query_connect(stop_id):
+    con = sqlite3.connect(db.DB_PATH)
+    try:
+        return con.execute(SQL, (stop_id,)).fetchone()
+    finally:
+        con.close()
+
+
+def pooled(stop_id):
+    with db.connection() as con:
+        return con.execute(SQL, (stop_id,)).fetchone()
+
+
+def run(fn, threads, per_thread):
+    rnd = random.Random(1)
+    ids = [f"S{rnd.randrange(N_STOPS)}" for _ in range(threads * per_thread)]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        list(ex.map(fn, ids))
+    elapsed = time.perf_counter() - t0
+    return len(ids) / elapsed, elapsed
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    build_db(db.DB_PATH)
+
+    for label, fn in (("connect per query (old)", per_query_connect), ("pooled", pooled)):
+        qps, elapsed = run(fn, threads, per_thread)
+        print(f"  {label:<26} {qps:10.0f} queries/s   ({elapsed:.2f} s, {threads} threads)")
+
+    print("Pool stats:", db.pool_stats()[db.DB_PATH])
+
+
+if __name__ == "__main__":
+    main()
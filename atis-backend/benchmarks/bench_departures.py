@@ -0,0 +1,81 @@
+"""
+Benchmark: shared departure board cache under many pollers.
+
+    python -m benchmarks.bench_departures [pollers] [seconds]
+
+Simulates open stop panels polling /departures (every 0.3 s here, standing
+in for the app's 30 s) against an upstream that takes 80 ms per board,
+with most panels on a few busy stops. Time is compressed: TTL 1 s and
+stale window 2 s stand in for the production 15 s / 30 s. Reports request
+latency and upstream calls with no cache and with the stale-while-
+revalidate board cache.
+"""
+
+import random, sys, threading, time
+
+from app.cache import StaleCache
+from app.store import sample_departures
+
+UPSTREAM_S = 0.08
+POLL_S = 0.3
+STOPS = [f"STOP-{i}" for i in range(200)]
+BUSY = STOPS[:5]
+
+
+def run(pollers, seconds, board):
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def panel(stop_id, rnd):
+        time.sleep(rnd.uniform(0, POLL_S))
+        local = []
+        while time.monotonic() < stop_at:
+            t = time.perf_counter()
+            board(stop_id)
+            local.append((time.perf_counter() - t) * 1000)
+            time.sleep(POLL_S)
+        with lock:
+            latencies.extend(local)
+
+    rnd = random.Random(5)
+    stops = [rnd.choice(BUSY) if rnd.random() < 0.7 else rnd.choice(STOPS) for _ in range(pollers)]
+    ths = [threading.Thread(target=panel, args=(s, random.Random(i))) for i, s in enumerate(stops)]
+    for th in ths:
+        th.start()
+    for th in ths:
+        th.join()
+    latencies.sort()
+    n = len(latencies)
+    return n, latencies[n // 2], latencies[int(n * 0.95)]
+
+
+def main():
+    pollers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 6
+
+    calls = []
+
+    def upstream(stop_id):
+        calls.append(stop_id)
+        time.sleep(UPSTREAM_S)
+        return sample_departures(stop_id)
+
+    print(f"{pollers} pollers over {len(STOPS)} stops (70% on {len(BUSY)} busy ones), "
+          f"{seconds:.0f} s, upstream {UPSTREAM_S * 1000:.0f} ms")
+    n, p50, p95 = run(pollers, seconds, upstream)
+    print(f"  no cache     {n:6,} requests  p50 {p50:6.1f} ms  p95 {p95:6.1f} ms  {len(calls):6,} upstream calls")
+
+    calls.clear()
+    cache = StaleCache("bench-departures", max_entries=100, ttl_s=1.0, stale_s=2.0)
+    n, p50, p95 = run(pollers, seconds, lambda s: cache.get_or_compute(s, lambda: upstream(s)))
+    time.sleep(UPSTREAM_S * 2)  # let background refreshes land
+    st = cache.snapshot()
+    print(f"  board cache  {n:6,} requests  p50 {p50:6.1f} ms  p95 {p95:6.1f} ms  {len(calls):6,} upstream calls "
+          f"(saved {st['upstream_calls_saved']:,}; hits {st['hits']:,}, stale {st['stale']:,}, "
+          f"coalesced {st['coalesced']:,}, misses {st['misses']:,}, refreshes {st['refreshes']:,}, "
+          f"evictions {st['evictions']:,})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark: response size and encode time per endpoint.
+
+    python -m benchmarks.bench_encoding [repeats]
+
+Fetches real payloads from the API on the synthetic 70x70 network (a
+/plan with several options, an /isochrone, a departure board, /alerts,
+the usage heatmap over a year of trips, /mcda/profiles) and, for each,
+compares the old encoder (jsonable_encoder + json.dumps) with orjson
+straight from the payload, then reports the size on the wire as JSON, gzip, brotli, MessagePack
+and, where the endpoint has one, the compact mode.
+"""
+
+import gzip, json, os, random, sys, tempfile, time
+
+import orjson
+
+from app import db, gtfs, routing, main as api
+from app.analytics import get_analytics
+from app.auth import issue_token
+from app.encoding import compress, dumps, msgpack, brotli
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+
+SIDE = 70
+
+
+def per_call_ms(fn, repeats):
+    fn()
+    t = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - t) / repeats * 1000
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=SIDE)
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db.DB_PATH, log=None)
+    tt = routing.get_timetable()
+
+    # A year of planned trips for the heatmap (kept in memory, not saved)
+    rnd = random.Random(4)
+    now = int(time.time())
+    analytics = get_analytics()
+    for _ in range(20000):
+        analytics._apply("trip", {"timestamp": now - rnd.randrange(365 * 86400)})
+
+    client = TestClient(api.app)
+    h = {"Authorization": f"Bearer {issue_token('bench')}", "Accept-Encoding": "identity"}
+    origin, destination = grid_point(SIDE, rnd), grid_point(SIDE, rnd)
+    plan_req = {"origin": origin, "destination": destination, "depart_at": "08:00", "max_walk_km": 2}
+    requests = [
+        ("/plan", lambda q="": client.post(f"/plan{q}", json=plan_req, headers=h)),
+        ("/isochrone", lambda q="": client.get("/isochrone", params={"lat": origin[0], "lng": origin[1],
+                                                                    "depart_at": "08:00"}, headers=h)),
+        ("/departures", lambda q="": client.get("/departures", params={"stop_id": tt.stop_ids[len(tt.stop_ids) // 2]},
+                                                headers=h)),
+        ("/alerts", lambda q="": client.get("/alerts", headers=h)),
+        ("/analytics/usage/heatmap", lambda q="": client.get(f"/analytics/usage/heatmap{q}", headers=h)),
+        ("/mcda/profiles", lambda q="": client.get("/mcda/profiles", headers=h)),
+    ]
+
+    def size(n):
+        return f"{n:>9,}" if n is not None else f"{'-':>9}"
+
+    print(f"Encode time per response (mean of {repeats}) and bytes on the wire")
+    print(f"  {'endpoint':<26}{'before':>9}{'now':>9}{'gzip':>9}{'br':>9}"
+          f"{'JSON':>9}{'gzip':>9}{'br':>9}{'msgpack':>9}{'mp+br':>9}{'compact':>9}")
+    for name, fetch in requests:
+        payload = fetch().json()
+        body = dumps(payload)
+        before = per_call_ms(lambda: json.dumps(jsonable_encoder(payload), ensure_ascii=False,
+                                                separators=(",", ":")).encode(), repeats)
+        now = per_call_ms(lambda: dumps(payload), repeats)
+        times = [before, now, per_call_ms(lambda: compress(body, "gzip"), repeats)]
+        sizes = [len(body), len(compress(body, "gzip")), None, None, None, None]
+        if brotli is not None:
+            times.append(per_call_ms(lambda: compress(body, "br"), repeats))
+            sizes[2] = len(compress(body, "br"))
+        if msgpack is not None:
+            packed = msgpack.packb(orjson.loads(body), use_bin_type=True)
+            sizes[3] = len(packed)
+            sizes[4] = len(compress(packed, "br")) if brotli is not None else None
+        if name in ("/plan", "/analytics/usage/heatmap"):
+            sizes[5] = len(fetch("?compact=1").content)
+        print(f"  {name:<26}" + "".join(f"{t:7.3f}ms" for t in times) + f"{'-':>9}" * (4 - len(times))
+              + "".join(size(n) for n in sizes))
+    if msgpack is None or brotli is None:
+        print("  (install msgpack and Brotli for the missing columns)")
+
+
+if __name__ == "__main__":
+    main()
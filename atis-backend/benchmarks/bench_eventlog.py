@@ -0,0 +1,137 @@
+"""
+Benchmark: analytics ingestion on the group-committed event log.
+
+    python -m benchmarks.bench_eventlog [history] [seconds]
+
+Writes a log of synthetic history (1M planned trips by default, spread
+over a year), opens the AnalyticsTracker on it (segment recovery + replay),
+then has several threads track trips for a while, as /analytics/track/trip
+does, reporting sustained trips/s, events per group commit, commit time
+and how long an event waits to become durable. For comparison it times
+one full rewrite of analytics_data.json at the same history, which the
+old tracker paid on every event. Finally a child process appending to the
+log is killed with SIGKILL mid-stream, and the log is reopened to show
+what recovery cut and that every event acknowledged as durable is there.
+"""
+
+import json, os, random, signal, subprocess, sys, tempfile, threading, time
+
+from app.analytics import AnalyticsTracker
+from app.eventlog import EventLog
+
+THREADS = 8
+NOW = int(time.time())
+
+CHILD = """
+import sys
+from app.eventlog import EventLog
+log = EventLog(sys.argv[1])
+n = 0
+while True:
+    for _ in range(500):
+        log.append({"k": "trip", "timestamp": 0, "user": "crash", "origin": [0, 0], "destination": [0, 0]})
+    n += 500
+    log.wait_durable()
+    print(n, flush=True)
+"""
+
+
+def trip(rnd: random.Random, ts: int):
+    o = [round(-36.85 + rnd.uniform(-0.2, 0.2), 4), round(174.76 + rnd.uniform(-0.2, 0.2), 4)]
+    d = [round(-36.85 + rnd.uniform(-0.2, 0.2), 4), round(174.76 + rnd.uniform(-0.2, 0.2), 4)]
+    return {"k": "trip", "timestamp": ts, "user": f"user{rnd.randrange(5000)}", "origin": o, "destination": d,
+            "duration_min": rnd.randrange(10, 90), "transfers": rnd.randrange(3), "modes": ["walk", "bus"],
+            "walk_km": 0.8, "environmental": {"co2_saved_kg": 1.2, "total_distance_km": 9.5},
+            "mcda_score": rnd.randrange(40, 95)}
+
+
+def count_events(directory):
+    return sum(1 for _ in EventLog(directory, fsync=False).replay())
+
+
+def main():
+    history = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rnd = random.Random(8)
+    tmp = tempfile.mkdtemp()
+    log_dir = os.path.join(tmp, "log")
+
+    t = time.perf_counter()
+    log = EventLog(log_dir)
+    log.append({"k": "started", "timestamp": NOW - 365 * 86400})
+    for _ in range(history):
+        log.append(trip(rnd, NOW - rnd.randrange(365 * 86400)))
+    log.close()
+    size_mb = sum(os.path.getsize(p) for p in log.segments()) / 1e6
+    print(f"History: {history:,} trips, {len(log.segments())} segments, {size_mb:,.0f} MB, "
+          f"written in {time.perf_counter() - t:.1f} s")
+
+    t = time.perf_counter()
+    tracker = AnalyticsTracker(data_file=os.path.join(tmp, "none.json"), log_dir=log_dir)
+    print(f"  open + replay: {time.perf_counter() - t:.1f} s ({tracker.get_summary_stats()['total_trips']:,} trips)")
+
+    # Sustained ingestion
+    stop_at = time.monotonic() + seconds
+    lags = []
+    def producer(seed):
+        r = random.Random(seed)
+        n = 0
+        while time.monotonic() < stop_at:
+            e = trip(r, int(time.time()))
+            tracker.track_trip_planned(e["user"], e["origin"], e["destination"],
+                                       {"durationMin": e["duration_min"], "modes": e["modes"]})
+            n += 1
+            if n % 2000 == 0:
+                # Durability lag of this event: queued -> fsynced
+                t0 = time.perf_counter()
+                tracker.log.wait_durable()
+                lags.append((time.perf_counter() - t0) * 1000)
+        return n
+    before = tracker.log.snapshot()
+    counts = []
+    threads = [threading.Thread(target=lambda s=s: counts.append(producer(s))) for s in range(THREADS)]
+    t = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    tracker.log.wait_durable()
+    elapsed = time.perf_counter() - t
+    after = tracker.log.snapshot()
+    commits = after["commits"] - before["commits"]
+    lags.sort()
+    print(f"  ingestion, {THREADS} threads: {sum(counts) / elapsed:,.0f} trips/s sustained over {elapsed:.0f} s; "
+          f"{sum(counts) / max(commits, 1):,.0f} events per commit, commit {after['commit_ms_avg']:.2f} ms avg / "
+          f"{after['commit_ms_max']:.1f} ms max; durable within {lags[len(lags) // 2] if lags else 0:.0f} ms "
+          f"(p50), {lags[-1] if lags else 0:.0f} ms (max)")
+
+    # The old tracker: one indent=2 rewrite of the whole history per event
+    legacy = {"trips": [e for e in tracker.log.replay() if e.pop("k") == "trip"]}
+    t = time.perf_counter()
+    with open(os.path.join(tmp, "analytics_data.json"), "w") as f:
+        json.dump(legacy, f, indent=2)
+    rewrite_s = time.perf_counter() - t
+    print(f"  analytics_data.json rewrite at this history: {rewrite_s:.1f} s per event "
+          f"({1 / rewrite_s:.2f} trips/s)")
+    tracker.log.close()
+    del tracker, legacy
+
+    # Crash mid-commit
+    before_n = count_events(log_dir)
+    child = subprocess.Popen([sys.executable, "-c", CHILD, log_dir], stdout=subprocess.PIPE, text=True)
+    time.sleep(2.0)
+    child.send_signal(signal.SIGKILL)
+    out = child.communicate()[0].split()
+    acked = int(out[-1]) if out else 0
+    t = time.perf_counter()
+    reopened = EventLog(log_dir)
+    open_ms = (time.perf_counter() - t) * 1000
+    found = sum(1 for _ in reopened.replay()) - before_n
+    reopened.close()
+    print(f"  SIGKILL while appending: {acked:,} events acknowledged durable, {found:,} found after recovery "
+          f"(cut {reopened.stats['recovered_bytes_cut']} torn bytes, reopen {open_ms:.0f} ms)")
+    assert found >= acked
+
+
+if __name__ == "__main__":
+    main()
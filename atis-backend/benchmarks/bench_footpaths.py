@@ -0,0 +1,65 @@
+"""
+Benchmark: footpath graph build, incremental update and load.
+
+    python -m benchmarks.bench_footpaths [n_stops] [changed]
+
+Builds the walking-transfer graph for a synthetic city-sized stop table
+(default 50k stops) the old way (one `within` lookup per stop) and with
+the batched CSR build, then changes a few stops and times the incremental
+update against a full rebuild, and the memory-mapped load at startup.
+"""
+
+import os, random, sys, tempfile, time
+
+from app.footpaths import FootpathGraph, FOOTPATH_RADIUS_M
+from app.spatial import StopIndex
+
+from benchmarks.bench_spatial import LAT_RANGE, LON_RANGE
+
+
+def timed(fn):
+    t = time.perf_counter()
+    out = fn()
+    return out, (time.perf_counter() - t) * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    changed = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rnd = random.Random(5)
+    stops = [(f"S{i}", f"Stop {i}", rnd.uniform(*LAT_RANGE), rnd.uniform(*LON_RANGE)) for i in range(n)]
+    index = StopIndex(stops)
+
+    _, ms = timed(lambda: [index.within(lat, lon, FOOTPATH_RADIUS_M)
+                           for lat, lon in zip(index.lats, index.lons)])
+    print(f"{n:,} stops, {FOOTPATH_RADIUS_M:.0f} m radius")
+    print(f"  per-stop within() lookups   {ms:9.1f} ms")
+    graph, ms = timed(lambda: FootpathGraph.build(index))
+    print(f"  batched CSR build           {ms:9.1f} ms   {graph.n_edges:,} edges")
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.footpaths")
+    _, ms = timed(lambda: graph.save(path))
+    print(f"  save                        {ms:9.1f} ms   {os.path.getsize(path) / 1e6:.1f} MB")
+    old, ms = timed(lambda: FootpathGraph.load(path))
+    print(f"  mmap load                   {ms:9.1f} ms")
+
+    # A feed update: some stops moved, some closed, some new
+    new = list(stops)
+    third = changed // 3
+    for i in rnd.sample(range(len(new)), third):
+        sid, name, lat, lon = new[i]
+        new[i] = (sid, name, lat + rnd.uniform(-0.001, 0.001), lon + rnd.uniform(-0.001, 0.001))
+    for i in sorted(rnd.sample(range(len(new)), third), reverse=True):
+        del new[i]
+    new += [(f"NEW{i}", "New stop", rnd.uniform(*LAT_RANGE), rnd.uniform(*LON_RANGE))
+            for i in range(changed - 2 * third)]
+    index2 = StopIndex(new)
+
+    inc, ms = timed(lambda: FootpathGraph.update(old, index2))
+    print(f"  incremental ({changed} changed)   {ms:9.1f} ms   {inc.build_info['rows_rebuilt']:,} rows recomputed")
+    _, ms = timed(lambda: FootpathGraph.build(index2))
+    print(f"  full rebuild                {ms:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark: streaming GTFS import and atomic swap.
+
+    python -m benchmarks.bench_gtfs_import [grid_side] [headway_min]
+
+Generates a synthetic zipped feed (default 70x70 grid, ~2M stop_times),
+imports it with app.gtfs.import_feed while reader threads keep querying
+the live database through the connection pool, and reports load rates
+plus the readers' worst-case latency across the swap.
+"""
+
+import os, sys, tempfile, threading, time
+
+from app import db, gtfs
+from benchmarks.synthetic_gtfs import write_feed
+
+
+def main():
+    side = int(sys.argv[1]) if len(sys.argv) > 1 else 70
+    headway = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    t0 = time.perf_counter()
+    counts = write_feed(feed, side=side, headway_min=headway)
+    print(f"Generated {feed} in {time.perf_counter() - t0:.1f} s "
+          f"({os.path.getsize(feed) / 1e6:.1f} MB zipped): "
+          + ", ".join(f"{k} {v:,}" for k, v in counts.items()))
+
+    # Live database with a small old feed, served while the big one loads
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    old_feed = os.path.join(tmp, "old.zip")
+    write_feed(old_feed, side=5, headway_min=60)
+    gtfs.import_feed(old_feed, db.DB_PATH, log=None)
+
+    stop = threading.Event()
+    seen = set()
+    latencies = []
+
+    def reader():
+        while not stop.is_set():
+            t = time.perf_counter()
+            with db.connection() as con:
+                n = con.execute("SELECT COUNT(*) FROM stops").fetchone()[0]
+            latencies.append((time.perf_counter() - t) * 1000)
+            seen.add(n)
+            time.sleep(0.002)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for th in readers:
+        th.start()
+    print("Importing:")
+    report = gtfs.import_feed(feed, db.DB_PATH)
+    time.sleep(0.05)
+    stop.set()
+    for th in readers:
+        th.join()
+
+    latencies.sort()
+    print(f"Swap took {report['swap_seconds'] * 1000:.1f} ms; "
+          f"{len(latencies)} reader queries during import, stop counts seen {sorted(seen)}, "
+          f"p50 {latencies[len(latencies) // 2]:.2f} ms, max {latencies[-1]:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
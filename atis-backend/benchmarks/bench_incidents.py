@@ -0,0 +1,114 @@
+"""
+Benchmark: incident store bbox and time-window queries.
+
+    python -m benchmarks.bench_incidents [incidents] [queries]
+
+Fills the store with synthetic incidents scattered over the Auckland
+region (points, road segments and a few region-wide alerts, lasting from
+minutes to days, some open-ended) and runs map-viewport bbox queries
+(~2 km to ~20 km across) and "what overlaps the next hour / day" window
+queries against it, compared with filtering the full list as /alerts
+used to leave to the client. Also times a feed reload and expiry.
+"""
+
+import random, sys, time
+
+from app.incidents import IncidentStore, extent, _intersects, FOREVER
+
+REGION = (174.55, -37.10, 175.00, -36.70)   # min_lng, min_lat, max_lng, max_lat
+NOW = 1_800_000_000.0
+
+
+def synthetic(n: int, rnd: random.Random):
+    recs = []
+    for i in range(n):
+        lng = rnd.uniform(REGION[0], REGION[2])
+        lat = rnd.uniform(REGION[1], REGION[3])
+        start = NOW + rnd.uniform(-2 * 86400, 5 * 86400)
+        rec = {"id": f"INC-{i}", "severity": rnd.choice(["high", "moderate", "info"]),
+               "start_time": start}
+        r = rnd.random()
+        if r < 0.001:
+            pass   # no location: region-wide
+        elif r < 0.3:
+            d = rnd.uniform(0.002, 0.03)
+            rec["geometry"] = {"type": "LineString", "coordinates": [[lng, lat], [lng + d, lat + d / 2]]}
+        else:
+            rec["geometry"] = {"type": "Point", "coordinates": [lng, lat]}
+        if rnd.random() < 0.95:
+            rec["end_time"] = start + rnd.expovariate(1 / 7200)
+        recs.append(rec)
+    return recs
+
+
+def linear(recs, bbox, start, end):
+    out = []
+    for r in recs:
+        s = r.get("start_time", -FOREVER)
+        e = r.get("end_time", FOREVER)
+        if e >= NOW and s <= end and e >= start and (bbox is None or _intersects(extent(r), bbox)):
+            out.append(r)
+    return out
+
+
+def timed(fn, queries):
+    t = time.perf_counter()
+    hits = sum(len(fn(q)) for q in queries)
+    return (time.perf_counter() - t) / len(queries) * 1000, hits / len(queries)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    q = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rnd = random.Random(7)
+    recs = synthetic(n, rnd)
+
+    store = IncidentStore(topic=None, clock=lambda: NOW)
+    t = time.perf_counter()
+    store.replace("traffic", recs)
+    load_s = time.perf_counter() - t
+    live = len(store)
+    t = time.perf_counter()
+    store.query()
+    build_s = time.perf_counter() - t
+    print(f"{n:,} incidents ({live:,} not yet over), load {load_s * 1000:.0f} ms, "
+          f"interval tree build {build_s * 1000:.0f} ms, {store.snapshot()['cells']:,} grid cells")
+
+    def viewport(km):
+        d = km / 111
+        lng = rnd.uniform(REGION[0], REGION[2] - d)
+        lat = rnd.uniform(REGION[1], REGION[3] - d)
+        return (lng, lat, lng + d, lat + d)
+
+    cases = [
+        ("bbox 2 km, from now on", [(viewport(2), None, None) for _ in range(q)]),
+        ("bbox 20 km, from now on", [(viewport(20), None, None) for _ in range(q)]),
+        ("bbox 5 km, next hour", [(viewport(5), NOW, NOW + 3600) for _ in range(q)]),
+        ("no bbox, next hour", [(None, NOW, NOW + 3600) for _ in range(q // 10 or 1)]),
+        ("no bbox, instant in 2 days", [(None, NOW + 2 * 86400 + s, NOW + 2 * 86400 + s)
+                                        for s in (rnd.uniform(0, 3600) for _ in range(q // 10 or 1))]),
+    ]
+    print(f"  {'query':<28}{'hits':>8}{'store':>11}{'linear':>11}{'speedup':>9}")
+    for label, queries in cases:
+        ms_store, hits = timed(lambda a: store.query(a[0], a[1], a[2]), queries)
+        ms_lin, hits_lin = timed(lambda a: linear(recs, a[0], a[1] if a[1] is not None else NOW,
+                                                  a[2] if a[2] is not None else FOREVER), queries)
+        assert abs(hits - hits_lin) < 1e-9, (label, hits, hits_lin)
+        print(f"  {label:<28}{hits:8.1f}{ms_store:9.3f}ms{ms_lin:9.2f}ms{ms_lin / ms_store:8.0f}x")
+
+    # Next feed poll: 2% of incidents changed, 1% cleared, 1% new
+    changed = [dict(r, severity="high") if rnd.random() < 0.02 else r for r in recs if rnd.random() > 0.01]
+    changed += synthetic(n // 100, rnd)
+    for i, r in enumerate(changed[-(n // 100):]):
+        r["id"] = f"NEW-{i}"
+    t = time.perf_counter()
+    delta = store.replace("traffic", changed)
+    print(f"  reload with {delta:,} changes: {(time.perf_counter() - t) * 1000:.0f} ms")
+    store.clock = lambda: NOW + 3600
+    t = time.perf_counter()
+    expired = store.expire()
+    print(f"  expiry an hour later: {expired:,} incidents in {(time.perf_counter() - t) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
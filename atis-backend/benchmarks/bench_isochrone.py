@@ -0,0 +1,77 @@
+"""
+Benchmark: /isochrone latency.
+
+    python -m benchmarks.bench_isochrone [n_origins]
+
+On the synthetic 70x70 network, computes isochrones (10/20/30/45 minute
+bands) from random origins at departures spread over the day, reporting
+cold latency split into the one-to-all search and the rasterise + outline
+stage, then the latency of repeat requests served from the per-cell cache.
+"""
+
+import os, random, sys, tempfile, time
+
+from app import db, gtfs, isochrone, routing
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+
+SIDE = 70
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=SIDE)
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db.DB_PATH, log=None)
+    routing.get_timetable()
+
+    rnd = random.Random(11)
+    queries = [(list(grid_point(SIDE, rnd)), f"2026-10-19T{rnd.randrange(7, 20):02d}:{rnd.randrange(60):02d}")
+               for _ in range(n)]
+
+    search_ms, total_ms, stops, rings = [], [], 0, 0
+    original = routing.Timetable.reach_times
+
+    def timed(self, *a, **kw):
+        t = time.perf_counter()
+        try:
+            return original(self, *a, **kw)
+        finally:
+            search_ms.append((time.perf_counter() - t) * 1000)
+    routing.Timetable.reach_times = timed
+
+    for origin, when in queries:
+        t = time.perf_counter()
+        res = isochrone.isochrone(origin, when)
+        total_ms.append((time.perf_counter() - t) * 1000)
+        stops += len(res["stops"])
+        rings += sum(len(p) for f in res["polygons"]["features"] for p in f["geometry"]["coordinates"])
+    routing.Timetable.reach_times = original
+
+    print(f"{n} isochrones, bands {list(isochrone.ISOCHRONE_BANDS)}, {isochrone.ISOCHRONE_CELL_M:.0f} m cells "
+          f"({stops / n:.0f} stops, {rings / n:.1f} rings on average)")
+    print(f"  cold    p50 {pct(total_ms, .5):7.1f} ms  p95 {pct(total_ms, .95):7.1f} ms  "
+          f"(search p50 {pct(search_ms, .5):.1f} ms, p95 {pct(search_ms, .95):.1f} ms)")
+
+    # Another user a few metres away in the same origin cell
+    g = isochrone.ISOCHRONE_CACHE_GRID_DEG
+    hits = []
+    for origin, when in queries:
+        nearby = [round(origin[0] / g) * g, round(origin[1] / g) * g]
+        t = time.perf_counter()
+        isochrone.isochrone(nearby, when)
+        hits.append((time.perf_counter() - t) * 1000)
+    stats = isochrone.isochrone_cache.snapshot()
+    print(f"  cached  p50 {pct(hits, .5):7.3f} ms  p95 {pct(hits, .95):7.3f} ms  "
+          f"(hits {stats['hits']}, misses {stats['misses']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmark: a login storm next to normal /departures traffic.
+
+    python -m benchmarks.bench_login [login_clients] [seconds]
+
+Starts benchmarks.standin (as AT and NZTA) and the API as uvicorn child
+processes, with a fresh users.db of accounts holding bcrypt hashes plus
+some legacy SHA-256 ones. A fixed set of /departures pollers runs
+throughout, first alone, then while many clients log in back to back
+(honouring Retry-After). The storm is run twice: with hashing spread over
+as many threads as the request threadpool and no admission control (how
+bcrypt behaves inside sync endpoints), and with the default hashing pool.
+Reports /departures throughput and latency, login latency, logins shed
+with 503, legacy hashes upgraded, and the pool's counters from /metrics.
+"""
+
+import asyncio, os, random, sqlite3, subprocess, sys, tempfile, time
+
+import bcrypt
+import httpx
+
+from benchmarks.bench_providers import free_port, wait_for, pct, STOPS
+
+POLLERS = 16
+ACCOUNTS = 2000
+LEGACY = 200
+
+
+def make_accounts(path: str, rounds: int):
+    from app.passwords import legacy_hash
+    from app.users import SCHEMA
+    # One bcrypt hash for every account keeps setup fast; the server does the same work per check
+    hashed = bcrypt.hashpw(b"secret", bcrypt.gensalt(rounds)).decode()
+    con = sqlite3.connect(path)
+    con.execute(SCHEMA)
+    con.executemany("INSERT INTO users VALUES (?, ?, ?, 0, NULL, 0)",
+                    [(f"user{i}", "s", legacy_hash("secret", "s")) if i < LEGACY else (f"user{i}", "", hashed)
+                     for i in range(ACCOUNTS)])
+    con.commit()
+    con.close()
+
+
+async def poll_departures(client, stop_at, out):
+    rnd = random.Random(len(out))
+    while time.monotonic() < stop_at:
+        t = time.perf_counter()
+        try:
+            status = (await client.get("/departures", params={"stop_id": rnd.choice(STOPS[:50])})).status_code
+        except httpx.HTTPError:
+            status = 0
+        out.append((status, (time.perf_counter() - t) * 1000))
+
+
+async def log_in(client, stop_at, out, seed):
+    rnd = random.Random(seed)
+    while time.monotonic() < stop_at:
+        t = time.perf_counter()
+        try:
+            r = await client.post("/auth/login", json={"username": f"user{rnd.randrange(ACCOUNTS)}",
+                                                       "password": "secret"})
+        except httpx.HTTPError:
+            out.append((0, (time.perf_counter() - t) * 1000, None))
+            continue
+        out.append((r.status_code, (time.perf_counter() - t) * 1000, r.headers.get("retry-after")))
+        if r.status_code == 503:
+            # Well-behaved client: honour Retry-After (capped so the run stays short)
+            await asyncio.sleep(min(float(r.headers.get("retry-after", 1)), 2.0))
+
+
+async def phase(api, token, seconds, login_clients):
+    deps, logins = [], []
+    stop_at = time.monotonic() + seconds
+    limits = httpx.Limits(max_connections=POLLERS + login_clients + 4)
+    async with httpx.AsyncClient(base_url=api, headers={"Authorization": f"Bearer {token}"},
+                                 limits=limits, timeout=60) as client:
+        await asyncio.gather(*[poll_departures(client, stop_at, deps) for _ in range(POLLERS)],
+                             *[log_in(client, stop_at, logins, i) for i in range(login_clients)])
+    return deps, logins
+
+
+# Hashing with as many threads as the request threadpool and no admission
+# control stands in for the old design (bcrypt inside sync endpoints)
+CONFIGS = [("request threads, unbounded", {"ATIS_HASH_WORKERS": "40", "ATIS_HASH_QUEUE": "100000",
+                                           "ATIS_HASH_NICE": "0"}),
+           ("hashing pool (defaults)", {})]
+
+
+def run_config(label, extra_env, users_db, standin_port, login_clients, seconds, baseline):
+    api_port = free_port()
+    env = dict(os.environ, ATIS_USE_REAL_PROVIDERS="1", ATIS_USERS_DB_PATH=users_db,
+               ATIS_AT_BASE_URL=f"http://127.0.0.1:{standin_port}/at",
+               ATIS_NZTA_BASE_URL=f"http://127.0.0.1:{standin_port}/nzta", **extra_env)
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(api_port),
+                             "--log-level", "warning"], env=env)
+    try:
+        wait_for(api_port)
+        from app.auth import issue_token
+        api = f"http://127.0.0.1:{api_port}"
+        token = issue_token("bench")
+        print(f"  {label}")
+        phases = ([("departures only", 0)] if baseline else []) + [(f"+ {login_clients} login clients", login_clients)]
+        for name, clients in phases:
+            deps, logins = asyncio.run(phase(api, token, seconds, clients))
+            lat = sorted(ms for _, ms in deps)
+            errors = sum(1 for status, _ in deps if status != 200)
+            print(f"    {name:<22} /departures {len(deps) / seconds:6.0f} req/s  p50 {pct(lat, .5):6.1f} ms  "
+                  f"p99 {pct(lat, .99):7.1f} ms  errors {errors}")
+            if logins:
+                ok = sorted(ms for status, ms, _ in logins if status == 200)
+                shed = [int(ra) for status, _, ra in logins if status == 503]
+                print(f"    {'':<22} logins {len(ok) / seconds:6.1f}/s ok  p50 {pct(ok, .5):6.0f} ms  "
+                      f"p99 {pct(ok, .99):7.0f} ms  503 {len(shed)} (Retry-After {min(shed or ['-'])}"
+                      f"..{max(shed or ['-'])} s)  other {len(logins) - len(ok) - len(shed)}")
+        print(f"    hashing pool: {httpx.get(f'{api}/metrics').json()['passwords']}")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    login_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 15
+    rounds = int(os.getenv("ATIS_BCRYPT_ROUNDS", "12"))
+
+    tmp = tempfile.mkdtemp()
+    users_db = os.path.join(tmp, "users.db")
+    make_accounts(users_db, rounds)
+    standin_port = free_port()
+    standin = subprocess.Popen([sys.executable, "-m", "benchmarks.standin", "--port", str(standin_port)])
+    try:
+        wait_for(standin_port)
+        print(f"{POLLERS} /departures pollers; {ACCOUNTS:,} accounts ({LEGACY} with SHA-256 hashes), "
+              f"bcrypt cost {rounds}, {seconds:.0f} s per phase")
+        for i, (label, extra_env) in enumerate(CONFIGS):
+            run_config(label, extra_env, users_db, standin_port, login_clients, seconds, baseline=i == 0)
+        con = sqlite3.connect(users_db)
+        legacy_left = con.execute("SELECT COUNT(*) FROM users WHERE substr(pw, 1, 2) != '$2'").fetchone()[0]
+        con.close()
+        print(f"  legacy hashes upgraded to bcrypt on login: {LEGACY - legacy_left} of {LEGACY}")
+    finally:
+        standin.terminate()
+        standin.wait()
+
+
+if __name__ == "__main__":
+    main()
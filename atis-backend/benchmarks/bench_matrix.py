@@ -0,0 +1,83 @@
+"""
+Benchmark: many-to-many planning for /plan/matrix.
+
+    python -m benchmarks.bench_matrix [n_origins] [n_destinations] [workers]
+
+On the synthetic 70x70 network, plans an origins x destinations matrix
+(default 40 x 40 = 1,600 pairs) three ways: pair by pair as repeated /plan
+calls would (route, rank, emissions, MCDA), with the one-search-per-origin
+batch router in a single process, and streamed through the worker pool.
+"""
+
+import os, random, sys, tempfile, time
+
+from app import db, gtfs, matrix, routing
+from app.environmental import calculate_itinerary_emissions
+from app.mcda import MCDAScorer
+from app.store import rank_itineraries
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+
+SIDE = 70
+WHEN = "2026-10-19T08:00"
+
+
+def plan_pair(o, d):
+    """What one /plan call does for a pair"""
+    itins = rank_itineraries(routing.route_itineraries(o, d, depart_at=WHEN))
+    for itin in itins:
+        itin["environmental"] = calculate_itinerary_emissions(itin)
+    return MCDAScorer().score_all_itineraries(itins)
+
+
+def main():
+    n_o = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    n_d = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    if len(sys.argv) > 3:
+        matrix.MATRIX_WORKERS = int(sys.argv[3])
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=SIDE)
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db.DB_PATH, log=None)
+    routing.get_timetable()
+
+    rnd = random.Random(7)
+    origins = [list(grid_point(SIDE, rnd)) for _ in range(n_o)]
+    destinations = [list(grid_point(SIDE, rnd)) for _ in range(n_d)]
+    pairs = n_o * n_d
+    print(f"{n_o} x {n_d} = {pairs:,} pairs, {matrix.MATRIX_WORKERS} worker processes")
+
+    # Pair by pair is slow; time a sample and extrapolate
+    sample = [(rnd.choice(origins), rnd.choice(destinations)) for _ in range(min(pairs, 60))]
+    t = time.perf_counter()
+    for o, d in sample:
+        plan_pair(o, d)
+    per_pair = (time.perf_counter() - t) / len(sample)
+    print(f"  sequential /plan per pair    {per_pair * pairs:8.1f} s  (est., {per_pair * 1000:.1f} ms/pair)")
+
+    t = time.perf_counter()
+    params = {"depart_at": WHEN}
+    for i in range(n_o):
+        matrix.solve_chunk([i], [origins[i]], list(range(n_d)), destinations, params)
+    secs = time.perf_counter() - t
+    print(f"  batch search, one process    {secs:8.1f} s  ({pairs / secs:,.0f} pairs/s)")
+
+    matrix.get_matrix_pool()
+    # Start every worker (one per task submitted) and let each load its timetable
+    list(matrix.stream_matrix(origins[:matrix.MATRIX_WORKERS], destinations[:1], params))
+    t = time.perf_counter()
+    first = None
+    routed = 0
+    for row in matrix.stream_matrix(origins, destinations, params):
+        if first is None:
+            first = time.perf_counter() - t
+        routed += row.get("status") == "ok"
+    secs = time.perf_counter() - t
+    print(f"  process pool, streamed       {secs:8.1f} s  ({pairs / secs:,.0f} pairs/s, "
+          f"first row after {first * 1000:.0f} ms, {routed:,} routed)")
+    matrix.reset_matrix_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark: /plan with slow upstreams, sequential vs concurrent steps vs a deadline budget.
+
+    python -m benchmarks.bench_plan_budget [requests] [budget_ms]
+
+Starts benchmarks.standin with a slow MetService and NZTA (long-tailed
+lognormal latency), points the live providers at it and plans random
+journeys on the synthetic 70x70 network, calling the /plan handler
+directly from a few threads (closed loop, so faster plans mean more load).
+Compares running weather, incidents, routing and realtime one after
+another, all at once with no budget, and all at once under the deadline
+budget, reporting throughput, latency and how often a step had to be
+left out.
+"""
+
+import json, os, random, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks.bench_providers import free_port, wait_for
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+
+SIDE = 70
+THREADS = 2
+UPSTREAMS = {"at": {"latency": "lognormal:40,400"},
+             "nzta": {"latency": "lognormal:120,1500"},
+             "metservice": {"latency": "lognormal:200,3000"}}
+
+
+def pct(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 800
+
+    port = free_port()
+    standin = subprocess.Popen([sys.executable, "-m", "benchmarks.standin", "--port", str(port)])
+    base = f"http://127.0.0.1:{port}"
+    for name in UPSTREAMS:
+        os.environ[f"ATIS_{name.upper()}_BASE_URL"] = f"{base}/{name}"
+    try:
+        wait_for(port)
+        httpx.post(f"{base}/_config", json=UPSTREAMS)
+
+        from app import db, gtfs, routing, main as api
+        from app.providers import Providers
+        Providers.USE_REAL = True
+
+        tmp = tempfile.mkdtemp()
+        feed = os.path.join(tmp, "feed.zip")
+        write_feed(feed, side=SIDE)
+        db.DB_PATH = os.path.join(tmp, "atis.db")
+        gtfs.import_feed(feed, db.DB_PATH, log=None)
+        routing.get_timetable()
+
+        rnd = random.Random(5)
+        requests = [api.PlanRequest(origin=grid_point(SIDE, rnd), destination=grid_point(SIDE, rnd),
+                                    depart_at="08:00") for _ in range(n)]
+
+        def sequential(req):
+            api._plan_weather(req.origin).result()
+            api._plan_incidents(req.origin, req.destination).result()
+            result = api._plan_pipeline(req)
+            routing.apply_realtime(result["itineraries"])
+
+        def concurrent(req):
+            return json.loads(api.plan(req, user="bench").body)["context"]["omitted"]
+
+        print(f"{n} plans from {THREADS} threads, upstream latency (median, p99 ms): "
+              + ", ".join(f"{k} {v['latency'].split(':')[1]}" for k, v in UPSTREAMS.items()))
+        for label, fn, budget_s in (("sequential", sequential, None),
+                                    ("concurrent, no budget", concurrent, 60.0),
+                                    (f"concurrent, {budget_ms:.0f} ms budget", concurrent, budget_ms / 1000)):
+            if budget_s is not None:
+                api.PLAN_BUDGET_S = budget_s
+            api.plan_cache.invalidate()
+            lat, omitted = [], {}
+
+            def run(req):
+                t = time.perf_counter()
+                left_out = fn(req) or []
+                lat.append((time.perf_counter() - t) * 1000)
+                for step in left_out:
+                    omitted[step] = omitted.get(step, 0) + 1
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(THREADS) as pool:
+                list(pool.map(run, requests))
+            rate = n / (time.perf_counter() - t0)
+            lat.sort()
+            print(f"  {label:<30} {rate:5.1f} plans/s  p50 {pct(lat, .5):7.1f} ms  p95 {pct(lat, .95):7.1f} ms  "
+                  f"max {lat[-1]:7.1f} ms  omitted "
+                  + (", ".join(f"{k} {v / n:.0%}" for k, v in sorted(omitted.items())) or "-"))
+    finally:
+        standin.terminate()
+        standin.wait()
+
+
+if __name__ == "__main__":
+    main()
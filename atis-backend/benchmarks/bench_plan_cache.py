@@ -0,0 +1,92 @@
+"""
+Benchmark: /plan result cache under concurrent popular requests.
+
+    python -m benchmarks.bench_plan_cache [threads] [requests_per_thread]
+
+On the synthetic 70x70 network, simulates many users planning between a
+handful of popular places (coordinates jittered by ~10 m of GPS noise,
+departures spread over two minutes) and runs the /plan pipeline with and
+without the cache, reporting throughput, latency and how many computations
+ran.
+"""
+
+import os, random, sys, tempfile, threading, time
+
+from app import db, gtfs, routing
+from app import main as api
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+
+SIDE = 70
+
+
+def run(threads, per_thread, requests, handler):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(reqs):
+        local = []
+        for req in reqs:
+            t = time.perf_counter()
+            handler(req)
+            local.append((time.perf_counter() - t) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    chunks = [requests[i * per_thread:(i + 1) * per_thread] for i in range(threads)]
+    ths = [threading.Thread(target=worker, args=(c,)) for c in chunks]
+    t = time.perf_counter()
+    for th in ths:
+        th.start()
+    for th in ths:
+        th.join()
+    secs = time.perf_counter() - t
+    latencies.sort()
+    n = len(latencies)
+    return secs, latencies[n // 2], latencies[int(n * 0.95)]
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=SIDE)
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db.DB_PATH, log=None)
+    routing.get_timetable()
+
+    rnd = random.Random(3)
+    places = [grid_point(SIDE, rnd) for _ in range(6)]
+    popular = [(a, b) for a in places for b in places if a != b][:20]
+    requests = []
+    for _ in range(threads * per_thread):
+        (olat, olng), (dlat, dlng) = rnd.choice(popular)
+        jitter = lambda: rnd.uniform(-0.0001, 0.0001)
+        requests.append(api.PlanRequest(
+            origin=[olat + jitter(), olng + jitter()], destination=[dlat + jitter(), dlng + jitter()],
+            depart_at=f"2026-10-19T08:0{rnd.randrange(2)}"))
+    print(f"{len(requests):,} /plan requests over {len(popular)} popular pairs, {threads} threads")
+
+    computed = []
+
+    def uncached(req):
+        computed.append(1)
+        return api._plan_pipeline(req)
+
+    secs, p50, p95 = run(threads, per_thread, requests, uncached)
+    print(f"  no cache   {secs:6.2f} s  {len(requests) / secs:7.0f} req/s  p50 {p50:7.1f} ms  "
+          f"p95 {p95:7.1f} ms  {len(computed)} computations")
+
+    computed.clear()
+    api.plan_cache.invalidate()
+    cached = lambda req: api.plan_cache.get_or_compute(api._plan_key(req), lambda: uncached(req))
+    secs, p50, p95 = run(threads, per_thread, requests, cached)
+    stats = api.plan_cache.snapshot()
+    print(f"  cached     {secs:6.2f} s  {len(requests) / secs:7.0f} req/s  p50 {p50:7.1f} ms  "
+          f"p95 {p95:7.1f} ms  {len(computed)} computations "
+          f"(hits {stats['hits']}, coalesced {stats['coalesced']}, misses {stats['misses']})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark: the real-provider path (AT, NZTA, MetService) against the local stand-in.
+
+    python -m benchmarks.bench_providers [concurrency] [seconds_per_scenario]
+
+Starts benchmarks.standin and the API (ATIS_USE_REAL_PROVIDERS=1, base
+URLs pointed at the stand-in) as uvicorn child processes, then drives
+/departures, /alerts and /weather/point with concurrent clients through
+several upstream scenarios: healthy, slow tail, flaky and a full outage.
+For each it reports throughput, tail latency, status codes and what the
+provider layer did (upstream calls, retries, last-good fallbacks, breaker
+state).
+"""
+
+import asyncio, json, os, random, socket, subprocess, sys, time
+
+import httpx
+
+SCENARIOS = [
+    # name, stand-in config applied to all three upstreams
+    ("healthy", {"latency": "lognormal:40,400", "error_rate": 0.0, "hang_rate": 0.0}),
+    ("slow tail", {"latency": "lognormal:80,2500", "error_rate": 0.0, "hang_rate": 0.0}),
+    ("flaky 20% 503", {"latency": "lognormal:40,400", "error_rate": 0.2, "hang_rate": 0.0}),
+    ("outage (hangs)", {"latency": "fixed:10", "error_rate": 0.0, "hang_rate": 1.0}),
+]
+STOPS = [f"S{i}" for i in range(500)]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port: int):
+    for _ in range(150):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+def request_for(rnd: random.Random):
+    r = rnd.random()
+    if r < 0.6:
+        return "departures", "/departures", {"stop_id": rnd.choice(STOPS)}
+    if r < 0.8:
+        return "alerts", "/alerts", {"bbox": "174.70,-36.88,174.80,-36.80"}
+    lat, lng = -36.85 + rnd.uniform(-0.1, 0.1), 174.76 + rnd.uniform(-0.1, 0.1)
+    return "weather", "/weather/point", {"lat": round(lat, 4), "lng": round(lng, 4)}
+
+
+async def drive(api: str, token: str, concurrency: int, seconds: float):
+    results = []   # (endpoint, status, ms)
+    stop_at = time.monotonic() + seconds
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=api, headers={"Authorization": f"Bearer {token}"},
+                                 limits=limits, timeout=30) as client:
+        async def worker(seed):
+            rnd = random.Random(seed)
+            while time.monotonic() < stop_at:
+                name, path, params = request_for(rnd)
+                t = time.perf_counter()
+                try:
+                    status = (await client.get(path, params=params)).status_code
+                except httpx.HTTPError:
+                    status = 0
+                results.append((name, status, (time.perf_counter() - t) * 1000))
+        await asyncio.gather(*[worker(i) for i in range(concurrency)])
+    return results
+
+
+def pct(xs, p):
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    standin_port, api_port = free_port(), free_port()
+    standin_url = f"http://127.0.0.1:{standin_port}"
+    env = dict(os.environ, ATIS_USE_REAL_PROVIDERS="1",
+               ATIS_AT_BASE_URL=f"{standin_url}/at", ATIS_NZTA_BASE_URL=f"{standin_url}/nzta",
+               ATIS_METSERVICE_BASE_URL=f"{standin_url}/metservice",
+               ATIS_AT_BREAKER_RESET_S="5", ATIS_NZTA_BREAKER_RESET_S="5", ATIS_METSERVICE_BREAKER_RESET_S="5")
+    procs = [subprocess.Popen([sys.executable, "-m", "benchmarks.standin", "--port", str(standin_port)]),
+             subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(api_port),
+                               "--log-level", "warning"], env=env)]
+    try:
+        wait_for(standin_port)
+        wait_for(api_port)
+        from app.auth import issue_token
+        token = issue_token("bench")
+        api = f"http://127.0.0.1:{api_port}"
+        print(f"{concurrency} concurrent clients, {seconds:.0f} s per scenario "
+              f"(60% /departures over {len(STOPS)} stops, 20% /alerts, 20% /weather/point)")
+        for name, cfg in SCENARIOS:
+            httpx.post(f"{standin_url}/_config", json={u: cfg for u in ("at", "nzta", "metservice")})
+            before = httpx.get(f"{api}/metrics").json()["providers"]
+            results = asyncio.run(drive(api, token, concurrency, seconds))
+            after = httpx.get(f"{api}/metrics").json()["providers"]
+
+            lat = sorted(ms for _, _, ms in results)
+            codes = {}
+            for _, status, _ in results:
+                codes[status] = codes.get(status, 0) + 1
+            print(f"\n  {name}: {len(results) / seconds:6.0f} req/s  p50 {pct(lat, .5):6.1f} ms  "
+                  f"p95 {pct(lat, .95):7.1f} ms  p99 {pct(lat, .99):7.1f} ms  status {dict(sorted(codes.items()))}")
+            for up in ("at", "nzta", "metservice"):
+                d = {k: after[up][k] - before[up][k] for k in
+                     ("requests", "upstream_calls", "retries", "timeouts", "served_last_good", "rejected_open")}
+                print(f"    {up:<10} " + "  ".join(f"{k} {v}" for k, v in d.items())
+                      + f"  breaker {after[up]['breaker']}")
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmark: idle and active SSE subscribers on one server worker.
+
+    python -m benchmarks.bench_push [idle_subscribers] [active_subscribers]
+
+Starts the API under uvicorn in a child process with the push sources
+replaced by static boards (plus one board, TICK, that changes every
+second), then opens thousands of /stream connections from this process.
+Reports the server's CPU use and memory with no subscribers, with every
+idle subscriber connected, and with extra subscribers on the ticking
+board, plus the delivery latency of its diffs.
+"""
+
+import asyncio, os, resource, socket, subprocess, sys, time
+
+IDLE_STOPS = 100
+MEASURE_S = 10
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(port: int):
+    """Child process: the real app with static push sources"""
+    raise_fd_limit()
+    import uvicorn
+    from app import main as api
+
+    def board(stop_id):
+        if stop_id == "TICK":
+            now = time.time()
+            return {"T1": {"trip_id": "T1", "tick": int(now), "sent": now}}
+        return {f"{stop_id}-{i}": {"trip_id": f"{stop_id}-{i}", "route": "NX1", "departure_in_min": i}
+                for i in range(10)}
+
+    api.hub.kinds["departures"].fetch = board
+    api.hub.kinds["departures"].interval_s = 1.0
+    uvicorn.run(api.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def measure(pid: int, label: str):
+    c0, t0 = cpu_seconds(pid), time.monotonic()
+    await asyncio.sleep(MEASURE_S)
+    cpu = (cpu_seconds(pid) - c0) / (time.monotonic() - t0) * 100
+    print(f"  {label:<34} server CPU {cpu:5.1f} %   RSS {rss_mb(pid):6.0f} MB")
+
+
+async def subscribe(port: int, token: str, stop_id: str, latencies=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET /stream?stops={stop_id} HTTP/1.1\r\nHost: bench\r\n"
+                 f"Authorization: Bearer {token}\r\nAccept: text/event-stream\r\n\r\n".encode())
+    await writer.drain()
+    connected = asyncio.get_running_loop().create_future()
+
+    async def pump():
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                if not connected.done() and line.startswith(b"event: snapshot"):
+                    connected.set_result(True)
+                if latencies is not None and line.startswith(b"data: ") and b'"sent"' in line:
+                    sent = float(line.split(b'"sent":', 1)[1].split(b"}", 1)[0])
+                    latencies.append((time.time() - sent) * 1000)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    task = asyncio.get_running_loop().create_task(pump())
+    await connected
+    return writer, task
+
+
+async def run(port: int, pid: int, n_idle: int, n_active: int):
+    from app.auth import issue_token
+    token = issue_token("bench")
+    await measure(pid, "no subscribers")
+
+    conns = []
+    t = time.perf_counter()
+    for i in range(0, n_idle, 200):
+        batch = [subscribe(port, token, f"IDLE-{j % IDLE_STOPS}") for j in range(i, min(n_idle, i + 200))]
+        conns += await asyncio.gather(*batch)
+    print(f"  connected {n_idle:,} idle subscribers in {time.perf_counter() - t:.1f} s")
+    await measure(pid, f"{n_idle:,} idle subscribers")
+
+    latencies = []
+    conns += await asyncio.gather(*[subscribe(port, token, "TICK", latencies) for _ in range(n_active)])
+    latencies.clear()
+    await measure(pid, f"+ {n_active:,} on a board changing 1/s")
+    latencies.sort()
+    if latencies:
+        n = len(latencies)
+        print(f"  {n:,} diffs delivered: latency p50 {latencies[n // 2]:.1f} ms, "
+              f"p95 {latencies[int(n * 0.95)]:.1f} ms (incl. producer poll offset)")
+
+    for writer, task in conns:
+        task.cancel()
+        writer.close()
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--serve":
+        serve(int(sys.argv[2]))
+        return
+    n_idle = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_active = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    raise_fd_limit()
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_push", "--serve", str(port)])
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        time.sleep(3)   # let startup warm-up finish
+        print(f"SSE push, one uvicorn worker (pid {server.pid}), {IDLE_STOPS} idle boards")
+        asyncio.run(run(port, server.pid, n_idle, n_active))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
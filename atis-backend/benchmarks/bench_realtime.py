@@ -0,0 +1,125 @@
+"""
+Benchmark: GTFS-Realtime TripUpdates ingestion.
+
+    python -m benchmarks.bench_realtime [cycles] [changed_share]
+
+On the synthetic 70x70 network, builds a TripUpdates snapshot for every
+trip in service at 08:00 (one to three stop time updates each) and runs
+poll cycles in which a share of trips change delay. Compares re-parsing
+the full feed every cycle with the diffing ingester (decode only changed
+entities), and reports overlay memory per active trip and the cost of
+realtime lookups from /departures and the router.
+"""
+
+import os, random, sys, tempfile, time, tracemalloc
+
+from app import db, gtfs, routing
+from app.realtime import RealtimeOverlay, TripUpdatesFeed, departure_board, overlay
+from benchmarks.synthetic_gtfs import write_feed, trip_updates_feed
+
+SIDE = 70
+DAY = "20261019"
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    share = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=SIDE)
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db.DB_PATH, log=None)
+    tt = routing.get_timetable()
+
+    # Trips on the road at 08:00
+    now = 8 * 3600
+    rnd = random.Random(2)
+    live = []
+    for t, trip_id in enumerate(tt.trip_ids):
+        p, j = tt.trip_pattern[t], tt.trip_col[t]
+        if p < 0:
+            continue
+        nt, m = len(tt.pat_trips[p]), len(tt.pat_stops[p])
+        if tt.pat_dep[p][j] <= now <= tt.pat_arr[p][(m - 1) * nt + j]:
+            live.append((trip_id, p))
+    state = {}
+    for trip_id, p in live:
+        state[trip_id] = {"id": f"TU-{trip_id}", "trip_id": trip_id, "start_date": DAY, "delay": None,
+                          "stop_updates": _stop_updates(tt, p, rnd)}
+
+    snapshots = []
+    for c in range(cycles + 1):
+        if c:
+            for trip_id in rnd.sample(sorted(state), int(len(state) * share)):
+                u = state[trip_id]
+                u["stop_updates"] = _stop_updates(tt, dict(live)[trip_id], rnd)
+                u["canceled"] = rnd.random() < 0.02
+        snapshots.append(trip_updates_feed(list(state.values()), 1_700_000_000 + 30 * c))
+    print(f"{len(live):,} active trips, snapshot {len(snapshots[0]) / 1024:.0f} KB, "
+          f"{share:.0%} of trips change per cycle, {cycles} cycles")
+
+    # Full re-parse: a fresh ingester per cycle decodes every entity
+    full = []
+    for buf in snapshots[1:]:
+        ingester = TripUpdatesFeed(lambda b=buf: b, lambda: tt, target=RealtimeOverlay())
+        t = time.perf_counter()
+        ingester.poll()
+        full.append((time.perf_counter() - t) * 1000)
+
+    ingester = TripUpdatesFeed(lambda: snapshots[0], lambda: tt, target=overlay)
+    ingester.poll()
+    diffs, decoded = [], 0
+    for buf in snapshots[1:]:
+        ingester.source = lambda b=buf: b
+        t = time.perf_counter()
+        last = ingester.poll()
+        diffs.append((time.perf_counter() - t) * 1000)
+        decoded += last["changed"]
+    mean = lambda xs: sum(xs) / len(xs)
+    print(f"  full re-parse per cycle   {mean(full):7.1f} ms  ({len(live):,} entities decoded)")
+    print(f"  diff + apply per cycle    {mean(diffs):7.1f} ms  ({decoded / cycles:,.0f} entities decoded; "
+          f"last: diff {last['diff_ms']} ms, decode {last['decode_ms']} ms, apply {last['apply_ms']} ms)")
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    probe = TripUpdatesFeed(lambda: snapshots[-1], lambda: tt, target=RealtimeOverlay())
+    probe.poll()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    print(f"  memory per active trip    {size / len(live):7.0f} B  (overlay + diff state, "
+          f"{size / 1024 / 1024:.1f} MB total)")
+    same = probe.overlay.trips.keys() == overlay.trips.keys() and all(
+        (a.arr, a.dep, a.canceled) == (b.arr, b.dep, b.canceled)
+        for a, b in ((probe.overlay.trips[k], overlay.trips[k]) for k in overlay.trips))
+    print(f"  incremental overlay matches a full re-parse: {same}")
+
+    ids = [trip_id for trip_id, _ in live]
+    n = 200_000
+    t = time.perf_counter()
+    for k in range(n):
+        rt = overlay.get(ids[k % len(ids)])
+        if rt is not None:
+            rt.departure_delay(3)
+    print(f"  overlay lookup            {(time.perf_counter() - t) / n * 1e9:7.0f} ns  (trip_id -> delay at a stop)")
+
+    when = routing.parse_when(f"2026-10-19T08:00")
+    stops = [tt.stop_ids[rnd.randrange(len(tt.stop_ids))] for _ in range(200)]
+    t = time.perf_counter()
+    for sid in stops:
+        departure_board(tt, sid, when)
+    print(f"  departure board           {(time.perf_counter() - t) / len(stops) * 1000:7.2f} ms  (timetable + overlay)")
+
+
+def _stop_updates(tt, p, rnd):
+    stops, seqs = tt.pat_stops[p], tt.pat_seq[p]
+    out = []
+    for i in sorted(rnd.sample(range(len(stops)), rnd.randint(1, 3))):
+        delay = rnd.choice([0, 30, 60, 120, 240, 420, -30])
+        out.append((seqs[i], tt.stop_ids[stops[i]], delay, delay))
+    return out
+
+
+if __name__ == "__main__":
+    main()
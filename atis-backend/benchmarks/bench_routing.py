@@ -0,0 +1,64 @@
+"""
+Benchmark: RAPTOR query latency on a city-scale synthetic network.
+
+    python -m benchmarks.bench_routing [grid_side] [headway_min] [queries]
+
+Imports a synthetic feed (default 70x70 grid: 4,900 stops, 142 lines,
+~2.25M stop_times), loads the timetable once and times random
+origin/destination queries at random times of day, depart-at and
+arrive-by, on one core.
+"""
+
+import os, random, sys, tempfile, time
+from datetime import datetime, timedelta
+
+from app import db, gtfs, routing
+from benchmarks.synthetic_gtfs import write_feed, grid_point
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    n = len(samples)
+    print(f"  {label:<22} mean {sum(samples)/n:7.1f} ms   p50 {samples[n//2]:7.1f} ms   "
+          f"p95 {samples[int(n*0.95)]:7.1f} ms   p99 {samples[int(n*0.99)]:7.1f} ms   max {samples[-1]:7.1f} ms")
+
+
+def main():
+    side = int(sys.argv[1]) if len(sys.argv) > 1 else 70
+    headway = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+
+    tmp = tempfile.mkdtemp()
+    feed = os.path.join(tmp, "feed.zip")
+    write_feed(feed, side=side, headway_min=headway)
+    db.DB_PATH = os.path.join(tmp, "atis.db")
+    gtfs.import_feed(feed, db.DB_PATH, log=None)
+
+    t0 = time.perf_counter()
+    tt = routing.get_timetable()
+    print(f"Timetable: {len(tt.stop_ids):,} stops, {len(tt.pat_stops):,} patterns, "
+          f"{len(tt.trip_ids):,} trips, {tt.n_stop_times:,} stop times, "
+          f"loaded in {time.perf_counter() - t0:.1f} s")
+
+    rnd = random.Random(11)
+    day = datetime(2026, 10, 19, tzinfo=routing.LOCAL_TZ)
+    queries = []
+    for _ in range(n_queries):
+        when = day + timedelta(seconds=rnd.randrange(7 * 3600, 20 * 3600))
+        queries.append((grid_point(side, rnd), grid_point(side, rnd), when.isoformat()))
+    routing.route_itineraries(queries[0][0], queries[0][1], depart_at=queries[0][2])  # warm caches
+
+    for label, kw in (("depart_at", "depart_at"), ("arrive_by", "arrive_by")):
+        samples, found, transfers = [], 0, 0
+        for o, d, when in queries:
+            t = time.perf_counter()
+            res = routing.route_itineraries(o, d, **{kw: when}, max_walk_km=1.2)
+            samples.append((time.perf_counter() - t) * 1000)
+            found += bool(res)
+            transfers += max((r["transfers"] for r in res), default=0)
+        report(label, samples)
+        print(f"  {'':<22} {found}/{len(queries)} routed, avg max transfers {transfers / max(found, 1):.2f}")
+
+
+if __name__ == "__main__":
+    main()
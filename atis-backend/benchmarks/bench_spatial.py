@@ -0,0 +1,120 @@
+"""
+Benchmark: nearby / k-nearest stop lookups against a synthetic stop table.
+
+    python -m benchmarks.bench_spatial [n_stops] [n_queries]
+
+Builds a throwaway SQLite file with n_stops (default 50k) scattered over the
+Auckland region, loads it through the same path the API uses and reports
+per-query latency for radius and k-nearest lookups, plus the old full scan
+for comparison. Also times the vectorized multi-point batch path against
+looping over single-point lookups.
+"""
+
+import os, sys, random, sqlite3, tempfile, time
+
+import numpy as np
+
+from app import db, spatial
+
+# Roughly the Auckland urban area
+LAT_RANGE = (-37.10, -36.60)
+LON_RANGE = (174.50, 175.00)
+
+
+def build_db(path, n):
+    rnd = random.Random(42)
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE stops (stop_id TEXT PRIMARY KEY, name TEXT, lat REAL, lon REAL)")
+    con.executemany(
+        "INSERT INTO stops VALUES (?, ?, ?, ?)",
+        ((f"S{i}", f"Stop {i}", rnd.uniform(*LAT_RANGE), rnd.uniform(*LON_RANGE)) for i in range(n)))
+    con.commit()
+    con.close()
+
+
+def full_scan(rows, lat, lng, radius):
+    out = []
+    for sid, name, slat, slon in rows:
+        d = db.haversine(lat, lng, slat, slon)
+        if d <= radius:
+            out.append((d, sid))
+    out.sort()
+    return out
+
+
+def timed(fn, points):
+    samples = []
+    for lat, lng in points:
+        t0 = time.perf_counter()
+        fn(lat, lng)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return samples
+
+
+def report(label, samples):
+    n = len(samples)
+    print(f"  {label:<28} mean {sum(samples)/n:8.3f} ms   p50 {samples[n//2]:8.3f} ms   "
+          f"p95 {samples[int(n*0.95)]:8.3f} ms   p99 {samples[int(n*0.99)]:8.3f} ms")
+
+
+def main():
+    n_stops = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    tmp = tempfile.mkdtemp()
+    db.DB_PATH = os.path.join(tmp, "bench.db")
+    build_db(db.DB_PATH, n_stops)
+
+    t0 = time.perf_counter()
+    spatial.reset_stop_index()
+    index = spatial.get_stop_index()
+    print(f"Built grid over {len(index)} stops in {(time.perf_counter() - t0)*1000:.1f} ms "
+          f"({len(index.cells)} cells)")
+
+    rnd = random.Random(7)
+    points = [(rnd.uniform(*LAT_RANGE), rnd.uniform(*LON_RANGE)) for _ in range(n_queries)]
+
+    print(f"{n_queries} queries:")
+    report("radius 900 m", timed(lambda a, b: db.query_nearby_stops(a, b, 900), points))
+    report("radius 2000 m", timed(lambda a, b: db.query_nearby_stops(a, b, 2000), points))
+    report("k=5 nearest", timed(lambda a, b: db.query_nearby_stops(a, b, None, k=5), points))
+    report("k=20 nearest", timed(lambda a, b: db.query_nearby_stops(a, b, None, k=20), points))
+
+    rows = spatial.load_stops()
+    report("full scan (old), 900 m", timed(lambda a, b: full_scan(rows, a, b, 900), points[:50]))
+
+    # Batch: every vertex of a 50-point walk (~40 m steps), and 50 scattered
+    # saved places; nearest 3 stops per point
+    walks = []
+    for lat, lng in points[:20]:
+        walk = []
+        for _ in range(50):
+            lat += rnd.uniform(-0.0004, 0.0004)
+            lng += rnd.uniform(-0.0004, 0.0004)
+            walk.append((lat, lng))
+        walks.append(walk)
+    scattered = [points[i:i + 50] for i in range(0, min(len(points), 1000), 50)]
+    for name, batches in (("walk vertices", walks), ("scattered places", scattered)):
+        print(f"{len(batches)} batches of 50 {name}, k=3:")
+        for label, fn in (
+            ("vectorized batch", lambda pts: db.query_nearby_stops_batch(pts, None, k=3)),
+            ("loop of k-nearest", lambda pts: [db.query_nearby_stops(a, b, None, k=3) for a, b in pts]),
+        ):
+            samples = []
+            for pts in batches:
+                t0 = time.perf_counter()
+                fn(pts)
+                samples.append((time.perf_counter() - t0) * 1000)
+            samples.sort()
+            report(label, samples)
+
+    # Sanity: the batch kernel agrees with the scalar haversine
+    lat, lng = points[0]
+    d_np = spatial.haversine_np(lat, lng, np.array(index.lats), np.array(index.lons))
+    d_py = [db.haversine(lat, lng, a, b) for a, b in zip(index.lats[:100], index.lons[:100])]
+    assert np.allclose(d_np[:100], d_py, atol=1e-3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Benchmark: login throughput on the SQLite user repository vs users.json.
+
+    python -m benchmarks.bench_users [accounts] [logins]
+
+Writes a users.json with many accounts (a tenth with MFA enabled), times
+the one-shot migration into users.db, then runs the login path (verify the
+password, check MFA twice, as /auth/login does) and /me for random users:
+against the JSON file read in full on every call as auth.py used to, and
+against the repository with a cold and a warm cache. The accounts keep
+their SHA-256 hashes on both sides, so this measures the store;
+bcrypt's cost is in bench_login. Finally registers accounts from several
+threads at once with both stores (bcrypt at its minimum cost) and counts
+the registrations that were lost.
+"""
+
+import hashlib, json, os, random, sys, tempfile, threading, time
+
+from app import passwords, users as user_store
+from app.auth import register_user, is_mfa_enabled
+from app.passwords import check_password, legacy_hash as _hash_password
+from app.users import UserRepository, get_users, migrate_legacy
+
+THREADS = 8
+
+
+def legacy_accounts(n: int, rnd: random.Random):
+    data = {}
+    for i in range(n):
+        salt = hashlib.sha256(rnd.randbytes(16)).hexdigest()[:16]
+        data[f"user{i}"] = {"salt": salt, "pw": _hash_password(f"pw{i}", salt), "created": 1_700_000_000 + i,
+                            "mfa_secret": "JBSWY3DPEHPK3PXP", "mfa_enabled": rnd.random() < 0.1}
+    return data
+
+
+class JsonStore:
+    """The users.json store auth.py used: every call loads the file, every write rewrites it"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        with open(self.path) as f:
+            return json.loads(f.read())
+
+    def verify(self, username, password):
+        u = self.load().get(username)
+        return bool(u) and _hash_password(password, u["salt"]) == u["pw"]
+
+    def mfa_enabled(self, username):
+        u = self.load().get(username)
+        return u.get("mfa_enabled", False) if u else False
+
+    def register(self, username, password):
+        users = self.load()
+        if username in users:
+            return False
+        users[username] = {"salt": "s", "pw": _hash_password(password, "s"), "created": 0}
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(users, indent=2))
+        return True
+
+
+def per_login_ms(login, names):
+    t = time.perf_counter()
+    for name in names:
+        login(name)
+    return (time.perf_counter() - t) / len(names) * 1000
+
+
+def concurrent_registrations(register, per_thread: int):
+    def worker(t):
+        for i in range(per_thread):
+            try:
+                register(f"new{t}-{i}", "pw")
+            except (ValueError, OSError):
+                pass   # a reader caught the JSON file half-written
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(THREADS)]
+    start = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    logins = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rnd = random.Random(3)
+    tmp = tempfile.mkdtemp()
+    json_path = os.path.join(tmp, "users.json")
+    data = legacy_accounts(n, rnd)
+    with open(json_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data, indent=2))
+    size_mb = os.path.getsize(json_path) / 1e6
+    names = [f"user{rnd.randrange(n)}" for _ in range(logins)]
+
+    legacy = JsonStore(json_path)
+    def legacy_login(name):
+        assert legacy.verify(name, f"pw{name[4:]}")
+        legacy.mfa_enabled(name)
+        legacy.mfa_enabled(name)
+    sample = names[:max(1, logins // 100)]
+    json_ms = per_login_ms(legacy_login, sample)
+    json_me_ms = per_login_ms(legacy.mfa_enabled, sample)
+
+    repo = UserRepository(os.path.join(tmp, "users.db"))
+    user_store._users = repo
+    t = time.perf_counter()
+    added = migrate_legacy(repo, json_path)
+    print(f"{n:,} accounts: users.json {size_mb:.1f} MB; migrated {added:,} into users.db in "
+          f"{(time.perf_counter() - t) * 1000:.0f} ms")
+
+    def login(name):
+        u = get_users().get(name)
+        assert check_password(f"pw{name[4:]}", u["pw"], u["salt"])
+        is_mfa_enabled(name)
+        is_mfa_enabled(name)
+    repo.cache.invalidate()
+    cold_ms = per_login_ms(login, list(dict.fromkeys(names)))
+    warm_ms = per_login_ms(login, names)
+    me_ms = per_login_ms(is_mfa_enabled, names)
+    print(f"  {'':<26}{'login':>10}{'logins/s':>10}{'/me':>10}")
+    print(f"  {'users.json (sampled)':<26}{json_ms:8.2f}ms{1000 / json_ms:10,.0f}{json_me_ms:8.2f}ms")
+    print(f"  {'users.db, cold cache':<26}{cold_ms:8.3f}ms{1000 / cold_ms:10,.0f}{'-':>10}")
+    print(f"  {'users.db, warm cache':<26}{warm_ms:8.3f}ms{1000 / warm_ms:10,.0f}{me_ms:8.4f}ms")
+    print(f"  cache: {repo.cache.snapshot()['hit_ratio']:.3f} hit ratio")
+
+    per_thread = 25
+    passwords.BCRYPT_ROUNDS = 4
+    with open(json_path + ".migrated") as f:
+        before = len(json.load(f))
+    os.replace(json_path + ".migrated", json_path)
+    secs = concurrent_registrations(legacy.register, per_thread)
+    lost_json = before + THREADS * per_thread - len(legacy.load())
+    before = len(repo)
+    secs_db = concurrent_registrations(register_user, per_thread)
+    lost_db = before + THREADS * per_thread - len(repo)
+    print(f"  {THREADS} threads x {per_thread} registrations: users.json {secs:.1f} s, {lost_json} lost; "
+          f"users.db {secs_db * 1000:.0f} ms, {lost_db} lost")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark: per-point MetService calls vs the ~2 km weather tile cache.
+
+    python -m benchmarks.bench_weather [users] [rounds]
+
+Starts benchmarks.standin with a MetService latency of a few hundred ms,
+points the live providers at it and has users clustered around Auckland
+centres poll their forecast from a pool of threads, a round at a time (the
+app refreshes weather every few minutes). Compares fetching the forecast
+for each point as /weather/point used to (sampled, it is slow) with the
+tile cache, reporting latency, upstream calls per 1,000 polls and the
+hit ratio, then how many /plan weather steps find their tile already warm.
+"""
+
+import os, random, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks.bench_providers import free_port, wait_for
+
+THREADS = 16
+CENTRES = [(-36.848, 174.763), (-36.787, 174.772), (-36.906, 174.816), (-36.990, 174.880),
+           (-36.857, 174.630), (-36.727, 174.710), (-36.940, 174.700)]
+METSERVICE = {"latency": "lognormal:150,1200"}
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else 0.0
+
+
+def user_points(n: int, rnd: random.Random):
+    # Most users within a few km of a centre, like the real population
+    pts = []
+    for _ in range(n):
+        lat, lng = rnd.choice(CENTRES)
+        pts.append((lat + rnd.gauss(0, 0.03), lng + rnd.gauss(0, 0.04)))
+    return pts
+
+
+def run(fn, points):
+    def timed(p):
+        t = time.perf_counter()
+        fn(*p)
+        return (time.perf_counter() - t) * 1000
+    t = time.perf_counter()
+    with ThreadPoolExecutor(THREADS) as ex:
+        lat = list(ex.map(timed, points))
+    return lat, time.perf_counter() - t
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    port = free_port()
+    standin = subprocess.Popen([sys.executable, "-m", "benchmarks.standin", "--port", str(port)])
+    base = f"http://127.0.0.1:{port}"
+    os.environ["ATIS_METSERVICE_BASE_URL"] = f"{base}/metservice"
+    try:
+        wait_for(port)
+        httpx.post(f"{base}/_config", json={"metservice": METSERVICE})
+
+        from app import main as api
+        from app.providers import Providers
+        Providers.USE_REAL = True
+        prov = Providers()
+
+        rnd = random.Random(9)
+        points = user_points(users, rnd)
+        tiles = {api.weather_tile(*p) for p in points}
+        print(f"{users:,} users in {len(tiles):,} tiles of {api.WEATHER_TILE_DEG} deg, {rounds} polling rounds, "
+              f"{THREADS} threads, MetService latency (median, p99 ms) {METSERVICE['latency'].split(':')[1]}")
+        print(f"  {'':<22}{'polls':>8}{'polls/s':>9}{'p50':>9}{'p95':>9}{'upstream/1k':>13}{'hit ratio':>11}")
+
+        def report(label, polls, lat, secs, calls):
+            # Every poll that did not go upstream was a hit (or joined one in flight)
+            print(f"  {label:<22}{polls:8,}{polls / secs:9,.0f}{pct(lat, 0.5):7.1f}ms{pct(lat, 0.95):7.1f}ms"
+                  f"{calls / polls * 1000:13,.0f}{1 - calls / polls:11.3f}")
+
+        # Before: every poll goes upstream (the provider's ~1 km last-good entry only helps on failure)
+        sample = points[:max(THREADS, users // 10)]
+        before = Providers.metservice.snapshot()["upstream_calls"]
+        lat, secs = run(prov.weather, sample)
+        report("per point (sampled)", len(sample), lat, secs,
+               Providers.metservice.snapshot()["upstream_calls"] - before)
+
+        api.weather_cache.invalidate()
+        for r in range(rounds):
+            rnd.shuffle(points)
+            before_calls = api.weather_cache.snapshot()["upstream_calls"]
+            lat, secs = run(api._weather_forecast, points)
+            report(f"tile cache, round {r + 1}", len(points), lat, secs,
+                   api.weather_cache.snapshot()["upstream_calls"] - before_calls)
+
+        # /plan from random users' origins: a warm tile needs no upstream wait at all
+        warm = sum(api._plan_weather(list(p)).done() for p in rnd.sample(points, min(1000, users)))
+        snap = api.weather_cache.snapshot()
+        print(f"  /plan weather step served from the tile cache: {warm / min(1000, users):.1%}; "
+              f"{snap['size']:,} tiles cached, {snap['upstream_calls']:,} upstream calls in total, "
+              f"next turnover within {api.WEATHER_CADENCE_S:.0f} s (cadence-aligned)")
+    finally:
+        standin.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Local stand-in for the AT, NZTA and MetService APIs.
+
+    python -m benchmarks.standin [--port 8900] [--fixtures DIR] [--config JSON]
+    python -m benchmarks.standin --record DIR      # write fresh fixtures from the samples
+
+Serves the endpoints app/providers.py calls, each upstream under its own
+prefix, replaying recorded responses from fixture files:
+
+    ATIS_AT_BASE_URL=http://127.0.0.1:8900/at
+    ATIS_NZTA_BASE_URL=http://127.0.0.1:8900/nzta
+    ATIS_METSERVICE_BASE_URL=http://127.0.0.1:8900/metservice
+
+Per upstream you can set a latency distribution ("fixed:50",
+"uniform:20,200", "lognormal:50,800" = median and p99 in ms), an error
+rate (503s), a hang rate (no answer within the client's timeout) and the
+number of records per response. Change it at runtime with
+POST /_config {"at": {"latency": "lognormal:80,2000", "error_rate": 0.1}};
+GET /_stats returns request counts.
+"""
+
+import argparse, asyncio, json, math, os, random
+from datetime import datetime, timedelta
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+UPSTREAMS = {
+    # name: (fixture file, key in the response body)
+    "at": ("at_departures.json", "departures"),
+    "nzta": ("nzta_incidents.json", "incidents"),
+    "metservice": ("metservice_point.json", "forecast"),
+}
+DEFAULTS = {"latency": "lognormal:40,400", "error_rate": 0.0, "hang_rate": 0.0, "hang_s": 30.0,
+            "records": None}
+
+
+def latency_sampler(spec: str):
+    """Seconds to wait per request, from "fixed:ms", "uniform:lo,hi" or "lognormal:median,p99" """
+    kind, _, args = spec.partition(":")
+    vals = [float(x) / 1000 for x in args.split(",") if x]
+    if kind == "fixed":
+        return lambda: vals[0]
+    if kind == "uniform":
+        return lambda: random.uniform(vals[0], vals[1])
+    if kind == "lognormal":
+        median, p99 = vals
+        sigma = math.log(p99 / median) / 2.326   # z-score of the 99th percentile
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    raise ValueError(f"Unknown latency distribution {spec!r}")
+
+
+def _shift_times(obj, delta: timedelta):
+    """Move every *_time ISO timestamp by delta, so replayed boards stay current"""
+    if isinstance(obj, list):
+        return [_shift_times(x, delta) for x in obj]
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if k.endswith("_time") and isinstance(v, str):
+                try:
+                    v = (datetime.fromisoformat(v) + delta).isoformat()
+                except ValueError:
+                    pass
+            out[k] = _shift_times(v, delta)
+        return out
+    return obj
+
+
+class Upstream:
+    def __init__(self, name: str, fixtures_dir: str):
+        self.name = name
+        fname, self.body_key = UPSTREAMS[name]
+        with open(os.path.join(fixtures_dir, fname)) as f:
+            recorded = json.load(f)
+        self.recorded_at = datetime.fromisoformat(recorded["recorded_at"])
+        self.responses = recorded["responses"]
+        self.configure(DEFAULTS)
+        self.stats = {"requests": 0, "errors": 0, "hangs": 0}
+        self._next = 0
+
+    def configure(self, cfg):
+        for k, v in cfg.items():
+            setattr(self, k, v)
+        self.sample_latency = latency_sampler(self.latency)
+
+    def payload(self):
+        """Next recorded response (round robin), resized and brought up to date"""
+        body = self.responses[self._next % len(self.responses)]
+        self._next += 1
+        if isinstance(body, list) and self.records is not None:
+            body = [body[i % len(body)] for i in range(int(self.records))] if body else []
+        body = _shift_times(body, datetime.utcnow() - self.recorded_at)
+        return {self.body_key: body}
+
+    async def respond(self):
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.sample_latency())
+        r = random.random()
+        if r < self.hang_rate:
+            self.stats["hangs"] += 1
+            await asyncio.sleep(self.hang_s)
+        elif r < self.hang_rate + self.error_rate:
+            self.stats["errors"] += 1
+            return Response(status_code=503)
+        return JSONResponse(self.payload())
+
+
+def build_app(fixtures_dir: str = FIXTURES, config=None) -> Starlette:
+    ups = {name: Upstream(name, fixtures_dir) for name in UPSTREAMS}
+    for name, cfg in (config or {}).items():
+        ups[name].configure(cfg)
+
+    async def departures(request: Request):
+        return await ups["at"].respond()
+
+    async def incidents(request: Request):
+        return await ups["nzta"].respond()
+
+    async def point(request: Request):
+        return await ups["metservice"].respond()
+
+    async def set_config(request: Request):
+        for name, cfg in (await request.json()).items():
+            ups[name].configure(cfg)
+        return JSONResponse({n: {k: getattr(u, k) for k in DEFAULTS} for n, u in ups.items()})
+
+    async def stats(request: Request):
+        return JSONResponse({n: u.stats for n, u in ups.items()})
+
+    return Starlette(routes=[
+        Route("/at/departures/{stop_id}", departures),
+        Route("/nzta/incidents", incidents),
+        Route("/metservice/point", point),
+        Route("/_config", set_config, methods=["POST"]),
+        Route("/_stats", stats),
+    ])
+
+
+def record(out_dir: str, variants: int = 5):
+    """Capture fixture files from the sample generators the API uses without live keys"""
+    from app.store import sample_departures, sample_traffic, sample_weather
+    os.makedirs(out_dir, exist_ok=True)
+    now = datetime.utcnow().isoformat()
+    random.seed(1)
+    recordings = {
+        "at": [sample_departures("STOP") for _ in range(variants)],
+        "nzta": [sample_traffic() for _ in range(variants)],
+        "metservice": [sample_weather([-36.85, 174.76], raw=True) for _ in range(variants)],
+    }
+    for name, responses in recordings.items():
+        with open(os.path.join(out_dir, UPSTREAMS[name][0]), "w") as f:
+            json.dump({"recorded_at": now, "responses": responses}, f, indent=1)
+    print(f"Wrote {len(recordings)} fixture files to {out_dir}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--fixtures", default=FIXTURES)
+    ap.add_argument("--config", default=None, help='JSON, e.g. {"at": {"error_rate": 0.1}}')
+    ap.add_argument("--record", metavar="DIR", help="write fixtures from the sample data and exit")
+    args = ap.parse_args()
+    if args.record:
+        record(args.record)
+        return
+    import uvicorn
+    uvicorn.run(build_app(args.fixtures, json.loads(args.config) if args.config else None),
+                host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Synthetic GTFS feed generator for benchmarks.
+
+Lays stops out on a square grid over Auckland and runs one bus line along
+every grid row and column (both directions), plus a faster rail line along
+each diagonal, with fixed headways across the service day. A 70x70 grid at
+10 minute headways gives ~2M stop_times.
+"""
+
+import csv, io, math, zipfile
+
+ORIGIN = (-36.95, 174.65)   # south-west corner
+SPACING_DEG = 0.004          # ~400 m between grid stops
+
+
+def hms(t):
+    return f"{t // 3600:02d}:{t % 3600 // 60:02d}:{t % 60:02d}"
+
+
+def stop_id(r, c):
+    return f"G{r:03d}_{c:03d}"
+
+
+def grid_lines(side):
+    """(route_id, route_type, seconds between stops, [(r, c), ...])"""
+    lines = []
+    for r in range(side):
+        lines.append((f"R{r:03d}", 3, 75, [(r, c) for c in range(side)]))
+    for c in range(side):
+        lines.append((f"C{c:03d}", 3, 75, [(r, c) for r in range(side)]))
+    # Express rail on the two diagonals, every second grid stop
+    lines.append(("RAIL1", 2, 70, [(i, i) for i in range(0, side, 2)]))
+    lines.append(("RAIL2", 2, 70, [(i, side - 1 - i) for i in range(0, side, 2)]))
+    return lines
+
+
+def write_feed(path, side=70, headway_min=10, start_h=5, end_h=24):
+    """Write a zipped feed to `path`; returns row counts per member"""
+    counts = {}
+    lines = grid_lines(side)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        def member(name, header, rows):
+            n = 0
+            with zf.open(name, "w") as raw:
+                fh = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+                w = csv.writer(fh, lineterminator="\n")
+                w.writerow(header)
+                for row in rows:
+                    w.writerow(row)
+                    n += 1
+                fh.flush()
+                fh.detach()
+            counts[name] = n
+
+        member("agency.txt", ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+               [("SYN", "Synthetic Transit", "https://example.invalid", "Pacific/Auckland")])
+        member("stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon"],
+               ((stop_id(r, c), f"Grid {r}/{c}",
+                 round(ORIGIN[0] + r * SPACING_DEG, 6), round(ORIGIN[1] + c * SPACING_DEG, 6))
+                for r in range(side) for c in range(side)))
+        member("routes.txt", ["route_id", "agency_id", "route_short_name", "route_long_name", "route_type"],
+               ((rid, "SYN", rid, f"Line {rid}", rtype) for rid, rtype, _, _ in lines))
+        member("calendar.txt", ["service_id", "monday", "tuesday", "wednesday", "thursday",
+                                "friday", "saturday", "sunday", "start_date", "end_date"],
+               [("ALL", 1, 1, 1, 1, 1, 1, 1, "20200101", "20351231")])
+
+        def trips():
+            for rid, _, _, seq in lines:
+                for d in (0, 1):
+                    for k, _ in enumerate(range(start_h * 3600, end_h * 3600, headway_min * 60)):
+                        yield (rid, "ALL", f"{rid}-{d}-{k}", f"{rid} dir {d}", d, f"{rid}-{d}")
+        member("trips.txt", ["route_id", "service_id", "trip_id", "trip_headsign", "direction_id", "shape_id"],
+               trips())
+
+        def stop_times():
+            for rid, _, hop, seq in lines:
+                for d in (0, 1):
+                    stops = seq if d == 0 else seq[::-1]
+                    for k, dep in enumerate(range(start_h * 3600, end_h * 3600, headway_min * 60)):
+                        tid = f"{rid}-{d}-{k}"
+                        for i, (r, c) in enumerate(stops):
+                            t = hms(dep + i * hop)
+                            yield (tid, t, t, stop_id(r, c), i + 1)
+        member("stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+               stop_times())
+
+        def shapes():
+            for rid, _, _, seq in lines:
+                for d in (0, 1):
+                    stops = seq if d == 0 else seq[::-1]
+                    for i, (r, c) in enumerate(stops):
+                        yield (f"{rid}-{d}", round(ORIGIN[0] + r * SPACING_DEG, 6),
+                               round(ORIGIN[1] + c * SPACING_DEG, 6), i + 1)
+        member("shapes.txt", ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"], shapes())
+    return counts
+
+
+def grid_point(side, rnd):
+    """Random coordinate inside the grid, for query generation"""
+    span = (side - 1) * SPACING_DEG
+    return (ORIGIN[0] + rnd.uniform(0, span), ORIGIN[1] + rnd.uniform(0, span))
+
+
+# ---------- GTFS-Realtime ----------
+
+def _varint(n):
+    n &= (1 << 64) - 1   # negative ints as 10-byte two's complement
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _pb(field, value):
+    """One protobuf field: ints as varints, bytes/str as length-delimited"""
+    if isinstance(value, int):
+        return _varint(field << 3) + _varint(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return _varint(field << 3 | 2) + _varint(len(value)) + value
+
+
+def trip_updates_feed(updates, timestamp, differential=False):
+    """
+    Encode a GTFS-Realtime FeedMessage of TripUpdates. `updates` is a list of
+    dicts: id, trip_id, start_date, canceled, delay, and stop_updates as
+    [(stop_sequence, stop_id, arrival delay, departure delay)].
+    """
+    msg = [_pb(1, _pb(1, "2.0") + _pb(2, 1 if differential else 0) + _pb(3, timestamp))]
+    for u in updates:
+        trip = _pb(1, u["trip_id"]) + _pb(3, u["start_date"]) + (_pb(4, 3) if u.get("canceled") else b"")
+        body = _pb(1, trip)
+        for seq, sid, arr, dep in u.get("stop_updates", ()):
+            body += _pb(2, _pb(1, seq) + _pb(2, _pb(1, arr)) + _pb(3, _pb(1, dep)) + _pb(4, sid))
+        body += _pb(4, timestamp)
+        if u.get("delay") is not None:
+            body += _pb(5, u["delay"])
+        msg.append(_pb(2, _pb(1, u["id"]) + _pb(3, body)))
+    return b"".join(msg)